@@ -2,26 +2,43 @@
 import logging
 import os
 import json
+import time
+import atexit
+from concurrent.futures import CancelledError
 from flask import Flask, request, abort, render_template, jsonify
 from dotenv import load_dotenv
 
 # --- LineBot 核心元件 ---
-from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
-    Configuration, ApiClient, MessagingApi,
-    ReplyMessageRequest, TextMessage, TemplateMessage,
+    ReplyMessageRequest, PushMessageRequest, TextMessage, TemplateMessage,
     CarouselTemplate, CarouselColumn, MessageAction,
     QuickReply, QuickReplyItem
 )
 from linebot.v3.webhooks import MessageEvent, TextMessageContent, AudioMessageContent, ImageMessageContent
-from linebot.v3.messaging.api import MessagingApiBlob
+from linebot.v3.messaging.exceptions import ApiException
+
+# --- LINE API 共用連線池 ---
+from line_client import init_line_client
+
+# --- Webhook 事件分派 ---
+from webhook_dispatcher import EventDispatcher
+from event_dedup import create_deduplicator
+
+# --- 日誌模組 ---
+from log_config import setup_logging, shutdown_logging
 
 # --- 資料庫模組 ---
 from database.models import init_db, save_recipe, Recipe, get_recipe_count
 
-# --- Google Gemini LLM ---
-import google.generativeai as genai
+# --- LLM（Google Gemini 或本地假後端） ---
+from llm import (
+    create_backend, LLMClient, ModelRouter, ModelTier, parse_routes, HedgePolicy,
+    LLMMetrics, JsonlSink, parse_pricing, LLMGateway, RetryPolicy, CircuitBreaker, iter_array_objects, is_rate_limited,
+    PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND,
+    generate_structured, structured_stats, coerce, StructuredOutputError,
+    RECOMMENDATIONS, RECIPE_DETAILS, SUBSTITUTIONS, RECIPE_CARD_SCHEMA, parse_output_limits
+)
 
 # --- 離線食譜模組已移除 ---
 
@@ -31,6 +48,21 @@ from speech_processor import init_speech_processor, get_speech_processor
 # --- 圖片處理模組 ---
 from image_processor import init_image_processor, get_image_processor
 
+# --- 食材關鍵字比對模組 ---
+from ingredient_matcher import init_ingredient_lexicon, get_ingredient_lexicon, get_ingredient_matcher, KIND_FILLER
+
+# --- 食譜快取模組 ---
+from recipe_cache import (
+    init_recommendation_cache, get_recommendation_cache,
+    init_recipe_detail_cache, get_recipe_detail_cache
+)
+from recipe_prefetch import init_recipe_prefetcher, get_recipe_prefetcher
+
+# --- 對話狀態模組 ---
+from conversation_state import init_conversation_state
+from state_snapshot import init_state_snapshotter, get_state_snapshotter
+from message_coalescer import init_message_coalescer, get_message_coalescer
+
 # --- 載入環境變數 ---
 load_dotenv()
 
@@ -44,31 +76,206 @@ LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
 AZURE_SPEECH_KEY = os.getenv("AZURE_SPEECH_KEY")
 AZURE_SPEECH_REGION = os.getenv("AZURE_SPEECH_REGION")
 
+# --- Webhook 背景處理設定 ---
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "false").lower() == "true"  # 立即回應 webhook，背景處理事件
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_WORKER_TYPE = os.getenv("WEBHOOK_WORKER_TYPE", "thread")  # thread 或 process
+REPLY_TOKEN_TTL = float(os.getenv("REPLY_TOKEN_TTL", "50"))  # reply token 有效秒數，超過改用 push
+# 同一用戶連續送出的短訊息在等待時間內合併成一次處理（process 模式不支援），0 代表停用
+MESSAGE_COALESCE_WINDOW = float(os.getenv("MESSAGE_COALESCE_WINDOW", "0"))
+MESSAGE_COALESCE_MAX_WAIT = float(os.getenv("MESSAGE_COALESCE_MAX_WAIT", "4"))  # 第一則訊息最多等待的秒數
+MESSAGE_COALESCE_MAX_RUNNING = float(os.getenv("MESSAGE_COALESCE_MAX_RUNNING", "120"))  # 處理超過此秒數視為中斷
+EVENT_DEDUP_BACKEND = os.getenv("EVENT_DEDUP_BACKEND", "memory")  # memory、sqlite（多 worker）或 off
+EVENT_DEDUP_TTL = float(os.getenv("EVENT_DEDUP_TTL", "600"))
+EVENT_DEDUP_MAX_ENTRIES = int(os.getenv("EVENT_DEDUP_MAX_ENTRIES", "10000"))
+EVENT_DEDUP_IN_FLIGHT_TIMEOUT = float(os.getenv("EVENT_DEDUP_IN_FLIGHT_TIMEOUT", "180"))  # 處理中事件多久未完成視為中斷，重送時重新處理
+LINE_API_POOL_SIZE = int(os.getenv("LINE_API_POOL_SIZE", "10"))
+LINE_API_CONNECT_TIMEOUT = float(os.getenv("LINE_API_CONNECT_TIMEOUT", "3"))
+LINE_API_READ_TIMEOUT = float(os.getenv("LINE_API_READ_TIMEOUT", "15"))
+
+# --- LLM 呼叫設定 ---
+LLM_CALL_TIMEOUT = float(os.getenv("LLM_CALL_TIMEOUT", "60"))  # 每個呼叫端等待 LLM 結果的秒數
+LLM_CALL_WORKERS = int(os.getenv("LLM_CALL_WORKERS", "16"))  # 同時進行的 LLM 請求上限
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "0"))  # 0 代表不限制
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "0"))  # 0 代表不限制
+LLM_RATE_LIMIT_COOLDOWN = float(os.getenv("LLM_RATE_LIMIT_COOLDOWN", "10"))  # 收到 429 後暫停送出新請求的秒數
+LLM_RETRY_ATTEMPTS = int(os.getenv("LLM_RETRY_ATTEMPTS", "3"))  # 每個請求最多嘗試次數（含第一次）
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+LLM_CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", "5"))  # 連續失敗幾次後斷路器開啟
+LLM_CIRCUIT_RECOVERY = float(os.getenv("LLM_CIRCUIT_RECOVERY", "30"))  # 斷路器開啟後多久放行試探請求
+LLM_CIRCUIT_PROBE_TIMEOUT = float(os.getenv("LLM_CIRCUIT_PROBE_TIMEOUT", "90"))  # 試探請求未回報結果多久後重新放行
+# 各呼叫類型的輸出 token 上限，可用 LLM_MAX_OUTPUT_TOKENS="recipe_details=2000,substitutions=800" 覆寫
+LLM_OUTPUT_LIMITS = {
+    "recommendations": 800,
+    "recommendations_combined": 3000,
+    "recipe_details": 1500,
+    "substitutions": 600,
+    "alternatives": 400,
+    "ingredient_extraction": 200,
+    "image_analysis": 600,
+    **parse_output_limits(os.getenv("LLM_MAX_OUTPUT_TOKENS", ""))
+}
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")  # gemini 或 fake（離線壓力測試用的本地假後端）
+LLM_MODEL = os.getenv("LLM_MODEL", "gemini-1.5-flash")
+LLM_FAKE_LATENCY = os.getenv("LLM_FAKE_LATENCY", "lognormal:0.8,0.4")  # fixed / uniform / normal / lognormal / exp
+LLM_FAKE_ERROR_RATE = float(os.getenv("LLM_FAKE_ERROR_RATE", "0"))  # 假後端返回 503 的機率
+LLM_FAKE_RATE_LIMIT_RATE = float(os.getenv("LLM_FAKE_RATE_LIMIT_RATE", "0"))  # 假後端返回 429 的機率
+LLM_FAKE_SEED = int(os.getenv("LLM_FAKE_SEED", "42"))
+# 模型路由：設定 LLM_FAST_MODEL 後，簡短任務優先使用快速模型，詳細食譜等長輸出優先使用 LLM_MODEL；
+# 偏好的層級過慢或被限流時改用另一個層級。可用 LLM_ROUTES="ingredient_extraction=fast>default" 覆寫
+LLM_FAST_MODEL = os.getenv("LLM_FAST_MODEL", "")  # 例如 gemini-1.5-flash-8b，空白代表只使用 LLM_MODEL
+LLM_FAST_TEMPERATURE = float(os.getenv("LLM_FAST_TEMPERATURE", "0.2"))
+LLM_FAKE_FAST_LATENCY = os.getenv("LLM_FAKE_FAST_LATENCY", "lognormal:0.3,0.3")  # 假後端快速層級的延遲分佈
+LLM_ROUTES = {
+    "ingredient_extraction": ["fast", "default"],
+    "alternatives": ["fast", "default"],
+    "substitutions": ["fast", "default"],
+    "recommendations": ["default", "fast"],
+    "recommendations_combined": ["default", "fast"],
+    "recipe_details": ["default", "fast"],
+    "image_analysis": ["default", "fast"],
+    **parse_routes(os.getenv("LLM_ROUTES", ""))
+}
+LLM_ROUTE_SLOW_SECONDS = float(os.getenv("LLM_ROUTE_SLOW_SECONDS", "15"))  # 單次呼叫超過此秒數視為該層級過慢
+LLM_ROUTE_COOLDOWN = float(os.getenv("LLM_ROUTE_COOLDOWN", "30"))  # 層級過慢或被限流後改用其他層級的秒數
+# 請求對沖：超過該呼叫類型近期 p95 延遲仍未返回時再送出一次，採用先完成的結果
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE", "false").lower() == "true"
+LLM_HEDGE_CALL_TYPES = [name.strip() for name in os.getenv(
+    "LLM_HEDGE_CALL_TYPES", "recipe_details,recommendations,recommendations_combined"
+).split(",") if name.strip()]
+LLM_HEDGE_MAX_SHARE = float(os.getenv("LLM_HEDGE_MAX_SHARE", "0.05"))  # 對沖請求佔所有請求的比例上限
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))  # 累積多少筆延遲後才開始對沖
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "2"))  # 對沖門檻下限（秒）
+# 呼叫統計：/metrics/llm 列出各呼叫類型的延遲直方圖、token、重試、快取命中與估算費用
+LLM_METRICS_JSONL = os.getenv("LLM_METRICS_JSONL", "")  # 每次呼叫寫入一行 JSON，空白代表不寫檔
+# 每百萬 token 價格（美元），格式 "模型=輸入/輸出"，未列出的模型費用以 0 計算
+LLM_PRICING = parse_pricing(os.getenv("LLM_PRICING", ""))
+RECOMMENDATION_MODE = os.getenv("RECOMMENDATION_MODE", "standard")  # standard 或 combined（推薦與詳細食譜一次生成）
+RECOMMENDATION_STREAMING = os.getenv("RECOMMENDATION_STREAMING", "false").lower() == "true"  # 串流讀取推薦，收到三道料理即停止
+
+# --- 對話狀態設定 ---
+CONVERSATION_STATE_BACKEND = os.getenv("CONVERSATION_STATE_BACKEND", "memory")  # memory（單一程序）或 sqlite（多個 gunicorn worker 共用）
+CONVERSATION_STATE_CACHE = int(os.getenv("CONVERSATION_STATE_CACHE", "1000"))  # sqlite 後端的程序內讀取快取用戶數，0 代表停用
+CONVERSATION_MAX_USERS = int(os.getenv("CONVERSATION_MAX_USERS", "10000"))  # 超過時淘汰最久沒有互動的用戶
+CONVERSATION_MAX_BYTES = int(os.getenv("CONVERSATION_MAX_BYTES", str(50 * 1024 * 1024)))
+CONVERSATION_IDLE_TIMEOUT = float(os.getenv("CONVERSATION_IDLE_TIMEOUT", "86400"))  # 閒置超過此秒數後對話重新開始
+STATE_SNAPSHOT_PATH = os.getenv("STATE_SNAPSHOT_PATH", "")  # 對話狀態快照檔（例如 database/state.snapshot），空白代表不保存；只適用 memory 後端
+STATE_SNAPSHOT_INTERVAL = float(os.getenv("STATE_SNAPSHOT_INTERVAL", "60"))  # 每隔幾秒寫入有變動的狀態
+STATE_SNAPSHOT_CACHES = os.getenv("STATE_SNAPSHOT_CACHES", "true").lower() == "true"  # 一併保存沒有存到資料庫的推薦 / 詳細食譜快取
+
+# --- 食材詞庫設定 ---
+INGREDIENT_LEXICON_PATH = os.getenv("INGREDIENT_LEXICON_PATH", "")  # 空白代表使用內建的 data/ingredient_lexicon.json
+INGREDIENT_LEXICON_RELOAD = float(os.getenv("INGREDIENT_LEXICON_RELOAD", "10"))  # 每隔幾秒檢查詞庫檔是否修改，0 代表不自動重新載入
+INGREDIENT_MIN_CONFIDENCE = float(os.getenv("INGREDIENT_MIN_CONFIDENCE", "0.7"))  # 本地比對的最低信心，低於此值交給 LLM
+
+# --- 推薦快取設定 ---
+RECOMMENDATION_CACHE_ENABLED = os.getenv("RECOMMENDATION_CACHE", "true").lower() == "true"
+RECOMMENDATION_CACHE_TTL = float(os.getenv("RECOMMENDATION_CACHE_TTL", "86400"))
+RECOMMENDATION_CACHE_MAX_ENTRIES = int(os.getenv("RECOMMENDATION_CACHE_MAX_ENTRIES", "1000"))
+RECOMMENDATION_CACHE_MAX_BYTES = int(os.getenv("RECOMMENDATION_CACHE_MAX_BYTES", str(5 * 1024 * 1024)))
+RECOMMENDATION_CACHE_VARIANTS = int(os.getenv("RECOMMENDATION_CACHE_VARIANTS", "3"))  # 每個食材組合保留的推薦版本數
+RECOMMENDATION_CACHE_REFRESH = float(os.getenv("RECOMMENDATION_CACHE_REFRESH", "0.3"))  # 版本未滿時重新生成的機率
+RECOMMENDATION_CACHE_PERSIST = os.getenv("RECOMMENDATION_CACHE_PERSIST", "true").lower() == "true"
+RECIPE_DETAIL_CACHE_ENABLED = os.getenv("RECIPE_DETAIL_CACHE", "true").lower() == "true"
+RECIPE_DETAIL_CACHE_MAX_ENTRIES = int(os.getenv("RECIPE_DETAIL_CACHE_MAX_ENTRIES", "500"))
+RECIPE_DETAIL_CACHE_MAX_BYTES = int(os.getenv("RECIPE_DETAIL_CACHE_MAX_BYTES", str(10 * 1024 * 1024)))
+RECIPE_DETAIL_CACHE_MAX_AGE = float(os.getenv("RECIPE_DETAIL_CACHE_MAX_AGE", str(30 * 86400)))  # 詳細食譜存活秒數
+RECIPE_DETAIL_CACHE_PERSIST = os.getenv("RECIPE_DETAIL_CACHE_PERSIST", "true").lower() == "true"
+
+# --- 詳細食譜預先生成設定 ---
+RECIPE_PREFETCH_ENABLED = os.getenv("RECIPE_PREFETCH", "false").lower() == "true"
+RECIPE_PREFETCH_WORKERS = int(os.getenv("RECIPE_PREFETCH_WORKERS", "2"))
+RECIPE_PREFETCH_MAX_PENDING = int(os.getenv("RECIPE_PREFETCH_MAX_PENDING", "6"))
+RECIPE_PREFETCH_MAX_PER_MINUTE = int(os.getenv("RECIPE_PREFETCH_MAX_PER_MINUTE", "30"))
+# 進行中的 LLM 請求達到此數量時不做背景預先生成
+RECIPE_PREFETCH_BUSY_THRESHOLD = int(os.getenv("RECIPE_PREFETCH_BUSY_THRESHOLD", str(LLM_CALL_WORKERS // 2)))
+
 # --- 設定日誌 ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    filename='momshero_llm_ui.log',
-    filemode='a'
+setup_logging(
+    log_file=os.getenv("LOG_FILE", "momshero_llm_ui.log"),
+    max_bytes=int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+    backup_count=int(os.getenv("LOG_BACKUP_COUNT", "5")),
+    json_format=os.getenv("LOG_JSON", "true").lower() == "true",
+    echo_stdout=os.getenv("LOG_STDOUT", "false").lower() == "true",  # 同時輸出到 stdout
+    debug_sample_rate=float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0"))  # 事件詳細日誌抽樣比例
 )
+atexit.register(shutdown_logging)
 
 # --- 初始化資料庫 ---
 print("正在初始化資料庫...")
 init_db()
 
-# --- 初始化 Google Gemini ---
-def init_gemini():
-    """初始化 Google Gemini LLM"""
+# --- 初始化 LLM 後端 ---
+def init_llm_backend(model_name=LLM_MODEL, fake_latency=LLM_FAKE_LATENCY):
+    """初始化 LLM 後端（Google Gemini 或本地假後端）"""
+    if LLM_BACKEND == "fake":
+        backend = create_backend(
+            "fake",
+            latency=fake_latency,
+            error_rate=LLM_FAKE_ERROR_RATE,
+            rate_limit_rate=LLM_FAKE_RATE_LIMIT_RATE,
+            seed=LLM_FAKE_SEED,
+            model_name=model_name
+        )
+        print(f"使用本地假 LLM 後端（延遲 {fake_latency}）")
+        return backend
+
     if not GOOGLE_API_KEY:
         raise ValueError("未設定 GOOGLE_API_KEY")
-    
-    genai.configure(api_key=GOOGLE_API_KEY)
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    print("Google Gemini LLM 初始化成功！")
-    return model
+    backend = create_backend(LLM_BACKEND, model_name=model_name, api_key=GOOGLE_API_KEY)
+    print(f"Google Gemini LLM 初始化成功！（{model_name}）")
+    return backend
+
+def init_llm_router():
+    """依設定建立模型層級與路由"""
+    tiers = [ModelTier("default", init_llm_backend())]
+    routes = {}
+    if LLM_FAST_MODEL:
+        tiers.append(ModelTier(
+            "fast",
+            init_llm_backend(LLM_FAST_MODEL, LLM_FAKE_FAST_LATENCY),
+            generation_config={"temperature": LLM_FAST_TEMPERATURE}
+        ))
+        routes = LLM_ROUTES
+    return ModelRouter(tiers, routes, slow_after=LLM_ROUTE_SLOW_SECONDS, cooldown=LLM_ROUTE_COOLDOWN)
 
 try:
-    llm_model = init_gemini()
+    llm_router = init_llm_router()
+    # 所有 LLM 呼叫都經過 llm_client，相同提示詞的並行請求只送出一次，
+    # 再由閘道依優先順序、並行上限與每分鐘配額排程
+    llm_gateway = LLMGateway(
+        max_concurrent=LLM_CALL_WORKERS,
+        requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+        tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+        rate_limit_cooldown=LLM_RATE_LIMIT_COOLDOWN,
+        retry=RetryPolicy(
+            max_attempts=LLM_RETRY_ATTEMPTS,
+            base_delay=LLM_RETRY_BASE_DELAY,
+            max_delay=LLM_RETRY_MAX_DELAY,
+            budget=LLM_CALL_TIMEOUT
+        ),
+        breaker=CircuitBreaker(
+            failure_threshold=LLM_CIRCUIT_FAILURES,
+            recovery_timeout=LLM_CIRCUIT_RECOVERY,
+            probe_timeout=LLM_CIRCUIT_PROBE_TIMEOUT
+        )
+    )
+    llm_hedging = HedgePolicy(
+        LLM_HEDGE_CALL_TYPES,
+        max_share=LLM_HEDGE_MAX_SHARE,
+        percentile=LLM_HEDGE_PERCENTILE,
+        min_samples=LLM_HEDGE_MIN_SAMPLES,
+        min_delay=LLM_HEDGE_MIN_DELAY
+    ) if LLM_HEDGE_ENABLED else None
+    llm_metrics = LLMMetrics(
+        pricing=LLM_PRICING,
+        sink=JsonlSink(LLM_METRICS_JSONL) if LLM_METRICS_JSONL else None
+    )
+    llm_client = LLMClient(timeout=LLM_CALL_TIMEOUT, gateway=llm_gateway, router=llm_router,
+                           hedging=llm_hedging, metrics=llm_metrics)
+    atexit.register(llm_client.shutdown)
     LLM_AVAILABLE = True
 except Exception as e:
     print(f"LLM 初始化失敗: {e}")
@@ -87,10 +294,13 @@ except Exception as e:
     print(f"Azure Speech Service 初始化失敗: {e}")
     SPEECH_AVAILABLE = False
 
+# --- 初始化食材詞庫（文字訊息與圖片分析共用同一份詞庫） ---
+init_ingredient_lexicon(INGREDIENT_LEXICON_PATH, INGREDIENT_LEXICON_RELOAD, INGREDIENT_MIN_CONFIDENCE)
+
 # --- 初始化圖片處理器 ---
 try:
     if LLM_AVAILABLE:
-        init_image_processor(llm_model)
+        init_image_processor(llm_client)
         IMAGE_AVAILABLE = True
         print("圖片處理器初始化成功！")
     else:
@@ -112,54 +322,74 @@ def load_prompt_template():
 PROMPT_TEMPLATE = load_prompt_template()
 print(f"提示模板載入成功，長度: {len(PROMPT_TEMPLATE)} 字元")
 
+# --- 註冊提示詞（系統指示與輸出上限）---
+if LLM_AVAILABLE:
+    for call_type, max_output_tokens in LLM_OUTPUT_LIMITS.items():
+        llm_client.prompts.register(
+            call_type,
+            system_instruction=PROMPT_TEMPLATE if call_type == "recipe_details" else None,
+            max_output_tokens=max_output_tokens
+        )
+
+# --- 初始化推薦快取 ---
+if RECOMMENDATION_CACHE_ENABLED:
+    init_recommendation_cache(
+        max_entries=RECOMMENDATION_CACHE_MAX_ENTRIES,
+        max_bytes=RECOMMENDATION_CACHE_MAX_BYTES,
+        ttl=RECOMMENDATION_CACHE_TTL,
+        max_variants=RECOMMENDATION_CACHE_VARIANTS,
+        refresh_probability=RECOMMENDATION_CACHE_REFRESH,
+        persist=RECOMMENDATION_CACHE_PERSIST
+    )
+
+# --- 初始化詳細食譜快取（提示模板變更時舊資料自動失效）---
+if RECIPE_DETAIL_CACHE_ENABLED:
+    init_recipe_detail_cache(
+        PROMPT_TEMPLATE,
+        max_entries=RECIPE_DETAIL_CACHE_MAX_ENTRIES,
+        max_bytes=RECIPE_DETAIL_CACHE_MAX_BYTES,
+        max_age=RECIPE_DETAIL_CACHE_MAX_AGE,
+        persist=RECIPE_DETAIL_CACHE_PERSIST
+    )
+
+# --- 初始化訊息合併器（合併結果只在同一程序內有效，process 模式不啟用）---
+if MESSAGE_COALESCE_WINDOW > 0 and WEBHOOK_WORKER_TYPE != "process":
+    init_message_coalescer(MESSAGE_COALESCE_WINDOW, MESSAGE_COALESCE_MAX_WAIT, MESSAGE_COALESCE_MAX_RUNNING)
+
 # --- 用戶對話狀態管理 ---
-class ConversationState:
-    def __init__(self):
-        self.user_states = {}  # 儲存每個用戶的對話狀態
-    
-    def get_user_state(self, user_id):
-        """取得用戶的對話狀態"""
-        if user_id not in self.user_states:
-            self.user_states[user_id] = {
-                'stage': 'idle',  # idle, waiting_for_ingredients, waiting_for_choice, substitution_mode
-                'ingredients': [],
-                'recommendations': [],
-                'selected_recipe': None,
-                'recipe_details': None,
-                'substitutions': {}  # 替代方案記錄
-            }
-        return self.user_states[user_id]
-    
-    def update_user_state(self, user_id, updates):
-        """更新用戶的對話狀態"""
-        state = self.get_user_state(user_id)
-        state.update(updates)
-        self.user_states[user_id] = state
-    
-    def reset_user_state(self, user_id):
-        """重置用戶的對話狀態"""
-        self.user_states[user_id] = {
-            'stage': 'idle',
-            'ingredients': [],
-            'recommendations': [],
-            'selected_recipe': None,
-            'recipe_details': None,
-            'substitutions': {}
-        }
+conversation_state = init_conversation_state(
+    CONVERSATION_STATE_BACKEND,
+    max_users=CONVERSATION_MAX_USERS,
+    max_bytes=CONVERSATION_MAX_BYTES,
+    idle_timeout=CONVERSATION_IDLE_TIMEOUT,
+    cache_size=CONVERSATION_STATE_CACHE
+)
 
-# 全域對話狀態管理器
-conversation_state = ConversationState()
+# --- 狀態快照（背景還原，不延遲啟動與第一個請求）---
+if STATE_SNAPSHOT_PATH:
+    snapshot_caches = {}
+    if STATE_SNAPSHOT_CACHES:
+        # 已存到資料庫的快取重啟後本來就還在，只保存純記憶體的快取
+        if get_recommendation_cache() and not get_recommendation_cache().persist:
+            snapshot_caches["recommendations"] = (get_recommendation_cache().memory, "recommendations")
+        if get_recipe_detail_cache() and not get_recipe_detail_cache().persist:
+            snapshot_caches["recipe_details"] = (get_recipe_detail_cache().memory, get_recipe_detail_cache().version)
+    init_state_snapshotter(
+        STATE_SNAPSHOT_PATH,
+        conversation_state if conversation_state.backend == "memory" else None,  # sqlite 後端本身已保存在資料庫
+        snapshot_caches,
+        interval=STATE_SNAPSHOT_INTERVAL
+    )
+    atexit.register(get_state_snapshotter().close)
 
 # --- UI 功能函數 ---
 def create_recipe_carousel(recommendations):
     """創建輪播樣板顯示推薦食譜"""
     logging.info(f"🎠 開始創建輪播樣板，推薦數量: {len(recommendations)}")
-    print(f"🎠 開始創建輪播樣板，推薦數量: {len(recommendations)}")
     
     columns = []
     for i, recipe in enumerate(recommendations[:3]):  # 只顯示3個推薦
-        logging.info(f"  📋 處理推薦 {i+1}: {recipe}")
-        print(f"  📋 處理推薦 {i+1}: {recipe}")
+        logging.debug(f"  📋 處理推薦 {i+1}: {recipe}")
         
         title = recipe.get('name', f'料理 {i+1}')
         ingredients = recipe.get('ingredients', [])
@@ -170,8 +400,7 @@ def create_recipe_carousel(recommendations):
         
         text = f"主要食材：{ingredients_text}\n時間：{recipe.get('time', '未知')} 難度：{recipe.get('difficulty', '未知')}"
         
-        logging.info(f"  🏷️  輪播項目 {i+1}: 標題='{title}', 內容='{text}'")
-        print(f"  🏷️  輪播項目 {i+1}: 標題='{title}', 內容='{text}'")
+        logging.debug(f"  🏷️  輪播項目 {i+1}: 標題='{title}', 內容='{text}'")
         
         column = CarouselColumn(
             title=title[:40],
@@ -187,7 +416,6 @@ def create_recipe_carousel(recommendations):
         columns.append(column)
     
     logging.info(f"✅ 輪播樣板創建完成，共 {len(columns)} 個項目")
-    print(f"✅ 輪播樣板創建完成，共 {len(columns)} 個項目")
     
     return TemplateMessage(
         altText="為您推薦的料理",
@@ -243,19 +471,10 @@ def create_recipe_details_with_ui(recipe_details):
     return TextMessage(text=details, quickReply=quick_reply, quoteToken=None)
 
 # --- LLM 輔助函數 ---
-def generate_llm_recommendations(user_id, ingredients):
-    """使用 LLM 生成食譜推薦（帶重試機制）"""
-    import time
-    
-    if not LLM_AVAILABLE:
-        logging.error("LLM 不可用，無法生成推薦")
-        return None
-    
-    ingredients_text = "、".join(ingredients)
-    logging.info(f"🤖 開始調用 LLM 生成推薦，食材: {ingredients_text}")
-    
+def build_recommendation_prompt(ingredients_text):
+    """建立推薦提示詞（只含輪播卡片需要的欄位）"""
     # 簡化 prompt 以減少處理時間
-    prompt = f"""根據食材：{ingredients_text}，推薦3道料理，JSON格式回覆：
+    return f"""根據食材：{ingredients_text}，推薦3道料理，JSON格式回覆：
 
 {{
     "recommendations": [
@@ -266,76 +485,172 @@ def generate_llm_recommendations(user_id, ingredients):
 }}
 
 要求：簡單實用料理，時間格式如「15分鐘」，難度：簡單/中等/困難，只回覆JSON。"""
+
+def build_combined_recommendation_prompt(ingredients_text):
+    """建立推薦 + 詳細食譜的提示詞，一次呼叫取得輪播與詳細食譜需要的全部內容"""
+    return f"""根據食材：{ingredients_text}，推薦3道料理並附上完整食譜，JSON格式回覆：
+
+{{
+    "recommendations": [
+        {{
+            "name": "料理名",
+            "ingredients": ["食材1", "食材2"],
+            "time": "時間",
+            "difficulty": "難度",
+            "description": "描述",
+            "details": {{
+                "ingredients": [{{"name": "食材名稱", "amount": "份量", "note": "備註"}}],
+                "steps": ["步驟1", "步驟2", "步驟3"],
+                "tips": "烹調小技巧",
+                "nutrition": "營養價值"
+            }}
+        }}
+    ]
+}}
+
+要求：共3道簡單實用料理，使用繁體中文，時間格式如「15分鐘」，難度：簡單/中等/困難，份量明確、步驟清楚易懂，只回覆JSON。"""
+
+def attach_recipe_details(recommendations):
+    """將一次生成的詳細食譜整理成 create_recipe_details_with_ui 使用的格式"""
+    for recipe in recommendations:
+        details = recipe.get('details')
+        if not isinstance(details, dict) or not details.get('steps'):
+            recipe.pop('details', None)
+            continue
+        recipe['details'] = {
+            'name': recipe.get('name', '未知料理'),
+            'ingredients': details.get('ingredients', recipe.get('ingredients', [])),
+            'time': recipe.get('time', '未知'),
+            'difficulty': recipe.get('difficulty', '未知'),
+            'steps': details.get('steps', []),
+            'tips': details.get('tips', '無'),
+            'nutrition': details.get('nutrition', '')
+        }
+        if not recipe['details']['nutrition']:
+            recipe['details'].pop('nutrition')
+
+def generate_llm_recommendations(user_id, ingredients, cancel=None):
+    """使用 LLM 生成食譜推薦（帶重試機制），cancel 取消時中止進行中的 LLM 呼叫並返回 None"""
+    
+    if not LLM_AVAILABLE:
+        logging.error("LLM 不可用，無法生成推薦")
+        return None
+    
+    ingredients_text = "、".join(ingredients)
+    
+    # 相同食材組合直接使用快取
+    combined = RECOMMENDATION_MODE == "combined"
+    cache_namespace = "combined" if combined else ""
+    recommendation_cache = get_recommendation_cache()
+    if recommendation_cache:
+        cached = recommendation_cache.get(ingredients, cache_namespace)
+        if cached:
+            logging.info(f"⚡ 推薦快取命中，食材: {ingredients_text}")
+            llm_client.metrics.record_cache_hit("recommendations_combined" if combined else "recommendations")
+            return cached
     
-    # 重試機制
+    logging.info(f"🤖 開始調用 LLM 生成推薦，食材: {ingredients_text}")
+    
+    if combined:
+        prompt = build_combined_recommendation_prompt(ingredients_text)
+        call_type = "recommendations_combined"
+    else:
+        prompt = build_recommendation_prompt(ingredients_text)
+        call_type = "recommendations"
+    
+    # 回應內容無效時重新生成；上游錯誤的重試與退避由 LLM 閘道處理
     max_retries = 3
-    retry_delay = 2
     
     for attempt in range(max_retries):
         try:
             logging.info(f"🔄 LLM 調用嘗試 {attempt + 1}/{max_retries}")
             
-            # 直接使用原有的 LLM 模型
-            response = llm_model.generate_content(prompt)
-            logging.info(f"✅ LLM 調用完成")
-            
-            if response and response.text:
-                # 清理回應文字
-                text = response.text.strip()
-                if text.startswith('```json'):
-                    text = text[7:]
-                if text.endswith('```'):
-                    text = text[:-3]
-                text = text.strip()
-                
-                try:
-                    data = json.loads(text)
-                    recommendations = data.get('recommendations', [])
-                    
-                    if recommendations:
-                        logging.info(f"✅ LLM 成功生成 {len(recommendations)} 個推薦")
-                        return recommendations
-                    else:
-                        logging.warning("LLM 回應中沒有找到推薦")
-                        if attempt < max_retries - 1:
-                            continue  # 重試
-                        return None
-                        
-                except json.JSONDecodeError as e:
-                    logging.error(f"❌ JSON 解析失敗: {e} (嘗試 {attempt + 1})")
-                    if attempt < max_retries - 1:
-                        continue  # 重試
-                    return None
+            if RECOMMENDATION_STREAMING:
+                recommendations = stream_llm_recommendations(prompt, call_type=call_type, cancel=cancel)
             else:
-                logging.error("LLM 沒有返回有效回應")
-                if attempt < max_retries - 1:
-                    continue  # 重試
-                return None
-                
+                # 格式小錯誤在本地修復，不必重新呼叫 LLM
+                data = generate_structured(llm_client, prompt, RECOMMENDATIONS, call_type=call_type,
+                                           cancel=cancel)
+                recommendations = data['recommendations']
+            
+            if recommendations:
+                logging.info(f"✅ LLM 成功生成 {len(recommendations)} 個推薦")
+                if combined:
+                    attach_recipe_details(recommendations)
+                if recommendation_cache:
+                    recommendation_cache.add(ingredients, recommendations, cache_namespace)
+                return recommendations
+            logging.warning("LLM 回應中沒有找到推薦")
+        
+        except StructuredOutputError as e:
+            logging.error(f"❌ 推薦格式無效: {e} (嘗試 {attempt + 1})")
+        except CancelledError:
+            logging.info(f"⏭️  推薦已取消，食材: {ingredients_text}")
+            return None
         except Exception as e:
-            logging.error(f"LLM 調用失敗 (嘗試 {attempt + 1}): {e}")
-            if attempt < max_retries - 1:
-                logging.info(f"⏰ 等待 {retry_delay} 秒後重試...")
-                time.sleep(retry_delay)
-                retry_delay *= 2  # 指數退避
-                continue
-            else:
-                logging.error("LLM 推薦生成最終失敗")
-                return None
+            # 閘道已在時間預算內重試過，或斷路器開啟中，不再於此等待
+            logging.error(f"LLM 推薦生成失敗: {e}")
+            return None
     
+    logging.error("LLM 推薦生成最終失敗")
     return None
 
-def generate_llm_recipe_details(recipe_name):
-    """使用 LLM 生成詳細食譜"""
+def stream_llm_recommendations(prompt, limit=3, call_type="recommendations", cancel=None):
+    """
+    串流生成推薦，每道料理的 JSON 物件一完整就收下，收滿 limit 道即停止讀取
+    
+    Args:
+        prompt: 推薦提示詞
+        limit: 需要的料理數（輪播卡片數）
+        call_type: 呼叫類型
+        cancel: 取消權杖，取消後停止讀取串流
+    
+    Returns:
+        推薦清單
+    """
+    started = time.monotonic()
+    recommendations = []
+    chunks = llm_client.stream_content(prompt, call_type=call_type, cancel=cancel)
+    try:
+        for recipe in iter_array_objects(chunks):
+            try:
+                recipe = coerce(recipe, RECIPE_CARD_SCHEMA)
+            except StructuredOutputError as e:
+                logging.warning(f"略過格式無效的料理: {e}")
+                continue
+            if not recommendations:
+                logging.info(f"⚡ 第一道料理於 {time.monotonic() - started:.2f} 秒後完成")
+            recommendations.append(recipe)
+            if len(recommendations) >= limit:
+                break
+    finally:
+        chunks.close()  # 不再讀取剩餘的串流內容
+    logging.debug(f"串流推薦完成，耗時 {time.monotonic() - started:.2f} 秒")
+    return recommendations
+
+def generate_llm_recipe_details(recipe_name, recommendation=None, priority=PRIORITY_INTERACTIVE):
+    """使用 LLM 生成詳細食譜（先查詳細食譜快取）"""
+    recipe_detail_cache = get_recipe_detail_cache()
+    if recipe_detail_cache:
+        cached = recipe_detail_cache.get(recipe_name)
+        if cached:
+            logging.info(f"⚡ 詳細食譜快取命中: {recipe_name}")
+            if LLM_AVAILABLE:
+                llm_client.metrics.record_cache_hit("recipe_details")
+            return cached
+    
     try:
         if not LLM_AVAILABLE:
             return None
         
-        prompt = f"""
-{PROMPT_TEMPLATE}
-
-請為「{recipe_name}」提供詳細的食譜，以JSON格式回覆：
-
+        # 推薦卡片上的主要食材，讓詳細食譜與推薦一致
+        ingredients_hint = ""
+        if recommendation and isinstance(recommendation.get('ingredients'), list):
+            ingredients_hint = f"主要食材：{'、'.join(str(i) for i in recommendation['ingredients'])}\n"
+        
+        # PROMPT_TEMPLATE 已註冊為 recipe_details 的系統指示，不必每次放進提示詞
+        prompt = f"""請為「{recipe_name}」提供詳細的食譜，以JSON格式回覆：
+{ingredients_hint}
 {{
     "name": "{recipe_name}",
     "ingredients": [
@@ -359,29 +674,17 @@ def generate_llm_recipe_details(recipe_name):
 4. 只回覆JSON格式，不要其他文字
 """
         
-        response = llm_model.generate_content(prompt)
-        
-        if response and response.text:
-            # 清理回應文字
-            text = response.text.strip()
-            if text.startswith('```json'):
-                text = text[7:]
-            if text.endswith('```'):
-                text = text[:-3]
-            text = text.strip()
-            
-            try:
-                data = json.loads(text)
-                return data
-                    
-            except json.JSONDecodeError as e:
-                logging.error(f"JSON 解析失敗: {e}")
-                logging.error(f"LLM 回應: {response.text}")
-                return None
-        else:
-            logging.error("LLM 沒有返回有效回應")
-            return None
-            
+        data = generate_structured(
+            llm_client, prompt, RECIPE_DETAILS, call_type="recipe_details", priority=priority
+        )
+        data.setdefault('name', recipe_name)
+        if recipe_detail_cache:
+            recipe_detail_cache.put(recipe_name, data)
+        return data
+    
+    except StructuredOutputError as e:
+        logging.error(f"詳細食譜格式無效: {e}")
+        return None
     except Exception as e:
         logging.error(f"LLM 詳細食譜生成失敗: {e}")
         return None
@@ -413,29 +716,11 @@ def generate_llm_substitutions(missing_ingredients):
 4. 只回覆JSON格式，不要其他文字
 """
         
-        response = llm_model.generate_content(prompt)
-        
-        if response and response.text:
-            # 清理回應文字
-            text = response.text.strip()
-            if text.startswith('```json'):
-                text = text[7:]
-            if text.endswith('```'):
-                text = text[:-3]
-            text = text.strip()
-            
-            try:
-                data = json.loads(text)
-                return data
-                    
-            except json.JSONDecodeError as e:
-                logging.error(f"JSON 解析失敗: {e}")
-                logging.error(f"LLM 回應: {response.text}")
-                return None
-        else:
-            logging.error("LLM 沒有返回有效回應")
-            return None
-            
+        return generate_structured(llm_client, prompt, SUBSTITUTIONS, call_type="substitutions")
+    
+    except StructuredOutputError as e:
+        logging.error(f"替代方案格式無效: {e}")
+        return None
     except Exception as e:
         logging.error(f"LLM 替代方案生成失敗: {e}")
         return None
@@ -448,7 +733,6 @@ def generate_alternatives_with_llm_simple(user_id, message, selected_recipe):
     
     try:
         logging.info(f"🤖 開始調用 LLM 生成替代方案")
-        print(f"🤖 開始調用 LLM 生成替代方案")
         
         # 構建提示詞（簡潔版）
         prompt = f"""用戶想做：{selected_recipe.get('name', '未知料理')}
@@ -468,13 +752,11 @@ def generate_alternatives_with_llm_simple(user_id, message, selected_recipe):
 
 請保持簡短實用。"""
 
-        logging.info(f"📝 LLM 替代方案提示詞長度: {len(prompt)} 字元")
-        print(f"📝 LLM 替代方案提示詞長度: {len(prompt)} 字元")
+        logging.debug(f"📝 LLM 替代方案提示詞長度: {len(prompt)} 字元")
         
-        response = llm_model.generate_content(prompt)
+        response = llm_client.generate_content(prompt, call_type="alternatives")
         
         logging.info(f"✅ LLM 替代方案調用完成")
-        print(f"✅ LLM 替代方案調用完成")
         
         if response and response.text:
             response_text = response.text.strip()
@@ -485,7 +767,6 @@ def generate_alternatives_with_llm_simple(user_id, message, selected_recipe):
                 return None
             
             logging.info(f"✅ LLM 替代方案生成成功，長度: {len(response_text)} 字元")
-            print(f"✅ LLM 替代方案生成成功，長度: {len(response_text)} 字元")
             
             return response_text
         else:
@@ -494,17 +775,29 @@ def generate_alternatives_with_llm_simple(user_id, message, selected_recipe):
             
     except Exception as e:
         logging.error(f"LLM 替代方案生成失敗: {e}")
-        print(f"❌ LLM 替代方案生成失敗: {e}")
         
         # 檢查是否是配額錯誤
-        if "quota" in str(e).lower() or "429" in str(e):
+        if is_rate_limited(e):
             return "抱歉，AI 服務的免費額度已用完。請稍後再試，或考慮升級到付費版本。"
         else:
             return None
 
 # --- 多輪對話處理函數 ---
-def handle_conversation(user_id, user_message):
-    """處理多輪對話邏輯"""
+# 處理中被用戶的新訊息取代（合併後重新處理），不回覆
+SUPERSEDED = object()
+
+def handle_conversation(user_id, user_message, cancel=None):
+    """
+    處理多輪對話邏輯
+
+    Args:
+        user_id: LINE 用戶 ID
+        user_message: 訊息內容
+        cancel: 合併批次的取消權杖，用戶送出新訊息時中止這次處理的 LLM 呼叫
+
+    Returns:
+        回覆訊息；被 cancel 取消時返回 SUPERSEDED（不回覆）
+    """
     state = conversation_state.get_user_state(user_id)
     
     # 檢查是否要重置對話
@@ -558,15 +851,15 @@ def handle_conversation(user_id, user_message):
     
     # 根據當前階段處理訊息
     if state['stage'] == 'idle':
-        return handle_idle_stage(user_id, user_message)
+        return handle_idle_stage(user_id, user_message, cancel)
     elif state['stage'] == 'waiting_for_ingredients':
-        return handle_ingredients_stage(user_id, user_message)
+        return handle_ingredients_stage(user_id, user_message, cancel)
     elif state['stage'] == 'waiting_for_choice':
         return handle_choice_stage(user_id, user_message)
     else:
-        return handle_idle_stage(user_id, user_message)
+        return handle_idle_stage(user_id, user_message, cancel)
 
-def handle_idle_stage(user_id, user_message):
+def handle_idle_stage(user_id, user_message, cancel=None):
     """處理閒置階段的訊息"""
     # 檢查是否包含食材資訊
     ingredients = extract_ingredients(user_message)
@@ -577,7 +870,7 @@ def handle_idle_stage(user_id, user_message):
             'stage': 'waiting_for_ingredients',
             'ingredients': ingredients
         })
-        return generate_recommendations_with_ui(user_id, ingredients)
+        return generate_recommendations_with_ui(user_id, ingredients, cancel)
     else:
         # 如果沒有識別到食材，直接引導用戶提供食材
         return TextMessage(text="""歡迎來到 MomsHero！👩‍🍳
@@ -592,7 +885,7 @@ def handle_idle_stage(user_id, user_message):
 
 請分享您的食材吧！""", quickReply=None, quoteToken=None)
 
-def handle_ingredients_stage(user_id, user_message):
+def handle_ingredients_stage(user_id, user_message, cancel=None):
     """處理食材收集階段的訊息"""
     # 檢查是否要重新提供食材
     if any(keyword in user_message for keyword in ['重新', '換', '其他']):
@@ -601,7 +894,7 @@ def handle_ingredients_stage(user_id, user_message):
             conversation_state.update_user_state(user_id, {
                 'ingredients': ingredients
             })
-            return generate_recommendations_with_ui(user_id, ingredients)
+            return generate_recommendations_with_ui(user_id, ingredients, cancel)
     
     # 檢查是否包含新的食材資訊
     ingredients = extract_ingredients(user_message)
@@ -609,7 +902,7 @@ def handle_ingredients_stage(user_id, user_message):
         conversation_state.update_user_state(user_id, {
             'ingredients': ingredients
         })
-        return generate_recommendations_with_ui(user_id, ingredients)
+        return generate_recommendations_with_ui(user_id, ingredients, cancel)
     
     # 如果沒有新的食材資訊，引導用戶提供
     return TextMessage(text="請告訴我您有哪些食材，我會為您推薦適合的料理！", quickReply=None, quoteToken=None)
@@ -624,24 +917,28 @@ def handle_recipe_details_request(user_id, recipe_name):
     state = conversation_state.get_user_state(user_id)
     
     # 先從推薦列表中查找
+    recommendation = None
     for recipe in state.get('recommendations', []):
         if recipe.get('name') == recipe_name:
-            # 使用 LLM 生成更詳細的食譜
-            detailed_recipe = generate_llm_recipe_details(recipe_name)
-            if detailed_recipe:
-                conversation_state.update_user_state(user_id, {'selected_recipe': detailed_recipe})
-                return create_recipe_details_with_ui(detailed_recipe)
-            else:
-                # 如果 LLM 失敗，使用原始推薦資料
-                conversation_state.update_user_state(user_id, {'selected_recipe': recipe})
-                return create_recipe_details_with_ui(recipe)
+            recommendation = recipe
+            break
     
-    # 如果沒找到，嘗試用 LLM 直接生成
-    detailed_recipe = generate_llm_recipe_details(recipe_name)
+    # 推薦時已一起生成詳細食譜，不需再呼叫 LLM
+    if recommendation and recommendation.get('details'):
+        conversation_state.update_user_state(user_id, {'selected_recipe': recommendation['details']})
+        return create_recipe_details_with_ui(recommendation['details'])
+    
+    # 詳細食譜（快取或 LLM 生成）
+    detailed_recipe = generate_llm_recipe_details(recipe_name, recommendation)
     if detailed_recipe:
         conversation_state.update_user_state(user_id, {'selected_recipe': detailed_recipe})
         return create_recipe_details_with_ui(detailed_recipe)
     
+    # 如果 LLM 失敗，使用原始推薦資料
+    if recommendation:
+        conversation_state.update_user_state(user_id, {'selected_recipe': recommendation})
+        return create_recipe_details_with_ui(recommendation)
+    
     # 離線食譜已移除
     
     return TextMessage(text=f"抱歉，找不到「{recipe_name}」的詳細食譜。", quickReply=None, quoteToken=None)
@@ -652,7 +949,6 @@ def handle_substitution_input(user_id, user_message):
     selected_recipe = state.get('selected_recipe', {})
     
     logging.info(f"🔄 處理替代方案輸入: 用戶 {user_id}, 訊息: '{user_message}'")
-    print(f"🔄 處理替代方案輸入: 用戶 {user_id}, 訊息: '{user_message}'")
     
     # 使用 LLM 生成替代方案建議（類似 app_llm.py 的方式）
     llm_response = generate_alternatives_with_llm_simple(user_id, user_message, selected_recipe)
@@ -680,109 +976,79 @@ def handle_substitution_input(user_id, user_message):
             quoteToken=None
         )
 
-def generate_recommendations_with_ui(user_id, ingredients):
-    """生成帶有 UI 的推薦食譜"""
+def generate_recommendations_with_ui(user_id, ingredients, cancel=None):
+    """
+    生成帶有 UI 的推薦食譜
+
+    Args:
+        user_id: LINE 用戶 ID
+        ingredients: 食材清單
+        cancel: 取消權杖，用戶送出新訊息時中止進行中的 LLM 呼叫
+
+    Returns:
+        輪播或錯誤訊息；被 cancel 取消時返回 SUPERSEDED
+    """
     logging.info(f"🎯 開始生成UI推薦，用戶: {user_id}, 食材: {ingredients}")
-    print(f"🎯 開始生成UI推薦，用戶: {user_id}, 食材: {ingredients}")
     
     try:
         # 嘗試使用 LLM 生成推薦
         if LLM_AVAILABLE:
-            logging.info(f"📞 調用 LLM 推薦生成器")
-            print(f"📞 調用 LLM 推薦生成器")
+            logging.debug(f"📞 調用 LLM 推薦生成器")
+            
+            recommendations = generate_llm_recommendations(user_id, ingredients, cancel)
             
-            recommendations = generate_llm_recommendations(user_id, ingredients)
+            # 用戶已送出新訊息，這次的推薦會與新訊息合併重新處理
+            if cancel is not None and cancel.cancelled:
+                logging.info(f"⏭️  用戶 {user_id} 已送出新訊息，取消這次推薦")
+                return SUPERSEDED
             
-            logging.info(f"📊 LLM 推薦結果: {recommendations}")
-            print(f"📊 LLM 推薦結果: {recommendations}")
+            logging.debug(f"📊 LLM 推薦結果: {recommendations}")
             
             if recommendations and isinstance(recommendations, list):
                 logging.info(f"✅ LLM 推薦成功，生成 {len(recommendations)} 個推薦")
-                print(f"✅ LLM 推薦成功，生成 {len(recommendations)} 個推薦")
                 
                 conversation_state.update_user_state(user_id, {'recommendations': recommendations})
                 carousel = create_recipe_carousel(recommendations)
                 
                 logging.info(f"🎠 輪播樣板創建完成")
-                print(f"🎠 輪播樣板創建完成")
                 
                 return carousel
             else:
                 logging.warning(f"⚠️  LLM 推薦結果為空或格式錯誤")
-                print(f"⚠️  LLM 推薦結果為空或格式錯誤")
         else:
             logging.warning(f"⚠️  LLM 不可用，跳過 LLM 推薦")
-            print(f"⚠️  LLM 不可用，跳過 LLM 推薦")
             
     except Exception as e:
         logging.error(f"❌ LLM 推薦生成失敗: {e}")
-        print(f"❌ LLM 推薦生成失敗: {e}")
     
     # 如果 LLM 失敗，直接提供錯誤訊息
     logging.error(f"❌ 所有推薦方法都失敗，返回錯誤訊息")
-    print(f"❌ 所有推薦方法都失敗，返回錯誤訊息")
     
     return TextMessage(text="抱歉，目前無法為您生成推薦。請稍後再試！", quickReply=None, quoteToken=None)
 
 
 # --- 輔助函數 ---
+def is_command_message(message):
+    """是否為指令類訊息（重新開始、查看詳細食譜、替代方案、完成查詢），這類訊息不與前後訊息合併"""
+    return (message.startswith("我要做") or "我食材有缺" in message or "完成查詢" in message
+            or any(keyword in message for keyword in ['重新開始', '重置', '重新', '開始']))
+
 def is_recipe_related(message):
-    """檢查訊息是否與食譜相關"""
-    recipe_keywords = [
-        '食材', '料理', '烹調', '煮', '炒', '蒸', '炸', '烤', '燉', '湯',
-        '飯', '麵', '菜', '肉', '魚', '蛋', '豆腐', '青菜', '調味',
-        '食譜', '做法', '步驟', '時間', '難度', '技巧', '小貼士'
-    ]
-    
-    # 檢查是否包含食材名稱
-    ingredient_keywords = [
-        '雞蛋', '豬肉', '牛肉', '雞肉', '魚', '蝦', '豆腐', '青菜', '番茄',
-        '洋蔥', '蒜', '薑', '蔥', '醬油', '鹽', '糖', '油', '米', '麵'
-    ]
-    
-    message_lower = message.lower()
-    
-    # 檢查食譜相關關鍵字
-    for keyword in recipe_keywords:
-        if keyword in message_lower:
-            return True
-    
-    # 檢查食材關鍵字
-    for keyword in ingredient_keywords:
-        if keyword in message_lower:
-            return True
-    
-    # 檢查是否包含數量詞（可能表示食材）
-    quantity_patterns = ['個', '顆', '片', '塊', '條', '根', '把', '包', '罐', '瓶']
-    for pattern in quantity_patterns:
-        if pattern in message:
-            return True
-    
-    return False
+    """檢查訊息是否與食譜相關（包含食材、烹調關鍵字或數量詞）"""
+    return any(match.kind != KIND_FILLER for match in get_ingredient_matcher().find(message))
 
 def extract_ingredients(message):
     """從訊息中提取食材"""
     logging.info(f"🔍 開始提取食材，訊息: '{message}'")
     
-    ingredients = []
+    # 先以詞庫比對食材（標準名稱、別名，再對剩下的片段做近似比對）
+    extraction = get_ingredient_lexicon().extract(message)
+    ingredients = extraction.ingredients
+    if extraction.fuzzy:
+        logging.info(f"🔎 近似比對: {extraction.fuzzy}")
     
-    # 常見食材關鍵字
-    ingredient_keywords = [
-        '雞蛋', '豬肉', '牛肉', '雞肉', '魚', '蝦', '豆腐', '青菜', '番茄',
-        '洋蔥', '蒜', '薑', '蔥', '醬油', '鹽', '糖', '油', '米', '麵',
-        '胡蘿蔔', '馬鈴薯', '青椒', '甜椒', '芹菜', '韭菜', '香菜',
-        '白菜', '高麗菜', '包菜', '香菇', '金針菇', '木耳', '紅蘿蔔',
-        '花椰菜', '青花菜', '玉米', '小黃瓜', '冬瓜', '南瓜', '茄子'
-    ]
-    
-    # 先檢查常見食材
-    message_lower = message.lower()
-    for ingredient in ingredient_keywords:
-        if ingredient in message_lower:
-            ingredients.append(ingredient)
-    
-    # 如果沒找到食材，嘗試用 LLM 來識別
-    if not ingredients and LLM_AVAILABLE and len(message) > 2:
+    # 本地信心不足（訊息中還有未知內容或近似比對信心太低）時，才用 LLM 來識別
+    if extraction.needs_llm and LLM_AVAILABLE and len(message) > 2:
         try:
             prompt = f"""請從以下訊息中識別出食材名稱，只回傳食材名稱，用逗號分隔：
 
@@ -796,14 +1062,14 @@ def extract_ingredients(message):
 
 請只回傳食材名稱或「無」，不要其他文字："""
 
-            response = llm_model.generate_content(prompt)
+            response = llm_client.generate_content(prompt, call_type="ingredient_extraction")
             llm_response = response.text.strip()
             
             if llm_response != '無' and llm_response:
                 llm_ingredients = llm_response.split(',')
                 for ingredient in llm_ingredients:
                     ingredient = ingredient.strip()
-                    if ingredient and len(ingredient) > 1 and ingredient != '無':
+                    if ingredient and len(ingredient) > 1 and ingredient != '無' and ingredient not in ingredients:
                         ingredients.append(ingredient)
                         
         except Exception as e:
@@ -817,16 +1083,101 @@ def extract_ingredients(message):
     
     return ingredients
 
+# --- 初始化詳細食譜預先生成器 ---
+if RECIPE_PREFETCH_ENABLED and LLM_AVAILABLE:
+    init_recipe_prefetcher(
+        lambda name, recommendation: generate_llm_recipe_details(name, recommendation, priority=PRIORITY_BACKGROUND),
+        max_workers=RECIPE_PREFETCH_WORKERS,
+        max_pending=RECIPE_PREFETCH_MAX_PENDING,
+        max_per_minute=RECIPE_PREFETCH_MAX_PER_MINUTE,
+        is_busy=lambda: llm_client.gateway.load() >= RECIPE_PREFETCH_BUSY_THRESHOLD
+    )
+
 # --- Line Bot 設定 ---
-configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+line_client = init_line_client(
+    LINE_CHANNEL_ACCESS_TOKEN,
+    pool_size=LINE_API_POOL_SIZE,
+    connect_timeout=LINE_API_CONNECT_TIMEOUT,
+    read_timeout=LINE_API_READ_TIMEOUT
+)
+def note_text_message(event):
+    """記錄文字訊息到達的順序與時間，供訊息合併器判斷哪些訊息一起處理"""
+    message_coalescer = get_message_coalescer()
+    if message_coalescer and isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+        text = event.message.text
+        message_coalescer.arrive(event.source.user_id, event.message.id, text, not is_command_message(text))
+
+handler = EventDispatcher(
+    LINE_CHANNEL_SECRET,
+    async_mode=WEBHOOK_ASYNC,
+    max_workers=WEBHOOK_WORKERS,
+    worker_type=WEBHOOK_WORKER_TYPE,
+    deduplicator=create_deduplicator(EVENT_DEDUP_BACKEND, EVENT_DEDUP_TTL, EVENT_DEDUP_MAX_ENTRIES,
+                                     EVENT_DEDUP_IN_FLIGHT_TIMEOUT),
+    on_submit=note_text_message
+)
+atexit.register(handler.shutdown)
+atexit.register(line_client.close)
+
+def send_response(event, response_message):
+    """回覆用戶訊息，reply token 過期或失效時改用 push message"""
+    if response_message is SUPERSEDED:
+        return
+    messages = response_message if isinstance(response_message, list) else [response_message]
+    token_age = time.time() - event.timestamp / 1000
+    replied = False
+
+    if token_age < REPLY_TOKEN_TTL:
+        try:
+            line_client.reply_message(
+                ReplyMessageRequest(
+                    replyToken=event.reply_token,
+                    messages=messages,
+                    notificationDisabled=None
+                )
+            )
+            replied = True
+        except ApiException as e:
+            logging.warning(f"reply token 無法使用 ({e.status})，改用 push message")
+    else:
+        logging.info(f"reply token 已過期 ({token_age:.1f} 秒)，改用 push message")
+
+    if not replied:
+        line_client.push_message(
+            PushMessageRequest(
+                to=event.source.user_id,
+                messages=messages,
+                notificationDisabled=None,
+                customAggregationUnits=None
+            )
+        )
+
+    # 輪播推薦送出後，背景預先生成詳細食譜
+    if any(isinstance(message, TemplateMessage) for message in messages):
+        prefetch_recipe_details(event.source.user_id)
+
+def prefetch_recipe_details(user_id):
+    """為用戶目前的推薦料理預先生成詳細食譜（結果存入詳細食譜快取）"""
+    recipe_prefetcher = get_recipe_prefetcher()
+    recipe_detail_cache = get_recipe_detail_cache()
+    if not recipe_prefetcher or not recipe_detail_cache or not LLM_AVAILABLE:
+        return
+    
+    state = conversation_state.get_user_state(user_id)
+    items = [
+        (recipe.get('name'), recipe)
+        for recipe in state.get('recommendations', [])[:3]
+        if recipe.get('name') and not recipe.get('details')
+        and not recipe_detail_cache.contains(recipe['name'])
+    ]
+    recipe_prefetcher.schedule(items)
 
 # --- Webhook 處理 ---
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
-    app.logger.info(f"Request body: {body}")
+    logging.debug(f"Request body: {body}")
     try:
         handler.handle(body, signature)
     except InvalidSignatureError:
@@ -839,32 +1190,33 @@ def handle_text_message(event):
     user_id = event.source.user_id
     user_message = event.message.text
     
+    # 合併等待時間內的連續訊息；已併入前一則訊息一起處理時不再回覆
+    message_coalescer = get_message_coalescer()
+    batch = None
+    if message_coalescer:
+        batch = message_coalescer.take(user_id, event.message.id, user_message, not is_command_message(user_message))
+        if batch is None:
+            logging.info(f"訊息已與用戶 {user_id} 的前一則訊息合併處理")
+            return
+        user_message = batch.text
+    
     try:
         # 使用整合的對話處理函數
-        response_message = handle_conversation(user_id, user_message)
-        
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    replyToken=event.reply_token,
-                    messages=[response_message],
-                    notificationDisabled=None
-                )
-            )
+        response_message = handle_conversation(user_id, user_message, batch.cancel_token if batch else None)
     except Exception as e:
         logging.error(f"處理文字訊息時發生錯誤: {e}")
         # 發送錯誤訊息
-        error_message = TextMessage(text="抱歉，處理您的訊息時發生錯誤。請稍後再試！", quickReply=None, quoteToken=None)
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    replyToken=event.reply_token,
-                    messages=[error_message],
-                    notificationDisabled=None
-                )
-            )
+        response_message = TextMessage(text="抱歉，處理您的訊息時發生錯誤。請稍後再試！", quickReply=None, quoteToken=None)
+    finally:
+        # 不論處理是否中斷都要結束批次，否則同一用戶的後續訊息會一直等待
+        should_reply = batch is None or message_coalescer.finish(batch)
+    
+    # 處理期間用戶又送出新訊息：結果不回覆，訊息與新訊息合併後重新處理
+    if not should_reply or response_message is SUPERSEDED:
+        logging.info(f"用戶 {user_id} 已送出新訊息，略過這次回覆")
+        return
+    
+    send_response(event, response_message)
 
 @handler.add(MessageEvent, message=AudioMessageContent)
 def handle_audio_message(event):
@@ -879,24 +1231,22 @@ def handle_audio_message(event):
             response_message = TextMessage(text="抱歉，語音處理功能目前無法使用，請改用文字輸入。", quickReply=None, quoteToken=None)
         else:
             # 獲取語音內容
-            with ApiClient(configuration) as api_client:
-                blob_api = MessagingApiBlob(api_client)
-                try:
-                    content = blob_api.get_message_content(message_id)
-                except Exception as download_error:
-                    logging.error(f"語音下載失敗: {download_error}")
-                    raise download_error
-                
-                # 建立暫存檔案
-                temp_dir = "temp_files"
-                os.makedirs(temp_dir, exist_ok=True)
-                temp_file = os.path.join(temp_dir, f"{user_id}_audio_{message_id}.m4a")
-                try:
-                    with open(temp_file, 'wb') as f:
-                        f.write(content)
-                except Exception as write_error:
-                    logging.error(f"語音檔案寫入失敗: {write_error}")
-                    raise write_error
+            try:
+                content = line_client.get_message_content(message_id)
+            except Exception as download_error:
+                logging.error(f"語音下載失敗: {download_error}")
+                raise download_error
+            
+            # 建立暫存檔案
+            temp_dir = "temp_files"
+            os.makedirs(temp_dir, exist_ok=True)
+            temp_file = os.path.join(temp_dir, f"{user_id}_audio_{message_id}.m4a")
+            try:
+                with open(temp_file, 'wb') as f:
+                    f.write(content)
+            except Exception as write_error:
+                logging.error(f"語音檔案寫入失敗: {write_error}")
+                raise write_error
             
             # 使用語音處理器轉文字
             speech_processor = get_speech_processor()
@@ -932,7 +1282,6 @@ def handle_audio_message(event):
                 else:
                     # 語音識別失敗
                     logging.warning(f"🎤 語音識別失敗，無法轉換為文字")
-                    print(f"🎤 語音識別失敗，無法轉換為文字")
                     response_message = TextMessage(text="抱歉，我無法識別您的語音內容。請改用文字輸入，例如：「我有雞蛋、白飯、蔥，想做蛋炒飯」", quickReply=None, quoteToken=None)
             else:
                 # 語音處理器不可用
@@ -942,15 +1291,7 @@ def handle_audio_message(event):
         logging.error(f"處理語音訊息時發生錯誤: {e}")
         response_message = TextMessage(text="抱歉，處理您的語音時發生錯誤，請改用文字輸入。", quickReply=None, quoteToken=None)
     
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-                replyToken=event.reply_token,
-                messages=[response_message],
-                notificationDisabled=None
-            )
-        )
+    send_response(event, response_message)
 
 @handler.add(MessageEvent, message=ImageMessageContent)
 def handle_image_message(event):
@@ -965,24 +1306,22 @@ def handle_image_message(event):
             response_message = TextMessage(text="抱歉，圖片處理功能目前無法使用，請改用文字輸入。", quickReply=None, quoteToken=None)
         else:
             # 獲取圖片內容
-            with ApiClient(configuration) as api_client:
-                blob_api = MessagingApiBlob(api_client)
-                try:
-                    content = blob_api.get_message_content(message_id)
-                except Exception as download_error:
-                    logging.error(f"圖片下載失敗: {download_error}")
-                    raise download_error
-                
-                # 建立暫存檔案
-                temp_dir = "temp_files"
-                os.makedirs(temp_dir, exist_ok=True)
-                temp_file = os.path.join(temp_dir, f"{user_id}_image_{message_id}.jpg")
-                try:
-                    with open(temp_file, 'wb') as f:
-                        f.write(content)
-                except Exception as write_error:
-                    logging.error(f"圖片檔案寫入失敗: {write_error}")
-                    raise write_error
+            try:
+                content = line_client.get_message_content(message_id)
+            except Exception as download_error:
+                logging.error(f"圖片下載失敗: {download_error}")
+                raise download_error
+            
+            # 建立暫存檔案
+            temp_dir = "temp_files"
+            os.makedirs(temp_dir, exist_ok=True)
+            temp_file = os.path.join(temp_dir, f"{user_id}_image_{message_id}.jpg")
+            try:
+                with open(temp_file, 'wb') as f:
+                    f.write(content)
+            except Exception as write_error:
+                logging.error(f"圖片檔案寫入失敗: {write_error}")
+                raise write_error
             
             # 使用圖片處理器分析
             image_processor = get_image_processor()
@@ -1010,15 +1349,7 @@ def handle_image_message(event):
         logging.error(f"處理圖片訊息時發生錯誤: {e}")
         response_message = TextMessage(text="抱歉，處理您的圖片時發生錯誤，請改用文字輸入。", quickReply=None, quoteToken=None)
     
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-                replyToken=event.reply_token,
-                messages=[response_message],
-                notificationDisabled=None
-            )
-        )
+    send_response(event, response_message)
 
 # --- 健康檢查端點 ---
 @app.route("/health", methods=['GET'])
@@ -1031,6 +1362,16 @@ def health_check():
             "speech_available": SPEECH_AVAILABLE,
             "image_available": IMAGE_AVAILABLE
         },
+        "llm": llm_client.stats() if LLM_AVAILABLE else None,
+        "structured_output": structured_stats(),
+        "webhook_dedup": handler.deduplicator.stats() if handler.deduplicator else None,
+        "recommendation_cache": get_recommendation_cache().stats() if get_recommendation_cache() else None,
+        "recipe_detail_cache": get_recipe_detail_cache().stats() if get_recipe_detail_cache() else None,
+        "recipe_prefetch": get_recipe_prefetcher().stats() if get_recipe_prefetcher() else None,
+        "ingredient_lexicon": get_ingredient_lexicon().stats(),
+        "conversation_state": conversation_state.stats(),
+        "message_coalescer": get_message_coalescer().stats() if get_message_coalescer() else None,
+        "state_snapshot": get_state_snapshotter().stats() if get_state_snapshotter() else None,
         "ui_features": [
             "輪播樣板推薦",
             "Quick Reply 按鈕",
@@ -1040,6 +1381,13 @@ def health_check():
         ]
     }
 
+@app.route("/metrics/llm", methods=['GET'])
+def llm_metrics_endpoint():
+    """各呼叫類型（對話階段）的 LLM 延遲、token 用量、重試、快取命中與估算費用"""
+    if not LLM_AVAILABLE:
+        return {"llm_available": False}, 503
+    return llm_client.metrics.snapshot()
+
 # --- 主程式 ---
 if __name__ == "__main__":
     # 从环境变量 PORT 或 WEBSITES_PORT 读取端口，预设回退到 5000
@@ -1058,6 +1406,7 @@ if __name__ == "__main__":
     print("- 🎤 語音轉文字功能")
     print("- 📷 圖片食材識別功能")
     print(f"健康檢查端點: http://localhost:{port}/health")
+    print(f"LLM 呼叫統計: http://localhost:{port}/metrics/llm")
     print("=" * 50)
      # 监听所有网络接口与环境变量指定端口
     app.run(debug=True, host='0.0.0.0', port=port)
\ No newline at end of file
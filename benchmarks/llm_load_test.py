@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLM 離線壓力測試
+以本地假後端模擬上游延遲、錯誤與 429，並行執行「推薦 → 詳細食譜」流程，
+量測端對端延遲分佈與閘道統計，不需要 API 金鑰也不消耗配額。
+
+使用方式：
+    python benchmarks/llm_load_test.py --users 50 --requests 200
+    LLM_FAKE_LATENCY=lognormal:3,0.8 LLM_FAKE_RATE_LIMIT_RATE=0.05 python benchmarks/llm_load_test.py
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("LLM_BACKEND", "fake")
+# 關閉快取，確保每個請求都實際呼叫 LLM
+os.environ.setdefault("RECOMMENDATION_CACHE", "false")
+os.environ.setdefault("RECIPE_DETAIL_CACHE", "false")
+os.environ.setdefault("RECIPE_PREFETCH", "false")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "load-test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "load-test")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app_llm_ui_integrated as app  # noqa: E402
+
+INGREDIENT_SETS = [
+    ["雞蛋", "白飯", "蔥"],
+    ["豬肉", "青菜", "豆腐"],
+    ["雞胸肉", "胡蘿蔔", "洋蔥"],
+    ["番茄", "雞蛋"],
+    ["牛肉", "青椒", "洋蔥"],
+]
+
+
+def run_flow(index):
+    """執行一次「推薦 → 點選第一道料理」流程，返回 (秒數, 是否成功)"""
+    start = time.perf_counter()
+    recommendations = app.generate_llm_recommendations(
+        f"load-{index}", INGREDIENT_SETS[index % len(INGREDIENT_SETS)]
+    )
+    if not recommendations:
+        return time.perf_counter() - start, False
+    first = recommendations[0]
+    details = first.get("details") or app.generate_llm_recipe_details(first.get("name"), first)
+    return time.perf_counter() - start, bool(details)
+
+
+def percentile(values, ratio):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以假後端對 LLM 流程做離線壓力測試")
+    parser.add_argument("--users", type=int, default=20, help="同時進行的用戶數")
+    parser.add_argument("--requests", type=int, default=100, help="總流程數")
+    args = parser.parse_args()
+
+    if not app.LLM_AVAILABLE:
+        print("LLM 不可用")
+        return 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as executor:
+        results = list(executor.map(run_flow, range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [seconds for seconds, ok in results if ok]
+    failures = sum(1 for _, ok in results if not ok)
+    print(f"後端: {app.LLM_BACKEND}  延遲分佈: {app.LLM_FAKE_LATENCY}  "
+          f"錯誤率: {app.LLM_FAKE_ERROR_RATE}  429 比例: {app.LLM_FAKE_RATE_LIMIT_RATE}")
+    print(f"流程數: {args.requests}  並行: {args.users}  失敗: {failures}  "
+          f"吞吐量: {args.requests / elapsed:.1f} 流程/秒")
+    if latencies:
+        print(f"延遲 p50: {statistics.median(latencies):.2f}s  p95: {percentile(latencies, 0.95):.2f}s  "
+              f"p99: {percentile(latencies, 0.99):.2f}s  最大: {max(latencies):.2f}s")
+    gateway = app.llm_client.gateway.stats()
+    print(f"閘道: 完成 {gateway['completed']}  重試 {gateway['retried']}  429 {gateway['rate_limited']}  "
+          f"斷路器拒絕 {gateway['circuit_rejected']}  失敗 {gateway['failed']}")
+    for name, tier in app.llm_client.router.stats()["tiers"].items():
+        print(f"模型層級 {name} ({tier['model']}): 呼叫 {tier['calls']}  錯誤 {tier['errors']}  "
+              f"429 {tier['rate_limited']}  p50 {tier['p50']:.2f}s  p95 {tier['p95']:.2f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
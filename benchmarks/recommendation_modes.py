@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+推薦流程效能比較
+比較 standard（推薦後點選再生成詳細食譜，兩次 LLM 呼叫）與
+combined（推薦與詳細食譜一次生成）兩種模式的端對端延遲與 token 用量。
+
+使用方式：
+    GOOGLE_API_KEY=... python benchmarks/recommendation_modes.py --rounds 5
+    LLM_BACKEND=fake python benchmarks/recommendation_modes.py --rounds 5   # 離線驗證流程
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+# 關閉快取，確保每一輪都實際呼叫 LLM
+os.environ.setdefault("RECOMMENDATION_CACHE", "false")
+os.environ.setdefault("RECIPE_DETAIL_CACHE", "false")
+os.environ.setdefault("RECIPE_PREFETCH", "false")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "benchmark")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "benchmark")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app_llm_ui_integrated as app  # noqa: E402
+from llm import LLMBackend  # noqa: E402
+
+INGREDIENT_SETS = [
+    ["雞蛋", "白飯", "蔥"],
+    ["豬肉", "青菜", "豆腐"],
+    ["雞胸肉", "胡蘿蔔", "洋蔥"],
+    ["番茄", "雞蛋"],
+    ["牛肉", "青椒", "洋蔥"],
+]
+
+
+class RecordingBackend(LLMBackend):
+    """記錄每次呼叫的後端、提示詞與回應，結束後再計算 token（不影響延遲量測）"""
+
+    def __init__(self, backend, calls=None, plain=None):
+        self.backend = backend
+        self.plain = plain or backend  # 不含系統指示的後端，用於計算輸出 token
+        self.calls = [] if calls is None else calls
+
+    def generate_content(self, contents, generation_config=None, stream=False):
+        response = self.backend.generate_content(contents, generation_config=generation_config)
+        self.calls.append((self, contents, response.text if response else ""))
+        return response
+
+    def with_system_instruction(self, system_instruction):
+        backend = self.backend.with_system_instruction(system_instruction)
+        # 共用同一份呼叫紀錄
+        return RecordingBackend(backend, self.calls, self.plain) if backend is not None else None
+
+    def count_tokens(self, contents):
+        return self.backend.count_tokens(contents)
+
+
+def run_flow(mode, ingredients):
+    """執行一次「推薦 → 點選第一道料理」流程，返回 (到輪播秒數, 端對端秒數)"""
+    app.RECOMMENDATION_MODE = mode
+    start = time.perf_counter()
+    recommendations = app.generate_llm_recommendations("benchmark", ingredients)
+    carousel_at = time.perf_counter()
+    if not recommendations:
+        raise RuntimeError(f"{mode} 模式沒有產生推薦")
+
+    first = recommendations[0]
+    details = first.get("details") or app.generate_llm_recipe_details(first.get("name"), first)
+    if not details:
+        raise RuntimeError(f"{mode} 模式沒有產生詳細食譜")
+    return carousel_at - start, time.perf_counter() - start
+
+
+def count_tokens(calls):
+    """
+    計算輸入 / 輸出 token 總數
+
+    輸入 token 以實際處理該次呼叫的後端計算，含該呼叫類型的系統指示
+    （SDK 不支援系統指示時已放進提示詞）
+    """
+    input_tokens = output_tokens = 0
+    for recorder, contents, text in calls:
+        input_tokens += recorder.backend.count_tokens(contents).total_tokens
+        if text:
+            output_tokens += recorder.plain.count_tokens(text).total_tokens
+    return input_tokens, output_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比較 standard 與 combined 推薦模式")
+    parser.add_argument("--rounds", type=int, default=5, help="每種模式執行的輪數")
+    args = parser.parse_args()
+
+    if not app.LLM_AVAILABLE:
+        print("LLM 不可用，請設定 GOOGLE_API_KEY 或使用 LLM_BACKEND=fake")
+        return 1
+
+    # 每個模型層級都記錄到同一份呼叫紀錄
+    tiers = list(app.llm_client.router.tiers.values())
+    recorder = RecordingBackend(tiers[0].backend)
+    for tier in tiers:
+        tier.backend = recorder if tier is tiers[0] else RecordingBackend(tier.backend, recorder.calls)
+
+    results = {}
+    for mode in ("standard", "combined"):
+        carousel, total, calls = [], [], []
+        tokens_in = tokens_out = 0
+        for i in range(args.rounds):
+            recorder.calls.clear()
+            to_carousel, end_to_end = run_flow(mode, INGREDIENT_SETS[i % len(INGREDIENT_SETS)])
+            carousel.append(to_carousel)
+            total.append(end_to_end)
+            calls.append(len(recorder.calls))
+            used_in, used_out = count_tokens(recorder.calls)
+            tokens_in += used_in
+            tokens_out += used_out
+        results[mode] = {
+            "carousel": statistics.median(carousel),
+            "total": statistics.median(total),
+            "calls": statistics.mean(calls),
+            "tokens_in": tokens_in / args.rounds,
+            "tokens_out": tokens_out / args.rounds,
+        }
+
+    print(f"{'模式':<10}{'到輪播(s)':>12}{'端對端(s)':>12}{'LLM 呼叫':>10}{'輸入 token':>12}{'輸出 token':>12}")
+    for mode, r in results.items():
+        print(f"{mode:<10}{r['carousel']:>12.2f}{r['total']:>12.2f}{r['calls']:>10.1f}"
+              f"{r['tokens_in']:>12.0f}{r['tokens_out']:>12.0f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
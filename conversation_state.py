@@ -0,0 +1,522 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+對話狀態模組
+保存每位用戶的多輪對話狀態（階段、食材、推薦、選擇的食譜），
+以固定欄位的紀錄取代開放式 dict，並限制用戶數、記憶體用量與閒置時間，長時間運行時記憶體用量維持穩定。
+memory 後端只在單一程序內有效；sqlite 後端（WAL 模式）讓同一台主機上的多個 gunicorn worker 共用狀態
+"""
+
+import json
+import logging
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from database.models import get_db_connection
+
+# 對話階段
+STAGE_IDLE = "idle"
+STAGE_WAITING_FOR_INGREDIENTS = "waiting_for_ingredients"
+STAGE_WAITING_FOR_CHOICE = "waiting_for_choice"
+STAGE_SUBSTITUTION = "substitution_mode"
+
+# 對話狀態欄位
+STATE_FIELDS = ("stage", "ingredients", "recommendations", "selected_recipe", "recipe_details", "substitutions")
+
+# 序列化後超過此大小（位元組）時以 zlib 壓縮
+COMPRESS_THRESHOLD = 512
+
+
+class UserState:
+    """一位用戶的對話狀態，可用 state['stage'] / state.get('recommendations') 讀取"""
+
+    __slots__ = STATE_FIELDS + ("touched_at", "size")
+
+    def __init__(self, stage: str = STAGE_IDLE, ingredients=None, recommendations=None,
+                 selected_recipe=None, recipe_details=None, substitutions=None):
+        self.stage = stage
+        self.ingredients = ingredients or []
+        self.recommendations = recommendations or []
+        self.selected_recipe = selected_recipe
+        self.recipe_details = recipe_details
+        self.substitutions = substitutions or {}  # 替代方案記錄
+        self.touched_at = time.time()
+        self.size = 0
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in STATE_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in STATE_FIELDS
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key) if key in STATE_FIELDS else default
+
+    def update(self, updates: Dict[str, Any]):
+        """更新欄位，不接受未定義的欄位"""
+        for key in updates:
+            if key not in STATE_FIELDS:
+                raise KeyError(f"未知的對話狀態欄位: {key}")
+        for key, value in updates.items():
+            setattr(self, key, value)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """轉成 dict（省略空白欄位）"""
+        return {key: getattr(self, key) for key in STATE_FIELDS if getattr(self, key)}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "UserState":
+        return cls(**{key: value for key, value in data.items() if key in STATE_FIELDS})
+
+    def copy(self) -> "UserState":
+        return UserState.from_dict(self.to_dict())
+
+    def measure(self) -> int:
+        """以 JSON 大小估算記憶體用量（位元組）"""
+        self.size = len(json.dumps(self.to_dict(), ensure_ascii=False).encode("utf-8"))
+        return self.size
+
+
+def encode_state(state: UserState) -> bytes:
+    """序列化對話狀態：精簡 JSON，較大的狀態再以 zlib 壓縮（第一個位元組標示格式）"""
+    raw = json.dumps(state.to_dict(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(raw) > COMPRESS_THRESHOLD:
+        return b"z" + zlib.compress(raw)
+    return b"j" + raw
+
+
+def decode_state(data: bytes) -> UserState:
+    """還原 encode_state() 的結果"""
+    raw = zlib.decompress(data[1:]) if data[:1] == b"z" else data[1:]
+    return UserState.from_dict(json.loads(raw.decode("utf-8")))
+
+
+class ConversationState:
+    """對話狀態管理器基底類別"""
+
+    backend = ""
+
+    def __init__(self, max_users: int = 10000, idle_timeout: float = 86400):
+        """
+        初始化對話狀態管理器
+
+        Args:
+            max_users: 最多保留的用戶數，超過時淘汰最久沒有互動的用戶
+            idle_timeout: 用戶閒置超過此秒數後狀態失效，下次互動從頭開始
+        """
+        self.max_users = max_users
+        self.idle_timeout = idle_timeout
+        self.logger = logging.getLogger(__name__)
+
+    def get_user_state(self, user_id: str) -> UserState:
+        """
+        取得用戶的對話狀態
+
+        Args:
+            user_id: LINE 用戶 ID
+
+        Returns:
+            對話狀態；沒有紀錄或已閒置逾時時返回新的閒置狀態（更新後才會保存）
+        """
+        raise NotImplementedError
+
+    def update_user_state(self, user_id: str, updates: Dict[str, Any]):
+        """
+        更新用戶的對話狀態
+
+        Args:
+            user_id: LINE 用戶 ID
+            updates: 要更新的欄位
+        """
+        raise NotImplementedError
+
+    def reset_user_state(self, user_id: str):
+        """重置用戶的對話狀態（閒置狀態不佔用空間）"""
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+
+class MemoryConversationState(ConversationState):
+    """單一程序使用的記憶體對話狀態（LRU + 閒置逾時，執行緒安全）"""
+
+    backend = "memory"
+
+    def __init__(self, max_users: int = 10000, max_bytes: int = 50 * 1024 * 1024,
+                 idle_timeout: float = 86400):
+        """
+        初始化對話狀態管理器
+
+        Args:
+            max_users: 最多保留的用戶數，超過時淘汰最久沒有互動的用戶
+            max_bytes: 所有對話狀態的大小上限（位元組）
+            idle_timeout: 用戶閒置超過此秒數後狀態失效，下次互動從頭開始
+        """
+        super().__init__(max_users, idle_timeout)
+        self.max_bytes = max_bytes
+        self._states: "OrderedDict[str, UserState]" = OrderedDict()  # 依最近互動時間排序
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "updates": 0, "resets": 0, "expired": 0, "evictions": 0}
+        self._dirty = set()  # 上次快照後有變動的用戶
+        self.restore_wait: Optional[Callable[[], Any]] = None  # 快照還原完成前，讀寫狀態先等待還原
+
+    def get_user_state(self, user_id: str) -> UserState:
+        self._await_restore()
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            state = self._states.get(user_id)
+            if state is None:
+                self._stats["misses"] += 1
+                return UserState()
+            state.touched_at = now
+            self._states.move_to_end(user_id)
+            self._stats["hits"] += 1
+            return state
+
+    def update_user_state(self, user_id: str, updates: Dict[str, Any]):
+        """更新用戶的對話狀態，超過用戶數或大小上限時淘汰最久沒有互動的用戶"""
+        self._await_restore()
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            state = self._states.pop(user_id, None)
+            if state is None:
+                state = UserState()
+            else:
+                self._bytes -= state.size
+            state.update(updates)
+            state.touched_at = now
+            self._states[user_id] = state
+            self._bytes += state.measure()
+            self._dirty.add(user_id)
+            self._stats["updates"] += 1
+            self._evict()
+
+    def reset_user_state(self, user_id: str):
+        self._await_restore()
+        with self._lock:
+            state = self._states.pop(user_id, None)
+            if state is not None:
+                self._bytes -= state.size
+                self._dirty.add(user_id)
+            self._stats["resets"] += 1
+
+    def export(self) -> Dict[str, Tuple[float, Dict[str, Any]]]:
+        """
+        匯出所有用戶的狀態（供完整快照使用），並清除變動紀錄
+
+        Returns:
+            用戶 ID → (最後互動時間, 狀態欄位)
+        """
+        with self._lock:
+            self._dirty.clear()
+            return {user_id: (state.touched_at, state.to_dict()) for user_id, state in self._states.items()}
+
+    def changes(self) -> Tuple[Dict[str, Tuple[float, Dict[str, Any]]], List[str]]:
+        """
+        取出上次呼叫後有變動的用戶（供增量快照使用）
+
+        Returns:
+            (更新的用戶 ID → (最後互動時間, 狀態欄位), 移除的用戶 ID)
+        """
+        with self._lock:
+            updated, removed = {}, []
+            for user_id in self._dirty:
+                state = self._states.get(user_id)
+                if state is None:
+                    removed.append(user_id)
+                else:
+                    updated[user_id] = (state.touched_at, state.to_dict())
+            self._dirty.clear()
+            return updated, removed
+
+    def restore(self, records: Dict[str, Tuple[float, Dict[str, Any]]]) -> int:
+        """
+        還原快照中的狀態，已有新狀態的用戶與閒置逾時的紀錄不還原
+
+        Args:
+            records: 用戶 ID → (最後互動時間, 狀態欄位)
+
+        Returns:
+            還原的用戶數
+        """
+        now = time.time()
+        restored = 0
+        with self._lock:
+            # 由新到舊插入佇列開頭，還原的用戶排在啟動後已互動的用戶之前
+            for user_id, (touched_at, data) in sorted(records.items(), key=lambda item: item[1][0], reverse=True):
+                if user_id in self._states or now - touched_at > self.idle_timeout:
+                    continue
+                state = UserState.from_dict(data)
+                state.touched_at = touched_at
+                self._states[user_id] = state
+                self._states.move_to_end(user_id, last=False)
+                self._bytes += state.measure()
+                restored += 1
+            self._evict()
+        return restored
+
+    def _await_restore(self):
+        wait = self.restore_wait
+        if wait is not None:
+            wait()
+
+    def stats(self) -> Dict[str, Any]:
+        """取得用戶數、估算記憶體用量與淘汰統計"""
+        with self._lock:
+            self._expire(time.time())
+            stats = dict(self._stats)
+            stats.update({
+                "backend": self.backend,
+                "users": len(self._states),
+                "bytes": self._bytes,
+                "max_users": self.max_users,
+                "max_bytes": self.max_bytes,
+            })
+        return stats
+
+    def _expire(self, now: float):
+        """從最久沒有互動的用戶開始移除閒置逾時的狀態"""
+        while self._states:
+            state = next(iter(self._states.values()))
+            if now - state.touched_at <= self.idle_timeout:
+                break
+            user_id, _ = self._states.popitem(last=False)
+            self._bytes -= state.size
+            self._dirty.add(user_id)
+            self._stats["expired"] += 1
+
+    def _evict(self):
+        """超過用戶數或大小上限時淘汰最久沒有互動的用戶（至少保留剛更新的用戶）"""
+        while len(self._states) > 1 and (len(self._states) > self.max_users or self._bytes > self.max_bytes):
+            user_id, state = self._states.popitem(last=False)
+            self._bytes -= state.size
+            self._dirty.add(user_id)
+            self._stats["evictions"] += 1
+            self.logger.debug(f"淘汰用戶 {user_id} 的對話狀態（{state.size} 位元組）")
+
+
+class SQLiteConversationState(ConversationState):
+    """
+    多個 gunicorn worker 共用的 SQLite（WAL 模式）對話狀態
+
+    每筆狀態帶有版本號，更新時以「版本未變才寫入」的樂觀版本控制避免覆寫其他 worker 的更新，
+    衝突時重新讀取再套用；程序內的讀取快取只在版本相同時使用，不會讀到過期的狀態
+    """
+
+    backend = "sqlite"
+    CLEANUP_INTERVAL = 200  # 每 N 次寫入清理一次閒置逾時與超過上限的用戶
+    MAX_RETRIES = 5  # 版本衝突時最多重試次數
+
+    def __init__(self, max_users: int = 10000, idle_timeout: float = 86400, cache_size: int = 1000):
+        """
+        初始化 SQLite 對話狀態
+
+        Args:
+            max_users: 最多保留的用戶數
+            idle_timeout: 用戶閒置（沒有更新）超過此秒數後狀態失效
+            cache_size: 程序內讀取快取的用戶數，0 代表每次都從資料庫讀取完整狀態
+        """
+        super().__init__(max_users, idle_timeout)
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, Tuple[int, UserState]]" = OrderedDict()  # user_id -> (版本, 狀態)
+        self._lock = threading.Lock()
+        self._stats = {"reads": 0, "cache_hits": 0, "updates": 0, "conflicts": 0, "failed_updates": 0,
+                       "resets": 0, "bytes_written": 0}
+        self._writes = 0
+        self._init_table()
+
+    def _init_table(self):
+        conn = get_db_connection()
+        conn.execute('PRAGMA journal_mode=WAL')  # 讀取不阻塞寫入，多個 worker 可同時讀取
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_states (
+                user_id TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_conversation_states_updated ON conversation_states (updated_at)')
+        conn.commit()
+        conn.close()
+
+    def get_user_state(self, user_id: str) -> UserState:
+        conn = get_db_connection()
+        try:
+            return self._load(conn, user_id)[1] or UserState()
+        finally:
+            conn.close()
+
+    def update_user_state(self, user_id: str, updates: Dict[str, Any]):
+        """讀取目前版本、套用更新後以版本比對寫回，其他 worker 先寫入時重新讀取再套用"""
+        now = time.time()
+        conn = get_db_connection()
+        try:
+            for _ in range(self.MAX_RETRIES):
+                version, state = self._load(conn, user_id)
+                state = state.copy() if state else UserState()
+                state.update(updates)
+                data = encode_state(state)
+                if version:
+                    cursor = conn.execute(
+                        'UPDATE conversation_states SET version = ?, data = ?, updated_at = ? '
+                        'WHERE user_id = ? AND version = ?',
+                        (version + 1, data, now, user_id, version)
+                    )
+                else:
+                    cursor = conn.execute(
+                        'INSERT OR IGNORE INTO conversation_states (user_id, version, data, updated_at) '
+                        'VALUES (?, 1, ?, ?)',
+                        (user_id, data, now)
+                    )
+                conn.commit()
+                if cursor.rowcount == 1:
+                    self._remember(user_id, version + 1, state)
+                    with self._lock:
+                        self._stats["updates"] += 1
+                        self._stats["bytes_written"] += len(data)
+                    return
+                with self._lock:
+                    self._stats["conflicts"] += 1
+
+            with self._lock:
+                self._stats["failed_updates"] += 1
+            self.logger.error(f"用戶 {user_id} 的對話狀態更新衝突 {self.MAX_RETRIES} 次，放棄這次更新")
+        finally:
+            conn.close()
+            self._maybe_cleanup(now)
+
+    def reset_user_state(self, user_id: str):
+        conn = get_db_connection()
+        conn.execute('DELETE FROM conversation_states WHERE user_id = ?', (user_id,))
+        conn.commit()
+        conn.close()
+        with self._lock:
+            self._cache.pop(user_id, None)
+            self._stats["resets"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """取得用戶數、讀取快取命中與版本衝突統計"""
+        conn = get_db_connection()
+        row = conn.execute(
+            'SELECT COUNT(*) AS users, COALESCE(SUM(LENGTH(data)), 0) AS bytes '
+            'FROM conversation_states WHERE updated_at >= ?',
+            (time.time() - self.idle_timeout,)
+        ).fetchone()
+        conn.close()
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cached_users"] = len(self._cache)
+        stats.update({
+            "backend": self.backend,
+            "users": row["users"],
+            "bytes": row["bytes"],
+            "max_users": self.max_users,
+        })
+        return stats
+
+    def _load(self, conn, user_id: str) -> Tuple[int, Optional[UserState]]:
+        """
+        讀取用戶的狀態與版本，快取的版本仍是最新時不必傳回與解碼完整狀態
+
+        Returns:
+            (版本, 狀態)；沒有紀錄時版本為 0，閒置逾時的狀態返回 None（版本保留供寫入時比對）
+        """
+        with self._lock:
+            cached = self._cache.get(user_id)
+            self._stats["reads"] += 1
+        row = conn.execute(
+            'SELECT version, updated_at, CASE WHEN version = ? THEN NULL ELSE data END AS data '
+            'FROM conversation_states WHERE user_id = ?',
+            (cached[0] if cached else 0, user_id)
+        ).fetchone()
+        if row is None:
+            if cached:
+                with self._lock:
+                    self._cache.pop(user_id, None)
+            return 0, None
+        if time.time() - row["updated_at"] > self.idle_timeout:
+            return row["version"], None
+        if row["data"] is None:
+            with self._lock:
+                self._stats["cache_hits"] += 1
+            return cached
+        state = decode_state(row["data"])
+        self._remember(user_id, row["version"], state)
+        return row["version"], state
+
+    def _remember(self, user_id: str, version: int, state: UserState):
+        if not self.cache_size:
+            return
+        with self._lock:
+            self._cache[user_id] = (version, state)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _maybe_cleanup(self, now: float):
+        """定期刪除閒置逾時的狀態並限制用戶數"""
+        with self._lock:
+            self._writes += 1
+            if self._writes % self.CLEANUP_INTERVAL:
+                return
+        try:
+            conn = get_db_connection()
+            conn.execute('DELETE FROM conversation_states WHERE updated_at < ?', (now - self.idle_timeout,))
+            conn.execute('''
+                DELETE FROM conversation_states WHERE user_id IN (
+                    SELECT user_id FROM conversation_states ORDER BY updated_at DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_users,))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            self.logger.warning(f"清理對話狀態失敗: {e}")
+
+
+def create_conversation_state(backend: str = "memory", max_users: int = 10000,
+                              max_bytes: int = 50 * 1024 * 1024, idle_timeout: float = 86400,
+                              cache_size: int = 1000) -> ConversationState:
+    """
+    依設定建立對話狀態管理器
+
+    Args:
+        backend: memory（單一程序）或 sqlite（同一台主機上的多個 worker 共用）
+        max_users: 最多保留的用戶數
+        max_bytes: memory 後端的大小上限（位元組）
+        idle_timeout: 用戶閒置超過此秒數後狀態失效
+        cache_size: sqlite 後端的程序內讀取快取用戶數
+
+    Returns:
+        對話狀態管理器
+    """
+    if backend == "sqlite":
+        return SQLiteConversationState(max_users, idle_timeout, cache_size)
+    return MemoryConversationState(max_users, max_bytes, idle_timeout)
+
+
+# 全域對話狀態管理器
+conversation_state = None
+
+def init_conversation_state(backend: str = "memory", max_users: int = 10000,
+                            max_bytes: int = 50 * 1024 * 1024, idle_timeout: float = 86400,
+                            cache_size: int = 1000) -> ConversationState:
+    """初始化全域對話狀態管理器"""
+    global conversation_state
+    conversation_state = create_conversation_state(backend, max_users, max_bytes, idle_timeout, cache_size)
+    logging.info(f"對話狀態管理器初始化成功：{conversation_state.backend} 後端，最多 {max_users} 位用戶，"
+                 f"閒置 {idle_timeout:g} 秒後失效")
+    return conversation_state
+
+def get_conversation_state() -> Optional[ConversationState]:
+    """獲取全域對話狀態管理器"""
+    return conversation_state
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Webhook 事件去重模組
+以 LINE webhookEventId 記錄處理中 / 已完成的事件，避免重送事件重跑整個流程
+"""
+
+import abc
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from database.models import get_db_connection
+
+# 事件狀態
+NEW = "new"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+
+
+class EventDeduplicator(abc.ABC):
+    """事件去重基底類別，負責命中統計"""
+
+    def __init__(self, ttl: float = 600, max_entries: int = 10000,
+                 in_flight_timeout: float = 180):
+        """
+        初始化事件去重器
+
+        Args:
+            ttl: 已完成事件保留秒數
+            max_entries: 最多保留的事件數
+            in_flight_timeout: 處理中事件視為失效的秒數（例如處理程序已中斷）
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.in_flight_timeout = in_flight_timeout
+        self.logger = logging.getLogger(__name__)
+
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "in_flight_hits": 0, "done_hits": 0, "redeliveries": 0}
+
+    def claim(self, event_id: str, is_redelivery: bool = False) -> str:
+        """
+        嘗試取得事件的處理權
+
+        Args:
+            event_id: webhookEventId
+            is_redelivery: LINE 是否標記為重送事件
+
+        Returns:
+            NEW 代表由呼叫端處理；IN_FLIGHT / DONE 代表重複事件
+        """
+        status = self._claim(event_id, time.time())
+        with self._stats_lock:
+            if is_redelivery:
+                self._stats["redeliveries"] += 1
+            if status == NEW:
+                self._stats["misses"] += 1
+            else:
+                self._stats["hits"] += 1
+                self._stats["in_flight_hits" if status == IN_FLIGHT else "done_hits"] += 1
+        if status != NEW:
+            self.logger.info(f"略過重複事件 {event_id} ({status})")
+        return status
+
+    def complete(self, event_id: str):
+        """標記事件已完成"""
+        self._complete(event_id, time.time())
+
+    def release(self, event_id: str):
+        """處理失敗時釋放事件，讓重送事件可以重新處理"""
+        self._release(event_id)
+
+    def stats(self) -> Dict[str, int]:
+        """取得命中統計"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["size"] = self.size()
+        return stats
+
+    @abc.abstractmethod
+    def size(self) -> int:
+        """目前保留的事件數"""
+
+    @abc.abstractmethod
+    def _claim(self, event_id: str, now: float) -> str:
+        """記錄事件為處理中並返回 NEW，已有未過期的紀錄時返回該紀錄的狀態"""
+
+    @abc.abstractmethod
+    def _complete(self, event_id: str, now: float):
+        """記錄事件已完成"""
+
+    @abc.abstractmethod
+    def _release(self, event_id: str):
+        """移除事件紀錄"""
+
+
+class MemoryDeduplicator(EventDeduplicator):
+    """單一程序使用的記憶體去重器（LRU + TTL）"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._entries = OrderedDict()  # event_id -> (status, updated_at)
+        self._lock = threading.Lock()
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def _is_expired(self, status: str, updated_at: float, now: float) -> bool:
+        limit = self.in_flight_timeout if status == IN_FLIGHT else self.ttl
+        return now - updated_at > limit
+
+    def _claim(self, event_id: str, now: float) -> str:
+        with self._lock:
+            entry = self._entries.get(event_id)
+            if entry is not None and not self._is_expired(entry[0], entry[1], now):
+                return entry[0]
+
+            self._entries[event_id] = (IN_FLIGHT, now)
+            self._entries.move_to_end(event_id)
+            self._evict(now)
+            return NEW
+
+    def _complete(self, event_id: str, now: float):
+        with self._lock:
+            self._entries[event_id] = (DONE, now)
+            self._entries.move_to_end(event_id)
+
+    def _release(self, event_id: str):
+        with self._lock:
+            self._entries.pop(event_id, None)
+
+    def _evict(self, now: float):
+        """移除過期事件，超過上限時從最舊的開始淘汰"""
+        while self._entries:
+            oldest_id, (status, updated_at) = next(iter(self._entries.items()))
+            if len(self._entries) > self.max_entries or self._is_expired(status, updated_at, now):
+                self._entries.popitem(last=False)
+            else:
+                break
+
+
+class SQLiteDeduplicator(EventDeduplicator):
+    """多個 gunicorn worker 共用的 SQLite 去重器"""
+
+    CLEANUP_INTERVAL = 100  # 每 N 次 claim 清理一次過期資料
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._claims = 0
+        self._init_table()
+
+    def _init_table(self):
+        conn = get_db_connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS webhook_events (
+                event_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_webhook_events_updated ON webhook_events (updated_at)')
+        conn.commit()
+        conn.close()
+
+    def size(self) -> int:
+        conn = get_db_connection()
+        count = conn.execute('SELECT COUNT(*) FROM webhook_events').fetchone()[0]
+        conn.close()
+        return count
+
+    def _claim(self, event_id: str, now: float) -> str:
+        conn = get_db_connection()
+        try:
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO webhook_events (event_id, status, updated_at) VALUES (?, ?, ?)',
+                (event_id, IN_FLIGHT, now)
+            )
+            if cursor.rowcount == 1:
+                conn.commit()
+                return NEW
+
+            # 已存在：過期的紀錄可以由這次重新取得處理權
+            cursor = conn.execute('''
+                UPDATE webhook_events SET status = ?, updated_at = ?
+                WHERE event_id = ?
+                  AND ((status = ? AND updated_at < ?) OR (status = ? AND updated_at < ?))
+            ''', (IN_FLIGHT, now, event_id,
+                  IN_FLIGHT, now - self.in_flight_timeout, DONE, now - self.ttl))
+            conn.commit()
+            if cursor.rowcount == 1:
+                return NEW
+
+            row = conn.execute('SELECT status FROM webhook_events WHERE event_id = ?', (event_id,)).fetchone()
+            return row['status'] if row else NEW
+        finally:
+            conn.close()
+            self._maybe_cleanup(now)
+
+    def _complete(self, event_id: str, now: float):
+        conn = get_db_connection()
+        conn.execute('UPDATE webhook_events SET status = ?, updated_at = ? WHERE event_id = ?',
+                     (DONE, now, event_id))
+        conn.commit()
+        conn.close()
+
+    def _release(self, event_id: str):
+        conn = get_db_connection()
+        conn.execute('DELETE FROM webhook_events WHERE event_id = ?', (event_id,))
+        conn.commit()
+        conn.close()
+
+    def _maybe_cleanup(self, now: float):
+        """定期刪除過期事件並限制資料表大小"""
+        self._claims += 1
+        if self._claims % self.CLEANUP_INTERVAL:
+            return
+        try:
+            conn = get_db_connection()
+            conn.execute('DELETE FROM webhook_events WHERE updated_at < ?',
+                         (now - max(self.ttl, self.in_flight_timeout),))
+            conn.execute('''
+                DELETE FROM webhook_events WHERE event_id IN (
+                    SELECT event_id FROM webhook_events ORDER BY updated_at DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_entries,))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            self.logger.warning(f"清理事件去重資料失敗: {e}")
+
+
+def create_deduplicator(backend: str, ttl: float = 600, max_entries: int = 10000,
+                        in_flight_timeout: float = 180) -> Optional[EventDeduplicator]:
+    """
+    依設定建立事件去重器
+
+    Args:
+        backend: memory、sqlite 或 off
+        ttl: 已完成事件保留秒數
+        max_entries: 最多保留的事件數
+        in_flight_timeout: 處理中事件視為失效的秒數
+
+    Returns:
+        事件去重器，停用則返回 None
+    """
+    if backend == "sqlite":
+        return SQLiteDeduplicator(ttl=ttl, max_entries=max_entries, in_flight_timeout=in_flight_timeout)
+    if backend == "memory":
+        return MemoryDeduplicator(ttl=ttl, max_entries=max_entries, in_flight_timeout=in_flight_timeout)
+    return None
@@ -12,17 +12,20 @@ from typing import Optional
 from PIL import Image
 import io
 
+from llm import content_key
+from ingredient_matcher import get_ingredient_matcher, KIND_INGREDIENT
+
 class ImageProcessor:
     """圖片處理器"""
     
-    def __init__(self, llm_model):
+    def __init__(self, llm_client):
         """
         初始化圖片處理器
         
         Args:
-            llm_model: 現有的 LLM 模型實例
+            llm_client: 共用的 LLM 用戶端（llm.LLMClient）
         """
-        self.llm_model = llm_model
+        self.llm_client = llm_client
         self.logger = logging.getLogger(__name__)
     
     def analyze_fridge_image(self, image_file: str) -> Optional[str]:
@@ -60,8 +63,12 @@ class ImageProcessor:
             # 建立圖片物件
             image = Image.open(io.BytesIO(image_data))
             
-            # 發送給 LLM 分析
-            response = self.llm_model.generate_content([prompt, image])
+            # 發送給 LLM 分析（相同圖片的並行請求只分析一次）
+            response = self.llm_client.generate_content(
+                [prompt, image],
+                call_type="image_analysis",
+                key=content_key(prompt, image_data)
+            )
             
             if response and response.text:
                 self.logger.info(f"圖片分析成功，回應長度: {len(response.text)}")
@@ -85,26 +92,8 @@ class ImageProcessor:
             食材列表
         """
         try:
-            # 簡單的食材提取邏輯
-            ingredients = []
-            
-            # 常見食材關鍵字
-            common_ingredients = [
-                "雞蛋", "豬肉", "牛肉", "雞肉", "魚", "蝦", "豆腐", "青菜", "白菜", "高麗菜",
-                "胡蘿蔔", "洋蔥", "蒜", "薑", "蔥", "辣椒", "馬鈴薯", "地瓜", "玉米",
-                "番茄", "青椒", "茄子", "南瓜", "冬瓜", "絲瓜", "苦瓜", "小黃瓜",
-                "香菇", "金針菇", "杏鮑菇", "木耳", "海帶", "紫菜", "豆芽", "韭菜",
-                "芹菜", "菠菜", "空心菜", "莧菜", "芥菜", "油菜", "青江菜", "小白菜",
-                "蘿蔔", "白蘿蔔", "紅蘿蔔", "牛蒡", "蓮藕", "竹筍", "茭白筍", "蘆筍",
-                "花椰菜", "青花菜", "白花菜", "芥藍", "芥菜", "油菜", "青江菜", "小白菜"
-            ]
-            
-            # 在分析文字中尋找食材
-            for ingredient in common_ingredients:
-                if ingredient in analysis_text:
-                    ingredients.append(ingredient)
-            
-            return list(set(ingredients))  # 去重
+            # 以共用詞庫比對（與文字訊息相同），重疊時取最長的詞
+            return get_ingredient_matcher().terms(analysis_text, KIND_INGREDIENT)
             
         except Exception as e:
             self.logger.error(f"食材提取失敗: {e}")
@@ -121,11 +110,11 @@ class ImageProcessor:
 # 全域圖片處理器實例
 image_processor = None
 
-def init_image_processor(llm_model):
+def init_image_processor(llm_client):
     """初始化全域圖片處理器"""
     global image_processor
     try:
-        image_processor = ImageProcessor(llm_model)
+        image_processor = ImageProcessor(llm_client)
         logging.info("圖片處理器初始化成功")
     except Exception as e:
         logging.error(f"圖片處理器初始化失敗: {e}")
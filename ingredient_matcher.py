@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+食材關鍵字比對模組
+從詞庫檔（data/ingredient_lexicon.json）載入標準食材名稱、別名與分類，建立 Aho-Corasick 自動機，
+一次掃描訊息即找出所有食材、烹調關鍵字與數量詞，重疊時取最長的詞（例如「紅蘿蔔」不會再拆出「蘿蔔」），
+別名統一返回標準名稱（「蕃茄」「西紅柿」→「番茄」）。
+詞庫以外的寫法以字元索引與有限編輯距離做近似比對，只有本地信心不足時才需要交給 LLM 判斷；
+詞庫檔修改後會自動重新載入，不需重啟服務
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# 比對結果類型
+KIND_INGREDIENT = "ingredient"
+KIND_COOKING = "cooking"
+KIND_QUANTITY = "quantity"
+KIND_FILLER = "filler"  # 「我有」「還有」等常見用語，比對後不算未知內容
+
+DEFAULT_LEXICON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "ingredient_lexicon.json")
+
+# 未比對的文字片段（兩個字以上的連續文字，不含標點、空白、數字）
+_WORD_RUN = re.compile(r"[^\W\d_]{2,}")
+
+
+class Match(NamedTuple):
+    """一個比對結果"""
+    term: str
+    kind: str
+    start: int
+    end: int
+    name: str  # 標準名稱（別名比對到時與 term 不同）
+
+
+class KeywordMatcher:
+    """多關鍵字比對器（Aho-Corasick），建立後唯讀，可在多執行緒間共用"""
+
+    def __init__(self, entries: Iterable[Tuple[str, ...]]):
+        """
+        建立比對器
+
+        Args:
+            entries: (詞, 類型) 或 (詞, 類型, 標準名稱) 清單；同一個詞出現多次時保留第一次的類型
+        """
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[Optional[Tuple[str, str, str]]] = [None]  # 在此節點結束的詞
+        self._dict_link: List[int] = [0]  # 沿失敗連結最近一個有詞結束的節點
+        self.size = 0
+
+        for term, kind, *name in entries:
+            term = term.strip().lower()
+            if term:
+                self._add(term, kind, name[0] if name else term)
+        self._build_links()
+        logging.getLogger(__name__).debug(f"關鍵字比對器建立完成，共 {self.size} 個詞")
+
+    def _add(self, term: str, kind: str, name: str):
+        node = 0
+        for char in term:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+                self._dict_link.append(0)
+            node = next_node
+        if self._output[node] is None:
+            self._output[node] = (term, kind, name)
+            self.size += 1
+
+    def _build_links(self):
+        """以廣度優先計算失敗連結"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(char, 0)
+                if target == child:
+                    target = 0  # 第一層節點的失敗連結指向根節點
+                self._fail[child] = target
+                self._dict_link[child] = target if self._output[target] else self._dict_link[target]
+                queue.append(child)
+
+    def find_all(self, text: str) -> List[Match]:
+        """找出所有（可能重疊的）比對結果"""
+        matches = []
+        node = 0
+        for index, char in enumerate(text.lower()):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            hit = node if self._output[node] else self._dict_link[node]
+            while hit:
+                term, kind, name = self._output[hit]
+                matches.append(Match(term, kind, index + 1 - len(term), index + 1, name))
+                hit = self._dict_link[hit]
+        return matches
+
+    def find(self, text: str) -> List[Match]:
+        """
+        掃描一次訊息，返回不重疊的比對結果
+
+        重疊時取最左邊開始、其次最長的詞，例如「紅蘿蔔」只返回「紅蘿蔔」
+
+        Args:
+            text: 訊息
+
+        Returns:
+            依出現位置排序的比對結果
+        """
+        matches = sorted(self.find_all(text), key=lambda match: (match.start, -len(match.term)))
+        selected = []
+        end = 0
+        for match in matches:
+            if match.start >= end:
+                selected.append(match)
+                end = match.end
+        return selected
+
+    def terms(self, text: str, kind: Optional[str] = None) -> List[str]:
+        """返回訊息中出現的詞的標準名稱（依出現順序去重），可限定類型"""
+        seen = []
+        for match in self.find(text):
+            if (kind is None or match.kind == kind) and match.name not in seen:
+                seen.append(match.name)
+        return seen
+
+
+class Extraction(NamedTuple):
+    """從一則訊息擷取食材的結果"""
+    ingredients: List[str]  # 標準名稱，依比對順序去重
+    confidence: float  # 本地比對的信心（0–1），近似比對與未知片段都會拉低信心
+    unknown: List[str]  # 沒有比對到任何詞的片段
+    fuzzy: List[Tuple[str, str, float]]  # 近似比對結果：(原文片段, 標準名稱, 信心)
+    needs_llm: bool  # 還有未知片段或信心低於門檻，需要交給 LLM 判斷
+
+
+def _max_distance(length: int) -> int:
+    """近似比對允許的編輯距離：兩個字的詞差一個字就是別的詞，不做近似比對"""
+    if length < 3:
+        return 0
+    return 1 if length < 5 else 2
+
+
+def substring_distance(pattern: str, text: str, limit: int) -> Optional[Tuple[int, int, int]]:
+    """
+    找出 text 中與 pattern 編輯距離最小的子字串（Sellers 演算法），距離確定超過上限時提早結束
+
+    Args:
+        pattern: 要找的詞
+        text: 訊息片段
+        limit: 允許的最大編輯距離
+
+    Returns:
+        (編輯距離, 子字串起點, 子字串終點)；超過上限時返回 None
+    """
+    if not text:
+        return None
+    previous = [0] * (len(text) + 1)
+    previous_start = list(range(len(text) + 1))
+    for row, char in enumerate(pattern, 1):
+        current = [row] + [0] * len(text)
+        current_start = [0] * (len(text) + 1)
+        for col in range(1, len(text) + 1):
+            best, start = previous[col - 1] + (char != text[col - 1]), previous_start[col - 1]
+            if previous[col] + 1 < best:
+                best, start = previous[col] + 1, previous_start[col]
+            if current[col - 1] + 1 < best:
+                best, start = current[col - 1] + 1, current_start[col - 1]
+            current[col], current_start[col] = best, start
+        if min(current) > limit:
+            return None
+        previous, previous_start = current, current_start
+    distance = min(previous[1:])
+    if distance > limit:
+        return None
+    # 距離相同時取最右邊的終點，保留較長的子字串（「金針姑」而不是「金針」）
+    end = max(col for col in range(1, len(text) + 1) if previous[col] == distance)
+    return distance, previous_start[end], end
+
+
+class _LexiconIndex:
+    """一個版本的詞庫：比對器與近似比對用的字元索引，建立後唯讀，重新載入時整個替換"""
+
+    def __init__(self, data: Dict[str, Any]):
+        self.version = data.get("version")
+        self.categories: Dict[str, str] = {}  # 標準名稱 → 分類
+        aliases: Dict[str, str] = {}  # 詞（標準名稱或別名）→ 標準名稱
+        for category, items in data.get("ingredients", {}).items():
+            for name, names in items.items():
+                self.categories.setdefault(name, category)
+                for term in [name, *names]:
+                    aliases.setdefault(term.strip().lower(), name)
+
+        entries = [(term, KIND_INGREDIENT, name) for term, name in aliases.items()]
+        entries += [(term, KIND_COOKING) for term in data.get("cooking", [])]
+        entries += [(term, KIND_QUANTITY) for term in data.get("quantity", [])]
+        entries += [(term, KIND_FILLER) for term in data.get("filler", [])]
+        self.matcher = KeywordMatcher(entries)
+
+        # 近似比對的候選詞（三個字以上）與「字元 → 含此字的候選詞」索引
+        self._candidates = tuple((term, name) for term, name in aliases.items() if _max_distance(len(term)))
+        chars: Dict[str, List[int]] = {}
+        for candidate_id, (term, _) in enumerate(self._candidates):
+            for char in set(term):
+                chars.setdefault(char, []).append(candidate_id)
+        self._chars = {char: tuple(ids) for char, ids in chars.items()}
+
+    def fuzzy(self, segment: str) -> List[Tuple[int, int, str, float]]:
+        """
+        在未比對片段中找近似的食材詞（編輯距離在 _max_distance 以內），找到後扣除該段文字再繼續找
+
+        Args:
+            segment: 沒有比對到任何詞的片段
+
+        Returns:
+            (起點, 終點, 標準名稱, 信心) 清單
+        """
+        found = []
+        pending = [(0, segment)]
+        while pending:
+            offset, text = pending.pop()
+            if len(text) < 2:
+                continue
+            shared: Dict[int, int] = {}
+            for char in set(text):
+                for candidate_id in self._chars.get(char, ()):
+                    shared[candidate_id] = shared.get(candidate_id, 0) + 1
+
+            best = None
+            for candidate_id, count in shared.items():
+                term, name = self._candidates[candidate_id]
+                limit = _max_distance(len(term))
+                # 編輯 k 次最多少掉 k 個不同的字，共同字元不夠的候選詞不必計算編輯距離
+                if count < len(set(term)) - limit:
+                    continue
+                result = substring_distance(term, text, limit)
+                if result is None:
+                    continue
+                confidence = 1 - result[0] / len(term)
+                if best is None or (confidence, len(term)) > best[0]:
+                    best = ((confidence, len(term)), name, result)
+
+            if best:
+                (confidence, _), name, (_, start, end) = best
+                found.append((offset + start, offset + end, name, round(confidence, 3)))
+                pending += [(offset, text[:start]), (offset + end, text[end:])]
+        return found
+
+
+class IngredientLexicon:
+    """檔案式食材詞庫，修改詞庫檔後自動重新載入（執行緒安全）"""
+
+    def __init__(self, path: str = DEFAULT_LEXICON_PATH, reload_interval: float = 10.0,
+                 min_confidence: float = 0.7):
+        """
+        初始化食材詞庫（詞庫檔無法載入時拋出例外）
+
+        Args:
+            path: 詞庫檔路徑（JSON：ingredients 分類 → 標準名稱 → 別名，以及 cooking、quantity、filler 清單）
+            reload_interval: 每隔幾秒檢查一次詞庫檔是否修改，0 代表不自動重新載入
+            min_confidence: 本地比對的最低信心，低於此值時交給 LLM 判斷
+        """
+        self.path = path
+        self.reload_interval = reload_interval
+        self.min_confidence = min_confidence
+        self.logger = logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._stats = {"lookups": 0, "exact": 0, "alias": 0, "fuzzy": 0,
+                       "low_confidence": 0, "llm_avoided": 0, "reloads": 0, "reload_errors": 0}
+        self._index, self._mtime = self._load()
+        self._next_check = time.monotonic() + reload_interval
+
+    def _load(self) -> Tuple[_LexiconIndex, float]:
+        mtime = os.path.getmtime(self.path)
+        with open(self.path, encoding="utf-8") as f:
+            return _LexiconIndex(json.load(f)), mtime
+
+    @property
+    def matcher(self) -> KeywordMatcher:
+        """目前版本的比對器"""
+        self.maybe_reload()
+        return self._index.matcher
+
+    def reload(self) -> bool:
+        """
+        重新載入詞庫檔，載入失敗時保留目前的詞庫
+
+        Returns:
+            是否載入成功
+        """
+        with self._reload_lock:
+            try:
+                index, mtime = self._load()
+            except Exception as e:
+                with self._lock:
+                    self._stats["reload_errors"] += 1
+                self.logger.error(f"食材詞庫重新載入失敗，繼續使用目前版本: {e}")
+                return False
+            self._index, self._mtime = index, mtime
+            with self._lock:
+                self._stats["reloads"] += 1
+        self.logger.info(f"食材詞庫已重新載入：版本 {index.version}，共 {index.matcher.size} 個詞")
+        return True
+
+    def maybe_reload(self):
+        """距離上次檢查超過 reload_interval 且詞庫檔已修改時重新載入"""
+        if not self.reload_interval:
+            return
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.reload_interval
+        try:
+            changed = os.path.getmtime(self.path) != self._mtime
+        except OSError:
+            return
+        if changed:
+            self.reload()
+
+    def category(self, name: str) -> Optional[str]:
+        """標準名稱所屬的分類"""
+        return self._index.categories.get(name)
+
+    def extract(self, text: str) -> Extraction:
+        """
+        從訊息擷取食材：先以自動機比對標準名稱與別名，剩下的片段再做近似比對
+
+        Args:
+            text: 訊息
+
+        Returns:
+            擷取結果；還有未知片段或信心低於 min_confidence 時 needs_llm 為 True
+        """
+        self.maybe_reload()
+        index = self._index
+        ingredients: List[str] = []
+        exact = alias = False
+        remaining = list(text)  # 已比對的字元以空白取代
+        cooking = []
+        for match in index.matcher.find(text):
+            if match.kind == KIND_COOKING:
+                # 「菜」「肉」等烹調關鍵字可能是寫錯的食材的一部分（「高利菜」），近似比對後才扣除
+                cooking.append(match)
+                continue
+            remaining[match.start:match.end] = " " * (match.end - match.start)
+            if match.kind != KIND_INGREDIENT:
+                continue
+            if match.term == match.name.lower():
+                exact = True
+            else:
+                alias = True
+            if match.name not in ingredients:
+                ingredients.append(match.name)
+
+        fuzzy: List[Tuple[str, str, float]] = []
+        for run in _WORD_RUN.finditer("".join(remaining)):
+            for start, end, name, confidence in index.fuzzy(run.group()):
+                start, end = run.start() + start, run.start() + end
+                fuzzy.append((text[start:end], name, confidence))
+                remaining[start:end] = " " * (end - start)
+                if name not in ingredients:
+                    ingredients.append(name)
+        for match in cooking:
+            remaining[match.start:match.end] = " " * (match.end - match.start)
+        unknown = _WORD_RUN.findall("".join(remaining))
+
+        if ingredients:
+            # 最弱的近似比對結果，再依未知片段佔的比例打折（「鮭魚、秋葵、松露」的松露不能直接丟掉）
+            confidence = min([confidence for _, _, confidence in fuzzy], default=1.0)
+            confidence *= len(ingredients) / (len(ingredients) + len(unknown))
+        else:
+            confidence = 0.0 if unknown else 1.0
+        needs_llm = bool(unknown) or confidence < self.min_confidence
+        extraction = Extraction(ingredients, round(confidence, 3), unknown, fuzzy, needs_llm)
+
+        with self._lock:
+            stats = self._stats
+            stats["lookups"] += 1
+            stats["exact"] += exact
+            stats["alias"] += alias
+            stats["fuzzy"] += bool(fuzzy)
+            if needs_llm:
+                stats["low_confidence"] += 1
+            elif ingredients and not exact and len(text) > 2:
+                # 沒有標準名稱命中，以前只能交給 LLM 判斷，現在由別名或近似比對在本地找到食材
+                stats["llm_avoided"] += 1
+        return extraction
+
+    def stats(self) -> Dict[str, Any]:
+        """取得詞庫版本、詞數與擷取統計（含避免的 LLM 呼叫次數）"""
+        index = self._index
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({
+            "path": self.path,
+            "version": index.version,
+            "terms": index.matcher.size,
+            "ingredients": len(index.categories),
+        })
+        return stats
+
+
+# 全域詞庫實例
+ingredient_lexicon = None
+
+def init_ingredient_lexicon(path: Optional[str] = None, reload_interval: float = 10.0,
+                            min_confidence: float = 0.7) -> IngredientLexicon:
+    """載入詞庫檔（未指定時使用內建的 data/ingredient_lexicon.json）並建立全域詞庫"""
+    global ingredient_lexicon
+    ingredient_lexicon = IngredientLexicon(path or DEFAULT_LEXICON_PATH, reload_interval, min_confidence)
+    stats = ingredient_lexicon.stats()
+    logging.info(f"食材詞庫初始化成功：版本 {stats['version']}，{stats['ingredients']} 種食材、共 {stats['terms']} 個詞")
+    return ingredient_lexicon
+
+def get_ingredient_lexicon() -> IngredientLexicon:
+    """獲取全域詞庫實例，尚未初始化時載入內建詞庫"""
+    if ingredient_lexicon is None:
+        return init_ingredient_lexicon()
+    return ingredient_lexicon
+
+def get_ingredient_matcher() -> KeywordMatcher:
+    """獲取目前版本的比對器"""
+    return get_ingredient_lexicon().matcher
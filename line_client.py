@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LINE Messaging API 連線模組
+整個程序共用一個 ApiClient，MessagingApi 與 MessagingApiBlob 共享 keep-alive 連線池
+"""
+
+import logging
+import threading
+from typing import Optional
+
+from linebot.v3.messaging import (
+    Configuration, ApiClient, MessagingApi,
+    ReplyMessageRequest, PushMessageRequest
+)
+from linebot.v3.messaging.api import MessagingApiBlob
+
+LINE_API_HOST = "https://api.line.me"
+LINE_DATA_API_HOST = "https://api-data.line.me"
+
+
+class LineClient:
+    """共用連線池的 LINE API 用戶端（執行緒安全）"""
+
+    def __init__(self, access_token: str, pool_size: int = 10,
+                 connect_timeout: float = 3, read_timeout: float = 15):
+        """
+        初始化 LINE API 用戶端
+
+        Args:
+            access_token: LINE Channel Access Token
+            pool_size: 每個主機保留的連線數
+            connect_timeout: 連線逾時（秒）
+            read_timeout: 讀取逾時（秒）
+        """
+        self.logger = logging.getLogger(__name__)
+        self.access_token = access_token
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self._api_client = None
+        self._messaging_api = None
+        self._blob_api = None
+        self._lock = threading.Lock()
+
+    @property
+    def api_client(self) -> ApiClient:
+        """共用的 ApiClient"""
+        self._connect()
+        return self._api_client
+
+    @property
+    def messaging_api(self) -> MessagingApi:
+        self._connect()
+        return self._messaging_api
+
+    @property
+    def blob_api(self) -> MessagingApiBlob:
+        self._connect()
+        return self._blob_api
+
+    def _connect(self):
+        """第一次使用時才建立連線池，未設定 token 時匯入應用程式不會失敗"""
+        if self._api_client is not None:
+            return
+        with self._lock:
+            if self._api_client is not None:
+                return
+            if not self.access_token:
+                raise ValueError("未設定 LINE_CHANNEL_ACCESS_TOKEN，無法呼叫 LINE API")
+            configuration = Configuration(access_token=self.access_token)
+            configuration.connection_pool_maxsize = self.pool_size
+
+            # urllib3 PoolManager 本身是執行緒安全的，可讓所有工作執行緒共用
+            api_client = ApiClient(configuration)
+            self._messaging_api = MessagingApi(api_client)
+            self._blob_api = MessagingApiBlob(api_client)
+            self._api_client = api_client
+            self.logger.info(f"LINE API 連線池建立，大小: {self.pool_size}")
+
+    def reply_message(self, request: ReplyMessageRequest):
+        """使用 reply token 回覆訊息"""
+        return self.messaging_api.reply_message_with_http_info(request, _request_timeout=self.timeout)
+
+    def push_message(self, request: PushMessageRequest):
+        """主動推播訊息"""
+        return self.messaging_api.push_message_with_http_info(request, _request_timeout=self.timeout)
+
+    def get_message_content(self, message_id: str) -> bytearray:
+        """下載用戶傳送的語音 / 圖片內容"""
+        return self.blob_api.get_message_content(message_id, _request_timeout=self.timeout)
+
+    def warm_up(self) -> bool:
+        """
+        預先建立到 LINE API 主機的 TLS 連線
+
+        Returns:
+            是否成功建立連線
+        """
+        try:
+            self.messaging_api.get_bot_info(_request_timeout=self.timeout)
+            # api-data 主機沒有輕量 API，只需完成握手讓連線進入連線池
+            self.api_client.rest_client.pool_manager.request(
+                "HEAD", LINE_DATA_API_HOST, timeout=self.timeout[0]
+            )
+            self.logger.info("LINE API 連線預熱完成")
+            return True
+        except Exception as e:
+            self.logger.warning(f"LINE API 連線預熱失敗: {e}")
+            return False
+
+    def close(self):
+        """關閉連線池（尚未建立時不必關閉）"""
+        if self._api_client is not None:
+            self._api_client.close()
+
+
+# 全域 LINE API 用戶端實例
+line_client = None
+
+def init_line_client(access_token: str, pool_size: int = 10,
+                     connect_timeout: float = 3, read_timeout: float = 15,
+                     warm_up: bool = True) -> LineClient:
+    """初始化全域 LINE API 用戶端，並在背景預熱連線"""
+    global line_client
+    line_client = LineClient(access_token, pool_size, connect_timeout, read_timeout)
+    if not access_token:
+        logging.warning("未設定 LINE_CHANNEL_ACCESS_TOKEN，LINE API 呼叫將會失敗")
+    elif warm_up:
+        threading.Thread(target=line_client.warm_up, name="line-warm-up", daemon=True).start()
+    return line_client
+
+def get_line_client() -> Optional[LineClient]:
+    """獲取全域 LINE API 用戶端實例"""
+    return line_client
@@ -0,0 +1,33 @@
+# llm/__init__.py
+from .cancel import CancelToken
+from .singleflight import SingleFlight
+from .gateway import (
+    LLMGateway, TokenBucket, estimate_tokens,
+    PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BACKGROUND
+)
+from .resilience import (
+    CircuitBreaker, CircuitOpenError, RetryPolicy, is_rate_limited, is_retryable, is_transient
+)
+from .prompts import PromptRegistry, PromptSpec, parse_output_limits
+from .backends import LLMBackend, GeminiBackend, FakeBackend, create_backend
+from .routing import ModelRouter, ModelTier, parse_routes
+from .hedging import HedgePolicy
+from .metrics import LLMMetrics, JsonlSink, parse_pricing
+from .client import LLMClient, prompt_key, content_key
+from .stream_json import IncrementalArrayParser, iter_array_objects
+from .structured import (
+    OutputSchema, StructuredOutputError, generate_structured, structured_stats, coerce,
+    RECOMMENDATIONS, RECIPE_DETAILS, SUBSTITUTIONS, RECIPE_CARD_SCHEMA
+)
+
+__all__ = ['CancelToken', 'SingleFlight', 'LLMGateway', 'TokenBucket', 'is_rate_limited', 'estimate_tokens',
+           'PRIORITY_INTERACTIVE', 'PRIORITY_NORMAL', 'PRIORITY_BACKGROUND',
+           'CircuitBreaker', 'CircuitOpenError', 'RetryPolicy', 'is_retryable', 'is_transient',
+           'PromptRegistry', 'PromptSpec', 'parse_output_limits',
+           'LLMBackend', 'GeminiBackend', 'FakeBackend', 'create_backend',
+           'ModelRouter', 'ModelTier', 'parse_routes', 'HedgePolicy',
+           'LLMMetrics', 'JsonlSink', 'parse_pricing',
+           'LLMClient', 'prompt_key', 'content_key',
+           'IncrementalArrayParser', 'iter_array_objects',
+           'OutputSchema', 'StructuredOutputError', 'generate_structured', 'structured_stats', 'coerce',
+           'RECOMMENDATIONS', 'RECIPE_DETAILS', 'SUBSTITUTIONS', 'RECIPE_CARD_SCHEMA']
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLM 後端模組
+LLMClient 透過後端介面呼叫模型：GeminiBackend 呼叫 Google Gemini，
+FakeBackend 在本地返回符合 schema 的固定食譜，可設定延遲分佈、錯誤率與 429，用於離線壓力測試
+"""
+
+import abc
+import asyncio
+import json
+import logging
+import random
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from .prompts import supports_system_instruction
+from .resilience import is_rate_limited
+
+
+class LLMBackend(abc.ABC):
+    """LLM 後端介面"""
+
+    name = "base"
+
+    @abc.abstractmethod
+    def generate_content(self, contents: Any, generation_config: Optional[Dict[str, Any]] = None,
+                         stream: bool = False):
+        """
+        同步生成內容
+
+        Args:
+            contents: 提示詞，或提示詞與圖片的清單
+            generation_config: 生成設定
+            stream: 是否返回可逐段讀取的回應
+
+        Returns:
+            具有 text 屬性的回應；stream=True 時為回應片段的迭代器
+        """
+
+    async def generate_content_async(self, contents: Any,
+                                     generation_config: Optional[Dict[str, Any]] = None):
+        """非同步生成內容，預設在執行緒池中呼叫同步版本"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, lambda: self.generate_content(contents, generation_config=generation_config)
+        )
+
+    def with_system_instruction(self, system_instruction: str) -> Optional["LLMBackend"]:
+        """
+        取得套用系統指示的後端
+
+        Returns:
+            新的後端；不支援系統指示時返回 None（由呼叫端放進提示詞）
+        """
+        return None
+
+
+class GeminiBackend(LLMBackend):
+    """Google Gemini 後端"""
+
+    name = "gemini"
+
+    def __init__(self, model_name: str = "gemini-1.5-flash", api_key: Optional[str] = None,
+                 system_instruction: Optional[str] = None):
+        """
+        初始化 Gemini 後端
+
+        Args:
+            model_name: 模型名稱
+            api_key: Google API 金鑰，None 時沿用已設定的金鑰
+            system_instruction: 系統指示（SDK 支援時才會使用）
+        """
+        import google.generativeai as genai
+
+        if api_key:
+            genai.configure(api_key=api_key)
+        self.model_name = model_name
+        if system_instruction:
+            self.model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+        else:
+            self.model = genai.GenerativeModel(model_name)
+
+    def generate_content(self, contents, generation_config=None, stream=False):
+        return self.model.generate_content(contents, generation_config=generation_config, stream=stream)
+
+    async def generate_content_async(self, contents, generation_config=None):
+        return await self.model.generate_content_async(contents, generation_config=generation_config)
+
+    def count_tokens(self, contents):
+        return self.model.count_tokens(contents)
+
+    def with_system_instruction(self, system_instruction):
+        if not supports_system_instruction():
+            return None
+        return GeminiBackend(self.model_name, system_instruction=system_instruction)
+
+
+# --- 本地假後端 ---
+
+class FakeResponse:
+    """假後端的回應，介面與 Gemini 回應相同（text、candidates）"""
+
+    def __init__(self, text: str, finish_reason: str = "STOP"):
+        self.text = text
+        self.candidates = [_FakeCandidate(finish_reason)]
+
+
+class _FakeCandidate:
+    def __init__(self, finish_reason: str):
+        self.finish_reason = _FakeFinishReason(finish_reason)
+
+
+class _FakeFinishReason:
+    def __init__(self, name: str):
+        self.name = name
+
+
+FAKE_DISHES = [
+    ("番茄炒蛋", ["番茄", "雞蛋", "蔥"], "15分鐘", "簡單"),
+    ("蒜炒青菜", ["青菜", "蒜", "鹽"], "10分鐘", "簡單"),
+    ("麻婆豆腐", ["豆腐", "豬肉", "豆瓣醬"], "20分鐘", "中等"),
+    ("洋蔥炒牛肉", ["牛肉", "洋蔥", "醬油"], "20分鐘", "中等"),
+    ("馬鈴薯燉雞", ["雞肉", "馬鈴薯", "紅蘿蔔"], "40分鐘", "中等"),
+    ("蛋炒飯", ["白飯", "雞蛋", "蔥"], "15分鐘", "簡單"),
+]
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """
+    解析延遲分佈設定
+
+    支援 fixed:秒、uniform:最小,最大、normal:平均,標準差、
+    lognormal:中位數,sigma、exp:平均（單位皆為秒）
+
+    Args:
+        spec: 分佈設定字串
+
+    Returns:
+        以亂數產生器產生延遲秒數的函數
+    """
+    kind, _, args = (spec or "fixed:0").partition(":")
+    values = [float(value) for value in args.split(",") if value.strip()]
+    kind = kind.strip().lower()
+    if kind == "fixed":
+        return lambda rng: values[0] if values else 0.0
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        import math
+        mu = math.log(values[0])
+        return lambda rng: rng.lognormvariate(mu, values[1])
+    if kind == "exp":
+        return lambda rng: rng.expovariate(1 / values[0])
+    raise ValueError(f"不支援的延遲分佈: {spec}")
+
+
+class FakeBackend(LLMBackend):
+    """離線假後端：依提示詞內容返回固定格式的回應，可重現慢速與故障的上游"""
+
+    name = "fake"
+
+    def __init__(self, latency: str = "lognormal:0.8,0.4", error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, seed: int = 42, model_name: str = "fake"):
+        """
+        初始化假後端
+
+        Args:
+            latency: 延遲分佈設定（見 parse_latency）
+            error_rate: 返回 503 的機率
+            rate_limit_rate: 返回 429 的機率
+            seed: 亂數種子，相同種子與呼叫順序會得到相同結果
+            model_name: 顯示用的模型名稱
+        """
+        self.model_name = model_name
+        self.latency_spec = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self._latency = parse_latency(latency)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "errors": 0, "rate_limited": 0}
+        self.logger = logging.getLogger(__name__)
+
+    def generate_content(self, contents, generation_config=None, stream=False):
+        delay, error = self._draw()
+        if stream:
+            return self._stream(contents, delay, error)
+        time.sleep(delay)
+        if error:
+            raise error
+        return FakeResponse(self._respond(contents))
+
+    async def generate_content_async(self, contents, generation_config=None):
+        # 以 asyncio.sleep 模擬延遲，大量並行請求也不佔用執行緒
+        delay, error = self._draw()
+        await asyncio.sleep(delay)
+        if error:
+            raise error
+        return FakeResponse(self._respond(contents))
+
+    def count_tokens(self, contents):
+        from .gateway import estimate_tokens
+        return type("TokenCount", (), {"total_tokens": estimate_tokens(contents)})()
+
+    def stats(self) -> Dict[str, int]:
+        """取得呼叫與注入錯誤的統計"""
+        with self._lock:
+            return dict(self._stats)
+
+    def _draw(self):
+        """抽出此次呼叫的延遲與要注入的錯誤"""
+        with self._lock:
+            self._stats["calls"] += 1
+            delay = self._latency(self._rng)
+            roll = self._rng.random()
+            if roll < self.rate_limit_rate:
+                self._stats["rate_limited"] += 1
+                return delay * 0.1, _error(429)
+            if roll < self.rate_limit_rate + self.error_rate:
+                self._stats["errors"] += 1
+                return delay, _error(503)
+            return delay, None
+
+    def _stream(self, contents, delay: float, error: Optional[Exception]) -> Iterator[FakeResponse]:
+        text = self._respond(contents)
+        pieces = [text[i:i + 40] for i in range(0, len(text), 40)] or [""]
+        for index, piece in enumerate(pieces):
+            time.sleep(delay / len(pieces))
+            # 429 在第一個片段前返回，其他錯誤模擬串流中途斷線
+            if error and index == (0 if is_rate_limited(error) else len(pieces) // 2):
+                raise error
+            yield FakeResponse(piece)
+
+    def _respond(self, contents) -> str:
+        """依提示詞判斷任務類型並產生回應"""
+        parts = contents if isinstance(contents, (list, tuple)) else [contents]
+        prompt = "\n".join(part for part in parts if isinstance(part, str))
+        has_image = any(not isinstance(part, str) for part in parts)
+
+        if has_image:
+            return "雞蛋,番茄,青菜,豆腐"
+        if '"recommendations"' in prompt:
+            return json.dumps({"recommendations": self._dishes(prompt, '"details"' in prompt)},
+                              ensure_ascii=False)
+        if '"substitutions"' in prompt:
+            missing = _first_match(r"缺少以下食材：(.+)", prompt) or "食材"
+            return json.dumps({
+                "substitutions": {name: ["可省略", "用類似食材代替", "加強其他調味"]
+                                  for name in re.split(r"[、,，]", missing) if name},
+                "notes": "替代後請依口味調整調味"
+            }, ensure_ascii=False)
+        if '"steps"' in prompt:
+            name = _first_match(r"請為「(.+?)」", prompt) or "家常料理"
+            return json.dumps(_recipe_details(name), ensure_ascii=False)
+        if "識別出食材名稱" in prompt:
+            return "雞蛋,番茄"
+        return "• 沒有醬油 → 用鹽+糖調味，或直接省略\n• 沒有蒜 → 用蒜粉代替，或可以不用"
+
+    def _dishes(self, prompt: str, with_details: bool) -> List[Dict[str, Any]]:
+        with self._lock:
+            dishes = self._rng.sample(FAKE_DISHES, 3)
+        recommendations = []
+        for name, ingredients, cook_time, difficulty in dishes:
+            recipe = {"name": name, "ingredients": ingredients, "time": cook_time,
+                      "difficulty": difficulty, "description": f"簡單美味的{name}"}
+            if with_details:
+                details = _recipe_details(name)
+                recipe["details"] = {key: details[key] for key in ("ingredients", "steps", "tips", "nutrition")}
+            recommendations.append(recipe)
+        return recommendations
+
+
+def _recipe_details(name: str) -> Dict[str, Any]:
+    return {
+        "name": name,
+        "ingredients": [{"name": "主要食材", "amount": "適量", "note": ""},
+                        {"name": "鹽", "amount": "少許", "note": "依口味調整"}],
+        "time": "20分鐘",
+        "difficulty": "簡單",
+        "steps": ["食材洗淨切好", "熱鍋下油爆香", "加入主要食材拌炒", "調味後起鍋"],
+        "tips": "火候不要太大，避免燒焦",
+        "nutrition": "富含蛋白質與膳食纖維",
+    }
+
+
+def _first_match(pattern: str, text: str) -> Optional[str]:
+    match = re.search(pattern, text)
+    return match.group(1).strip() if match else None
+
+
+def _error(status: int) -> Exception:
+    """產生與 Gemini SDK 相同類型的錯誤，讓重試、斷路器與 429 判斷照常運作"""
+    try:
+        from google.api_core import exceptions as google_exceptions
+        if status == 429:
+            return google_exceptions.ResourceExhausted("fake backend: quota exceeded")
+        return google_exceptions.ServiceUnavailable("fake backend: service unavailable")
+    except ImportError:
+        error = RuntimeError(f"fake backend: HTTP {status}")
+        error.code = status
+        return error
+
+
+def create_backend(name: str = "gemini", **kwargs) -> LLMBackend:
+    """
+    依名稱建立 LLM 後端
+
+    Args:
+        name: gemini 或 fake
+        **kwargs: 後端的初始化參數
+
+    Returns:
+        LLM 後端
+    """
+    if name == "fake":
+        return FakeBackend(**kwargs)
+    if name == "gemini":
+        return GeminiBackend(**kwargs)
+    raise ValueError(f"不支援的 LLM 後端: {name}")
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLM 呼叫取消模組
+呼叫端不再需要結果時（例如用戶已送出新訊息），由其他執行緒取消進行中的 LLM 呼叫，
+排隊中的請求不再送出，執行中的上游呼叫被中止
+"""
+
+import logging
+import threading
+from typing import Callable, List
+
+
+class CancelToken:
+    """可跨執行緒取消的權杖（執行緒安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._callbacks: List[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def cancel(self) -> bool:
+        """
+        取消並呼叫已登記的回呼函數
+
+        Returns:
+            是否為第一次取消
+        """
+        with self._lock:
+            if self._cancelled:
+                return False
+            self._cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.getLogger(__name__).warning(f"取消回呼執行失敗: {e}")
+        return True
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        登記取消時呼叫的函數，已取消時立即呼叫
+
+        Args:
+            callback: 取消時呼叫的函數（在呼叫 cancel() 的執行緒中執行）
+
+        Returns:
+            取消登記的函數
+        """
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks.append(callback)
+                return lambda: self._discard(callback)
+        callback()
+        return lambda: None
+
+    def _discard(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLM 用戶端模組
+所有 LLM 呼叫的共同入口，相同提示詞的並行請求只會送出一次，
+實際請求交由 LLM 閘道依優先順序與配額排程，再由模型路由器選擇的 LLM 後端執行
+"""
+
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import time
+import uuid
+from concurrent.futures import CancelledError
+from typing import Any, Dict, Iterator, Optional
+
+from .gateway import LLMGateway, PRIORITY_NORMAL, estimate_tokens
+from .backends import LLMBackend
+from .cancel import CancelToken
+from .prompts import PromptRegistry, response_usage
+from .resilience import is_rate_limited, is_transient
+from .hedging import HedgePolicy
+from .metrics import CallInfo, LLMMetrics, outcome_of
+from .routing import ModelRouter, ModelTier
+from .singleflight import SingleFlight
+
+
+class LLMClient:
+    """包裝 LLM 後端的用戶端"""
+
+    def __init__(self, backend: Optional[LLMBackend] = None, timeout: float = 60,
+                 gateway: Optional[LLMGateway] = None, prompts: Optional[PromptRegistry] = None,
+                 router: Optional[ModelRouter] = None, hedging: Optional[HedgePolicy] = None,
+                 metrics: Optional[LLMMetrics] = None):
+        """
+        初始化 LLM 用戶端
+
+        Args:
+            backend: LLM 後端（llm.backends.LLMBackend），未提供 router 時所有呼叫都使用此後端
+            timeout: 每個呼叫端等待結果的秒數
+            gateway: LLM 閘道，None 時使用預設設定建立
+            prompts: 提示詞註冊表（系統指示、輸出上限與 token 統計）
+            router: 模型路由器，依呼叫類型選擇模型層級
+            hedging: 對沖策略，None 時不送出對沖請求
+            metrics: 呼叫統計，None 時使用預設設定建立
+        """
+        if router is None:
+            if backend is None:
+                raise ValueError("需要提供 backend 或 router")
+            router = ModelRouter.single(backend)
+        self.router = router
+        self.hedging = hedging
+        self.metrics = metrics or LLMMetrics()
+        self.timeout = timeout
+        self.gateway = gateway or LLMGateway()
+        self.prompts = prompts or PromptRegistry()
+        self.single_flight = SingleFlight()
+        self.logger = logging.getLogger(__name__)
+        self._system_backends: Dict[tuple, Optional[LLMBackend]] = {}
+
+    def generate_content(self, contents: Any, call_type: str = "default",
+                         key: Optional[str] = None, timeout: Optional[float] = None,
+                         priority: int = PRIORITY_NORMAL,
+                         generation_config: Optional[Dict[str, Any]] = None,
+                         cancel: Optional[CancelToken] = None):
+        """
+        呼叫 LLM 生成內容
+
+        Args:
+            contents: 提示詞，或提示詞與圖片的清單
+            call_type: 呼叫類型（recommendations、recipe_details 等）
+            key: 合併請求用的鍵值；None 時由文字提示詞計算，含圖片且未提供時不合併
+            timeout: 等待秒數，None 使用預設值
+            priority: 閘道排程的優先順序
+            generation_config: 生成設定，與註冊的輸出上限合併
+            cancel: 取消權杖；取消時拋出 concurrent.futures.CancelledError，
+                沒有其他呼叫端合併等待時同時取消閘道中的請求
+
+        Returns:
+            後端的回應物件（具有 text 屬性）
+        """
+        generation_config = self.prompts.generation_config(call_type, generation_config)
+        if key is None:
+            key = prompt_key(contents)
+            if key is not None and generation_config:
+                key = content_key(key, json.dumps(generation_config, sort_keys=True))
+        if timeout is None:
+            timeout = self.timeout
+
+        info = CallInfo()
+        started = time.monotonic()
+
+        def start():
+            return self.gateway.submit(
+                self._job(call_type, contents, generation_config, info), priority,
+                estimate_tokens(contents), timeout
+            )
+
+        def on_join(future):
+            # 合併到進行中的請求，用量已記在該請求上
+            info.coalesced = True
+            self.gateway.promote(future, priority)
+
+        if key is None:
+            key = uuid.uuid4().hex  # 無法判斷內容是否相同，不合併
+        try:
+            response = self.single_flight.do(f"{call_type}:{key}", start, timeout, on_join=on_join,
+                                             cancel=cancel, on_abandon=self.gateway.cancel)
+        except Exception as e:
+            self._record_call(call_type, info, started, e)
+            raise
+        self._record_call(call_type, info, started)
+        return response
+
+    def stream_content(self, contents: Any, call_type: str = "default",
+                       priority: int = PRIORITY_NORMAL,
+                       cancel: Optional[CancelToken] = None) -> Iterator[str]:
+        """
+        以串流方式呼叫 LLM，逐段返回文字
+
+        串流回應無法分享給其他呼叫端，因此不經過請求合併，只向閘道取得名額
+
+        Args:
+            contents: 提示詞
+            call_type: 呼叫類型
+            priority: 閘道排程的優先順序
+            cancel: 取消權杖；取消後收到下一個片段時停止讀取串流並拋出 concurrent.futures.CancelledError
+
+        Yields:
+            回應的文字片段
+        """
+        self.logger.debug(f"串流呼叫 LLM: {call_type}")
+        generation_config = self.prompts.generation_config(call_type, None)
+        input_tokens = estimate_tokens(contents)
+        output_tokens = 0
+        info = CallInfo()
+        called_at = time.monotonic()
+        error = None
+        if cancel is not None and cancel.cancelled:
+            raise CancelledError("LLM 呼叫已取消")
+        with self.gateway.reserve(priority, input_tokens, self.timeout):
+            tried = []
+            tier = self.router.choose(call_type)
+            started = time.monotonic()
+            try:
+                while True:
+                    backend, prepared, config = self._prepare(tier, call_type, contents, generation_config)
+                    kwargs = {"generation_config": config} if config else {}
+                    info.attempts += 1
+                    try:
+                        response = iter(backend.generate_content(prepared, stream=True, **kwargs))
+                        first = next(response, None)
+                        break
+                    except Exception as e:
+                        # 尚未收到任何片段時，被限流的層級可以直接改用下一個層級
+                        fallback = self._fallback(call_type, tier, tried, e, started)
+                        if fallback is None:
+                            raise
+                        tier, started = fallback, time.monotonic()
+
+                for chunk in itertools.chain([first] if first is not None else [], response):
+                    if cancel is not None and cancel.cancelled:
+                        raise CancelledError("LLM 呼叫已取消")
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        continue  # 沒有文字內容的片段（例如安全性過濾）
+                    if text:
+                        output_tokens += estimate_tokens(text)
+                        yield text
+            except GeneratorExit:
+                # 呼叫端提前停止讀取（例如已收到足夠的菜色），上游有正常回應
+                self.gateway.breaker.record_success()
+                raise
+            except Exception as e:
+                error = e
+                # 與閘道相同：只有暫時性故障計入失敗，其他錯誤代表上游仍有回應
+                if is_transient(e):
+                    self.gateway.breaker.record_failure()
+                else:
+                    self.gateway.breaker.record_success()
+                raise
+            else:
+                self.gateway.breaker.record_success()
+                self.router.record_success(tier, time.monotonic() - started)
+            finally:
+                # 提前停止讀取時只計算已收到的部分
+                self.prompts.record(call_type, input_tokens, output_tokens)
+                info.model = tier.model_name
+                info.input_tokens, info.output_tokens = input_tokens, output_tokens
+                self._record_call(call_type, info, called_at, error)
+
+    def _prepare(self, tier: ModelTier, call_type: str, contents: Any,
+                 generation_config: Optional[Dict[str, Any]]):
+        """
+        套用模型層級的生成設定與呼叫類型註冊的系統指示
+
+        Args:
+            tier: 路由器選擇的模型層級
+            call_type: 呼叫類型
+            contents: 提示詞
+            generation_config: 呼叫類型的生成設定（優先於層級設定）
+
+        Returns:
+            (後端, 內容, 生成設定)
+        """
+        if tier.generation_config:
+            generation_config = {**tier.generation_config, **(generation_config or {})}
+        spec = self.prompts.get(call_type)
+        if not spec or not spec.system_instruction:
+            return tier.backend, contents, generation_config
+
+        # 後端支援系統指示時設定在後端上，每次呼叫只送出各自的內容
+        cache_key = (tier.name, spec.version)
+        if cache_key not in self._system_backends:
+            self._system_backends[cache_key] = tier.backend.with_system_instruction(spec.system_instruction)
+        backend = self._system_backends[cache_key]
+        if backend is not None:
+            return backend, contents, generation_config
+
+        # 不支援系統指示時放在內容最前面
+        if isinstance(contents, (list, tuple)):
+            return tier.backend, [spec.system_instruction, *contents], generation_config
+        return tier.backend, f"{spec.system_instruction}\n\n{contents}", generation_config
+
+    def _fallback(self, call_type: str, tier: ModelTier, tried: list, error: Exception,
+                  started: float) -> Optional[ModelTier]:
+        """記錄層級失敗；被限流時返回下一個可用層級，否則返回 None"""
+        rate_limited = is_rate_limited(error)
+        self.router.record_failure(tier, time.monotonic() - started, rate_limited)
+        if not rate_limited:
+            return None
+        tried.append(tier.name)
+        fallback = self.router.choose(call_type, exclude=tried)
+        if fallback is not None:
+            self.logger.info(f"模型層級 {tier.name} 被限流，{call_type} 改用 {fallback.name}")
+        return fallback
+
+    def _job(self, call_type: str, contents: Any, generation_config: Optional[Dict[str, Any]],
+             info: CallInfo):
+        """建立在閘道事件迴圈中執行的協程函數，每次嘗試都重新選擇模型層級"""
+        async def call():
+            info.attempts += 1
+            hedge_after = self.hedging.hedge_after(call_type) if self.hedging else None
+            tier = self.router.choose(call_type)
+            primary_started = time.monotonic()
+            primary = asyncio.ensure_future(self._attempt(call_type, contents, generation_config, tier, info))
+            hedge = None
+            try:
+                if hedge_after is not None:
+                    done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+                    if not done and self.hedging.acquire():
+                        if self.gateway.try_acquire_extra(estimate_tokens(contents)):
+                            # 超過近期 p95 仍未返回：優先在另一個層級送出相同請求，採用先完成的結果
+                            self.logger.info(f"LLM 請求 {call_type} 超過 {hedge_after:.1f} 秒未返回，送出對沖請求")
+                            hedge_tier = (self.router.choose(call_type, exclude=[tier.name])
+                                          or self.router.choose(call_type))
+                            info.hedged = True
+                            hedge = asyncio.ensure_future(
+                                self._attempt(call_type, contents, generation_config, hedge_tier, info)
+                            )
+                        else:
+                            self.hedging.refund()
+                if hedge is None:
+                    return await primary
+                winner, response = await _first_success([primary, hedge])
+                if winner is hedge:
+                    self.hedging.record_win()
+                return response
+            finally:
+                # 取消仍在進行的一方（逾時被取消時兩者都取消）
+                if self.hedging and not primary.done():
+                    # 原請求的實際延遲至少是已經過的時間，不記錄會讓對沖門檻越來越低
+                    self.hedging.record(call_type, time.monotonic() - primary_started, censored=True)
+                primary.cancel()
+                if hedge is not None:
+                    hedge.cancel()
+                    self.gateway.release_extra()
+        return call
+
+    async def _attempt(self, call_type: str, contents: Any,
+                       generation_config: Optional[Dict[str, Any]], tier: ModelTier, info: CallInfo):
+        """
+        送出一次請求；被限流時在同一次嘗試中改用下一個層級
+
+        Args:
+            call_type: 呼叫類型
+            contents: 提示詞
+            generation_config: 呼叫類型的生成設定
+            tier: 路由器選擇的模型層級
+            info: 填入實際使用的模型與 token 用量
+
+        Returns:
+            後端的回應物件
+        """
+        tried = []
+        while True:
+            backend, prepared, config = self._prepare(tier, call_type, contents, generation_config)
+            kwargs = {"generation_config": config} if config else {}
+            started = time.monotonic()
+            try:
+                response = await backend.generate_content_async(prepared, **kwargs)
+            except asyncio.CancelledError:
+                # 超過時間預算或對沖請求已先完成
+                self.router.record_cancelled(tier, time.monotonic() - started)
+                raise
+            except Exception as e:
+                fallback = self._fallback(call_type, tier, tried, e, started)
+                if fallback is None:
+                    raise
+                tier = fallback
+                continue
+            latency = time.monotonic() - started
+            self.router.record_success(tier, latency)
+            if self.hedging:
+                self.hedging.record(call_type, latency)
+            # 合併的請求只記錄一次用量
+            usage = response_usage(prepared, response)
+            self.prompts.record(call_type, **usage)
+            info.model = tier.model_name
+            info.input_tokens, info.output_tokens = usage["input_tokens"], usage["output_tokens"]
+            return response
+
+    def _record_call(self, call_type: str, info: CallInfo, started: float,
+                     error: Optional[BaseException] = None):
+        self.metrics.record(
+            call_type, time.monotonic() - started, model=info.model,
+            input_tokens=info.input_tokens, output_tokens=info.output_tokens,
+            attempts=info.attempts, outcome=outcome_of(error),
+            coalesced=info.coalesced, hedged=info.hedged
+        )
+
+    def stats(self):
+        """取得呼叫統計"""
+        return {"single_flight": self.single_flight.stats(), "gateway": self.gateway.stats(),
+                "routing": self.router.stats(), "hedging": self.hedging.stats() if self.hedging else None,
+                "prompt_usage": self.prompts.report(5)}
+
+    def shutdown(self):
+        """停止閘道並寫完呼叫紀錄"""
+        self.gateway.shutdown()
+        self.metrics.close()
+
+
+async def _first_success(tasks):
+    """等待第一個成功的任務，全部失敗時拋出最後一個例外"""
+    pending = set(tasks)
+    error = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None:
+                return task, task.result()
+            error = task.exception()
+    raise error
+
+
+def prompt_key(contents: Any) -> Optional[str]:
+    """由文字提示詞計算請求鍵值，含非文字內容時返回 None"""
+    parts = contents if isinstance(contents, (list, tuple)) else [contents]
+    if not all(isinstance(part, str) for part in parts):
+        return None
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def content_key(*parts: Any) -> str:
+    """由文字與位元組內容（例如圖片）計算請求鍵值"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, (bytes, bytearray)) else str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
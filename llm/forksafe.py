@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fork 安全模組
+fork 出的子進程（例如 WEBHOOK_WORKER_TYPE=process 的工作進程）只會複製呼叫 fork 的執行緒，
+背景執行緒與事件迴圈不會存在；持有背景執行緒的物件在此登記，於子進程中重建
+"""
+
+import os
+import weakref
+
+
+def reinit_in_child(instance, method: str):
+    """
+    登記在 fork 出的子進程中呼叫的重建方法
+
+    只保留弱參照，物件被回收後不再呼叫
+
+    Args:
+        instance: 持有背景執行緒的物件
+        method: 重建背景執行緒的方法名稱
+    """
+    if not hasattr(os, "register_at_fork"):
+        return
+    ref = weakref.ref(instance)
+
+    def after_in_child():
+        target = ref()
+        if target is not None:
+            getattr(target, method)()
+
+    os.register_at_fork(after_in_child=after_in_child)
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLM 閘道模組
+在獨立執行緒的 asyncio 事件迴圈中排程所有 LLM 請求，
+限制同時進行的請求數，並以 token bucket 控制每分鐘請求數與 token 數；
+失敗的請求在時間預算內重新排入佇列重試，上游持續故障時由斷路器直接拒絕
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from .forksafe import reinit_in_child
+from .resilience import (
+    CircuitBreaker, CircuitOpenError, RetryPolicy, is_rate_limited, is_transient, CLOSED, OPEN
+)
+
+# 優先順序（數字越小越先執行）
+PRIORITY_INTERACTIVE = 0   # 用戶正在等待的操作，例如點選詳細食譜
+PRIORITY_NORMAL = 1        # 一般對話流程
+PRIORITY_BACKGROUND = 2    # 背景工作，例如預先生成
+
+IMAGE_TOKENS = 258  # Gemini 每張圖片約佔用的 token 數
+
+
+class TokenBucket:
+    """每分鐘補充固定數量的 token bucket（只在事件迴圈執行緒中使用）"""
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        """
+        初始化 token bucket
+
+        Args:
+            per_minute: 每分鐘補充量
+            capacity: 最大容量，預設為一分鐘的補充量
+        """
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """取得足夠 token 還需要等待的秒數（超過容量的請求在額滿時放行）"""
+        self._refill()
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        """扣除 token，可以扣成負數（回應比預估大時由後續請求等待補足）"""
+        self._refill()
+        self.tokens -= amount
+
+    def drain(self):
+        """清空 bucket（上游回報配額不足時使用）"""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+
+class _Request:
+    __slots__ = ("job", "priority", "tokens", "future", "deadline", "attempts", "entry")
+
+    def __init__(self, job, priority, tokens, future, deadline):
+        self.job = job
+        self.priority = priority
+        self.tokens = tokens
+        self.future = future
+        self.deadline = deadline
+        self.attempts = 0
+        self.entry = None  # 目前有效的佇列項目序號，None 代表不在佇列中
+
+
+class LLMGateway:
+    """有並行上限、速率限制與優先順序的 LLM 請求排程器"""
+
+    def __init__(self, max_concurrent: int = 16, requests_per_minute: float = 0,
+                 tokens_per_minute: float = 0, rate_limit_cooldown: float = 10,
+                 retry: Optional[RetryPolicy] = None, breaker: Optional[CircuitBreaker] = None):
+        """
+        初始化 LLM 閘道
+
+        Args:
+            max_concurrent: 同時進行的請求上限
+            requests_per_minute: 每分鐘請求數上限，0 代表不限制
+            tokens_per_minute: 每分鐘 token 數上限，0 代表不限制
+            rate_limit_cooldown: 上游回報 429 後暫停送出新請求的秒數
+            retry: 重試策略，None 時使用預設設定
+            breaker: 斷路器，None 時使用預設設定
+        """
+        self.max_concurrent = max_concurrent
+        self.rate_limit_cooldown = rate_limit_cooldown
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.logger = logging.getLogger(__name__)
+
+        self._request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+        self._queue = []  # (priority, seq, request)
+        self._seq = itertools.count()
+        self._active = 0
+        self._paused_until = 0.0
+        self._wake_handle = None
+        self._tasks: Dict[Future, asyncio.Task] = {}  # 執行中請求的 Future -> 事件迴圈中的 task
+        self._stats_lock = threading.Lock()
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "rate_limited": 0,
+                       "throttled": 0, "promoted": 0, "retried": 0, "circuit_rejected": 0,
+                       "budget_exhausted": 0, "extra": 0, "cancelled": 0}
+        self._lane_stats = {PRIORITY_INTERACTIVE: 0, PRIORITY_NORMAL: 0, PRIORITY_BACKGROUND: 0}
+
+        self._start_loop()
+        # process 模式的工作進程是 fork 出的複本，沒有事件迴圈執行緒，需在子進程中重建
+        reinit_in_child(self, "_after_fork")
+
+    # --- 對外介面（任何執行緒皆可呼叫） ---
+
+    def submit(self, job: Callable[[], Awaitable[Any]], priority: int = PRIORITY_NORMAL,
+               tokens: int = 0, budget: Optional[float] = None) -> Future:
+        """
+        排入一個 LLM 請求
+
+        Args:
+            job: 在事件迴圈中執行的協程函數，返回上游回應
+            priority: 優先順序
+            tokens: 預估的輸入 token 數
+            budget: 此請求（含排隊與重試）的總秒數，None 使用重試策略的預設值
+
+        Returns:
+            concurrent.futures.Future，完成時為上游回應；斷路器開啟時為 CircuitOpenError
+        """
+        future = Future()
+        deadline = time.monotonic() + (budget if budget is not None else self.retry.budget)
+        self._loop.call_soon_threadsafe(self._enqueue, _Request(job, priority, tokens, future, deadline))
+        return future
+
+    @contextmanager
+    def reserve(self, priority: int = PRIORITY_NORMAL, tokens: int = 0,
+                timeout: Optional[float] = None):
+        """
+        取得一個請求名額，由呼叫端自行送出請求（例如串流回應）
+
+        Args:
+            priority: 優先順序
+            tokens: 預估的輸入 token 數
+            timeout: 等待名額的秒數，逾時拋出 concurrent.futures.TimeoutError
+
+        呼叫端需自行以 breaker.record_success / record_failure 回報結果；
+        離開時仍未回報的試探名額會歸還給斷路器
+        """
+        future = self.submit(None, priority, tokens, timeout)
+        try:
+            future.result(timeout=timeout)
+        except BaseException:
+            # 已取得（或即將取得）名額但呼叫端不再等待時必須歸還
+            if not future.cancel():
+                future.add_done_callback(self._release_if_admitted)
+            raise
+        try:
+            yield
+        finally:
+            self.breaker.release()
+            self._loop.call_soon_threadsafe(self._release)
+
+    def _release_if_admitted(self, future: Future):
+        if not future.cancelled() and future.exception() is None:
+            self.breaker.release()
+            self._loop.call_soon_threadsafe(self._release)
+
+    def cancel(self, future: Future):
+        """
+        取消 submit() 返回的請求（呼叫端已不需要結果）
+
+        排隊中或退避中的請求不再送出，執行中的請求中止上游呼叫並歸還名額；
+        Future 以 concurrent.futures.CancelledError 結束
+        """
+        if not future.cancel():
+            self._loop.call_soon_threadsafe(self._cancel_running, future)
+
+    def promote(self, future: Future, priority: int):
+        """提高排隊中請求的優先順序（例如前景請求合併到背景請求時）"""
+        self._loop.call_soon_threadsafe(self._promote, future, priority)
+
+    def try_acquire_extra(self, tokens: int = 0) -> bool:
+        """
+        為進行中的請求額外佔用一個名額（例如對沖請求），只能在事件迴圈中呼叫
+
+        只有在沒有請求排隊、仍有並行名額、配額足夠且斷路器關閉時才允許，成功時扣除配額；
+        呼叫端用完後需呼叫 release_extra()
+
+        Args:
+            tokens: 預估的輸入 token 數
+
+        Returns:
+            是否取得名額
+        """
+        if self.breaker.state != CLOSED or self._active >= self.max_concurrent:
+            return False
+        if any(request.entry == seq for _, seq, request in self._queue):
+            return False
+        if self._quota_wait(tokens) > 0:
+            return False
+        self._active += 1
+        self._consume(tokens)
+        self._count("extra")
+        return True
+
+    def release_extra(self):
+        """歸還 try_acquire_extra() 取得的名額，只能在事件迴圈中呼叫"""
+        self._release()
+
+    def stats(self) -> Dict[str, Any]:
+        """取得排程統計"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+            stats["lanes"] = {
+                "interactive": self._lane_stats[PRIORITY_INTERACTIVE],
+                "normal": self._lane_stats[PRIORITY_NORMAL],
+                "background": self._lane_stats[PRIORITY_BACKGROUND],
+            }
+        stats["active"] = self._active
+        stats["queued"] = sum(1 for _, seq, request in self._queue if request.entry == seq)
+        stats["circuit"] = self.breaker.stats()
+        return stats
+
+    def load(self) -> int:
+        """進行中與排隊中的請求數"""
+        return self._active + sum(1 for _, seq, request in self._queue if request.entry == seq)
+
+    def shutdown(self):
+        """停止事件迴圈"""
+        if self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _start_loop(self):
+        """建立事件迴圈與執行它的背景執行緒"""
+        self._loop = asyncio.new_event_loop()
+        # 沒有非同步介面的同步呼叫在此執行緒池中執行
+        self._loop.set_default_executor(
+            ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix="llm-call")
+        )
+        self._thread = threading.Thread(target=self._run_loop, name="llm-gateway", daemon=True)
+        self._thread.start()
+
+    def _after_fork(self):
+        """在 fork 出的子進程中重建事件迴圈；父進程的排隊與進行中請求不屬於子進程"""
+        self._queue = []
+        self._active = 0
+        self._wake_handle = None
+        self._tasks = {}
+        self._stats_lock = threading.Lock()
+        self._start_loop()
+
+    # --- 事件迴圈內部 ---
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def _enqueue(self, request: _Request):
+        self._count("submitted")
+        self._push(request)
+        self._dispatch()
+
+    def _push(self, request: _Request):
+        request.entry = next(self._seq)
+        heapq.heappush(self._queue, (request.priority, request.entry, request))
+
+    def _promote(self, future: Future, priority: int):
+        for _, seq, request in self._queue:
+            if request.future is future and request.entry == seq and priority < request.priority:
+                # 舊項目留在佇列中，取出時因序號不符而略過
+                request.priority = priority
+                self._push(request)
+                self._count("promoted")
+                self._dispatch()
+                return
+
+    def _cancel_running(self, future: Future):
+        task = self._tasks.get(future)
+        if task is not None:
+            task.cancel()
+        elif not future.done():
+            # 退避中或等待重試：結束 Future，重新排入佇列時會被略過
+            self._count("cancelled")
+            future.set_exception(CancelledError("LLM 請求已取消"))
+
+    def _requeue(self, request: _Request):
+        """退避時間結束，重新排入佇列"""
+        self._push(request)
+        self._dispatch()
+
+    def _dispatch(self):
+        """在名額與配額允許時依優先順序送出請求"""
+        while self._queue and self._active < self.max_concurrent:
+            _, seq, request = self._queue[0]
+            if request.entry != seq or request.future.done():
+                heapq.heappop(self._queue)
+                continue
+
+            # 斷路器開啟時直接拒絕，不必等待配額
+            if self.breaker.state != OPEN:
+                wait = self._quota_wait(request.tokens)
+                if wait > 0:
+                    self._count("throttled")
+                    self._schedule_wake(wait)
+                    return
+
+            heapq.heappop(self._queue)
+            request.entry = None
+            if request.attempts == 0 and not request.future.set_running_or_notify_cancel():
+                continue
+            if not self.breaker.allow():
+                self._count("circuit_rejected")
+                request.future.set_exception(CircuitOpenError("LLM 服務暫時無法使用"))
+                continue
+            if time.monotonic() >= request.deadline:
+                self._count("budget_exhausted")
+                request.future.set_exception(TimeoutError("LLM 請求已超過時間預算"))
+                continue
+
+            request.attempts += 1
+            self._active += 1
+            self._consume(request.tokens)
+            with self._stats_lock:
+                self._lane_stats[min(request.priority, PRIORITY_BACKGROUND)] += 1
+
+            if request.job is None:
+                request.future.set_result(None)  # reserve()：由呼叫端歸還名額
+            else:
+                self._tasks[request.future] = self._loop.create_task(self._execute(request))
+
+    def _quota_wait(self, tokens: int) -> float:
+        wait = self._paused_until - time.monotonic()
+        if self._request_bucket:
+            wait = max(wait, self._request_bucket.wait_time(1))
+        if self._token_bucket:
+            wait = max(wait, self._token_bucket.wait_time(tokens))
+        return wait
+
+    def _consume(self, tokens: int):
+        if self._request_bucket:
+            self._request_bucket.consume(1)
+        if self._token_bucket:
+            self._token_bucket.consume(tokens)
+
+    def _schedule_wake(self, delay: float):
+        if self._wake_handle is not None:
+            self._wake_handle.cancel()
+        self._wake_handle = self._loop.call_later(delay, self._dispatch)
+
+    def _release(self):
+        self._active -= 1
+        self._dispatch()
+
+    async def _execute(self, request: _Request):
+        try:
+            remaining = request.deadline - time.monotonic()
+            result = await asyncio.wait_for(request.job(), timeout=max(remaining, 0.001))
+        except asyncio.CancelledError:
+            self.breaker.release()
+            if not request.future.done():
+                self._count("cancelled")
+                request.future.set_exception(CancelledError("LLM 請求已取消"))
+            raise
+        except Exception as e:
+            if is_rate_limited(e):
+                self._on_rate_limited()
+            # 只有暫時性故障代表上游不健康；其他錯誤代表上游仍有回應
+            if is_transient(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+            delay = self.retry.next_delay(request.attempts, e, request.deadline - time.monotonic())
+            if delay is not None:
+                # 退避期間不佔用名額，也不阻塞任何執行緒
+                self._count("retried")
+                self.logger.info(f"LLM 請求失敗，{delay:.1f} 秒後重試（第 {request.attempts} 次）: {e}")
+                self._loop.call_later(delay, self._requeue, request)
+            else:
+                self._count("failed")
+                request.future.set_exception(e)
+        else:
+            self.breaker.record_success()
+            if self._token_bucket:
+                self._token_bucket.consume(estimate_tokens(_response_text(result)))
+            self._count("completed")
+            request.future.set_result(result)
+        finally:
+            self._tasks.pop(request.future, None)
+            self._release()
+
+    def _on_rate_limited(self):
+        """上游回報配額不足：清空 bucket 並暫停送出新請求"""
+        self._count("rate_limited")
+        self._paused_until = time.monotonic() + self.rate_limit_cooldown
+        for bucket in (self._request_bucket, self._token_bucket):
+            if bucket:
+                bucket.drain()
+        self.logger.warning(f"LLM 配額不足（429），暫停送出新請求 {self.rate_limit_cooldown} 秒")
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+
+def estimate_tokens(contents: Any) -> int:
+    """
+    粗估內容的 token 數
+
+    中文字約一字一個 token，其他文字約四個字元一個 token，圖片以固定數量計算
+    """
+    parts = contents if isinstance(contents, (list, tuple)) else [contents]
+    total = 0
+    for part in parts:
+        if isinstance(part, str):
+            wide = sum(1 for char in part if ord(char) > 0x2E7F)
+            total += wide + (len(part) - wide) // 4
+        elif part is not None:
+            total += IMAGE_TOKENS
+    return total
+
+
+def _response_text(response: Any) -> str:
+    try:
+        return response.text or ""
+    except Exception:
+        return ""
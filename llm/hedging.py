@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLM 請求對沖模組
+呼叫超過該呼叫類型近期的 p95 延遲仍未返回時，再送出一個相同的請求並採用先完成的結果，
+額外送出的請求數受預算比例限制，避免加重配額壓力
+"""
+
+import logging
+import threading
+from collections import deque
+from typing import Any, Dict, Iterable, Optional
+
+
+class HedgePolicy:
+    """依呼叫類型的近期延遲決定何時送出對沖請求（執行緒安全）"""
+
+    def __init__(self, call_types: Iterable[str], max_share: float = 0.1, percentile: float = 0.95,
+                 min_samples: int = 20, min_delay: float = 1.0, window: int = 200):
+        """
+        初始化對沖策略
+
+        Args:
+            call_types: 啟用對沖的呼叫類型
+            max_share: 對沖請求佔所有請求的比例上限
+            percentile: 以近期延遲的第幾百分位作為對沖門檻
+            min_samples: 累積多少筆延遲後才開始對沖
+            min_delay: 對沖門檻的下限（秒）
+            window: 每種呼叫類型保留的延遲筆數
+        """
+        self.call_types = set(call_types)
+        self.max_share = max_share
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.window = window
+        self.logger = logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, deque] = {}
+        self._stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "over_budget": 0,
+                       "no_capacity": 0, "censored": 0}
+
+    def hedge_after(self, call_type: str) -> Optional[float]:
+        """
+        取得此次請求的對沖門檻
+
+        Args:
+            call_type: 呼叫類型
+
+        Returns:
+            等待多少秒仍未完成就對沖；不對沖時返回 None
+        """
+        if call_type not in self.call_types:
+            return None
+        with self._lock:
+            self._stats["requests"] += 1
+            latencies = self._latencies.get(call_type)
+            if latencies is None or len(latencies) < self.min_samples:
+                return None
+            return max(self.min_delay, self._threshold(latencies))
+
+    def acquire(self) -> bool:
+        """在預算內時佔用一次對沖名額"""
+        with self._lock:
+            if self._stats["hedged"] + 1 > self.max_share * self._stats["requests"]:
+                self._stats["over_budget"] += 1
+                return False
+            self._stats["hedged"] += 1
+            return True
+
+    def refund(self):
+        """歸還 acquire() 佔用的名額（閘道沒有餘裕時不送出對沖請求）"""
+        with self._lock:
+            self._stats["hedged"] -= 1
+            self._stats["no_capacity"] += 1
+
+    def record(self, call_type: str, latency: float, censored: bool = False):
+        """
+        記錄一次呼叫的延遲
+
+        Args:
+            call_type: 呼叫類型
+            latency: 延遲秒數
+            censored: 呼叫在完成前被取消（例如對沖請求先完成），latency 是實際延遲的下限；
+                      仍要計入，否則門檻只反映較快的呼叫而逐漸偏低
+        """
+        if call_type not in self.call_types:
+            return
+        with self._lock:
+            self._latencies.setdefault(call_type, deque(maxlen=self.window)).append(latency)
+            if censored:
+                self._stats["censored"] += 1
+
+    def record_win(self):
+        """對沖請求比原請求先完成"""
+        with self._lock:
+            self._stats["hedge_wins"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """取得對沖統計與各呼叫類型目前的門檻"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["share"] = round(stats["hedged"] / stats["requests"], 4) if stats["requests"] else 0.0
+            stats["thresholds"] = {
+                call_type: round(max(self.min_delay, self._threshold(latencies)), 3)
+                for call_type, latencies in self._latencies.items()
+                if len(latencies) >= self.min_samples
+            }
+        return stats
+
+    def _threshold(self, latencies: deque) -> float:
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLM 呼叫統計模組
+記錄每次 LLM 呼叫的類型、模型、延遲、token、重試次數、快取命中與結果，
+彙整成各呼叫類型的延遲直方圖與用量，並可選擇寫入 JSONL 檔案供離線分析
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from .forksafe import reinit_in_child
+from .resilience import CircuitOpenError, is_rate_limited
+
+# 延遲直方圖的區間上限（秒）
+DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 60)
+
+# 呼叫結果
+OUTCOME_OK = "ok"
+OUTCOME_CACHE_HIT = "cache_hit"
+OUTCOME_ERROR = "error"
+OUTCOME_TIMEOUT = "timeout"
+OUTCOME_RATE_LIMITED = "rate_limited"
+OUTCOME_CIRCUIT_OPEN = "circuit_open"
+OUTCOME_CANCELLED = "cancelled"
+
+
+def outcome_of(error: Optional[BaseException]) -> str:
+    """依例外類型判斷呼叫結果"""
+    if error is None:
+        return OUTCOME_OK
+    if isinstance(error, CircuitOpenError):
+        return OUTCOME_CIRCUIT_OPEN
+    if isinstance(error, concurrent.futures.CancelledError):
+        return OUTCOME_CANCELLED
+    if is_rate_limited(error):
+        return OUTCOME_RATE_LIMITED
+    # Python 3.10 以前 concurrent.futures / asyncio 的 TimeoutError 不是內建 TimeoutError
+    if isinstance(error, (TimeoutError, concurrent.futures.TimeoutError, asyncio.TimeoutError)):
+        return OUTCOME_TIMEOUT
+    return OUTCOME_ERROR
+
+
+class CallInfo:
+    """一次呼叫在執行過程中逐步填入的資訊（由 LLMClient 使用）"""
+
+    __slots__ = ("model", "attempts", "input_tokens", "output_tokens", "hedged", "coalesced")
+
+    def __init__(self):
+        self.model = None
+        self.attempts = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.hedged = False
+        self.coalesced = False
+
+
+class JsonlSink:
+    """在背景執行緒中把呼叫紀錄逐行寫入 JSONL 檔案，佇列滿時捨棄紀錄而不阻塞呼叫端"""
+
+    def __init__(self, path: str, max_queue: int = 10000):
+        """
+        初始化 JSONL 輸出
+
+        Args:
+            path: 輸出檔案路徑（附加寫入）
+            max_queue: 等待寫入的紀錄上限
+        """
+        self.path = path
+        self.dropped = 0
+        self.max_queue = max_queue
+        self._start()
+        # fork 出的工作進程沒有寫入執行緒，在子進程中重建（各進程以附加模式寫入同一個檔案）
+        reinit_in_child(self, "_start")
+
+    def _start(self):
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._thread = threading.Thread(target=self._run, name="llm-metrics-sink", daemon=True)
+        self._thread.start()
+
+    def write(self, record: Dict[str, Any]):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """寫完佇列中的紀錄後停止"""
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+    def _run(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                record = self._queue.get()
+                if record is None:
+                    break
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                if self._queue.empty():
+                    f.flush()
+
+
+class LLMMetrics:
+    """LLM 呼叫統計（執行緒安全）"""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS,
+                 pricing: Optional[Dict[str, Tuple[float, float]]] = None,
+                 sink: Optional[JsonlSink] = None):
+        """
+        初始化呼叫統計
+
+        Args:
+            buckets: 延遲直方圖的區間上限（秒）
+            pricing: 模型名稱 → (每百萬輸入 token 價格, 每百萬輸出 token 價格)，用於估算費用
+            sink: JSONL 輸出，None 時不寫檔
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.pricing = pricing or {}
+        self.sink = sink
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._call_types: Dict[str, Dict[str, Any]] = {}
+        self._models: Dict[str, Dict[str, Any]] = {}
+        self._started = time.time()
+
+    def record(self, call_type: str, latency: float = 0.0, model: Optional[str] = None,
+               input_tokens: int = 0, output_tokens: int = 0, attempts: int = 0,
+               outcome: str = OUTCOME_OK, cache_hit: bool = False, **extra):
+        """
+        記錄一次呼叫
+
+        Args:
+            call_type: 呼叫類型（對話流程的階段）
+            latency: 呼叫端等待的秒數
+            model: 實際使用的模型
+            input_tokens: 輸入 token 數
+            output_tokens: 輸出 token 數
+            attempts: 上游嘗試次數（1 代表沒有重試；合併或快取命中為 0）
+            outcome: 呼叫結果
+            cache_hit: 是否由快取提供
+            **extra: 其他寫入 JSONL 的欄位（例如 coalesced、hedged）
+        """
+        cost = self._cost(model, input_tokens, output_tokens)
+        with self._lock:
+            stats = self._call_types.get(call_type)
+            if stats is None:
+                stats = self._call_types[call_type] = {
+                    "calls": 0, "outcomes": {}, "histogram": [0] * (len(self.buckets) + 1),
+                    "latency_sum": 0.0, "input_tokens": 0, "output_tokens": 0,
+                    "retries": 0, "cache_hits": 0, "cost": 0.0,
+                }
+            stats["calls"] += 1
+            stats["outcomes"][outcome] = stats["outcomes"].get(outcome, 0) + 1
+            stats["histogram"][self._bucket(latency)] += 1
+            stats["latency_sum"] += latency
+            stats["input_tokens"] += input_tokens
+            stats["output_tokens"] += output_tokens
+            stats["retries"] += max(attempts - 1, 0)
+            stats["cache_hits"] += 1 if cache_hit else 0
+            stats["cost"] += cost
+
+            if model and attempts:
+                usage = self._models.setdefault(model, {"calls": 0, "input_tokens": 0,
+                                                        "output_tokens": 0, "cost": 0.0})
+                usage["calls"] += 1
+                usage["input_tokens"] += input_tokens
+                usage["output_tokens"] += output_tokens
+                usage["cost"] += cost
+
+        if self.sink:
+            self.sink.write({
+                "ts": round(time.time(), 3), "call_type": call_type, "model": model,
+                "latency": round(latency, 4), "input_tokens": input_tokens,
+                "output_tokens": output_tokens, "attempts": attempts, "cache_hit": cache_hit,
+                "outcome": outcome, "cost": round(cost, 8), **extra,
+            })
+
+    def record_cache_hit(self, call_type: str, latency: float = 0.0):
+        """記錄由快取提供、沒有呼叫 LLM 的請求"""
+        self.record(call_type, latency, outcome=OUTCOME_CACHE_HIT, cache_hit=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        取得彙整結果
+
+        Returns:
+            各呼叫類型的次數、結果分佈、延遲直方圖與百分位、token、重試、快取命中與估算費用，
+            以及各模型的用量
+        """
+        labels = [f"le_{bound:g}" for bound in self.buckets] + ["inf"]
+        with self._lock:
+            call_types = {}
+            for call_type, stats in self._call_types.items():
+                calls = stats["calls"]
+                call_types[call_type] = {
+                    "calls": calls,
+                    "outcomes": dict(stats["outcomes"]),
+                    "latency": {
+                        "avg": round(stats["latency_sum"] / calls, 4),
+                        "p50": self._percentile(stats["histogram"], calls, 0.5),
+                        "p95": self._percentile(stats["histogram"], calls, 0.95),
+                        "p99": self._percentile(stats["histogram"], calls, 0.99),
+                        "histogram": dict(zip(labels, stats["histogram"])),
+                    },
+                    "input_tokens": stats["input_tokens"],
+                    "output_tokens": stats["output_tokens"],
+                    "retries": stats["retries"],
+                    "cache_hits": stats["cache_hits"],
+                    "cost": round(stats["cost"], 6),
+                }
+            models = {model: {**usage, "cost": round(usage["cost"], 6)} for model, usage in self._models.items()}
+        return {
+            "since": self._started,
+            "call_types": call_types,
+            "models": models,
+            "total_cost": round(sum(stats["cost"] for stats in call_types.values()), 6),
+            "sink_dropped": self.sink.dropped if self.sink else 0,
+        }
+
+    def close(self):
+        """關閉 JSONL 輸出"""
+        if self.sink:
+            self.sink.close()
+
+    def _bucket(self, latency: float) -> int:
+        for index, bound in enumerate(self.buckets):
+            if latency <= bound:
+                return index
+        return len(self.buckets)
+
+    def _percentile(self, histogram, calls: int, ratio: float) -> Optional[float]:
+        """以直方圖估算百分位（返回所在區間的上限，超過最後區間時返回 None）"""
+        target = calls * ratio
+        seen = 0
+        for index, count in enumerate(histogram):
+            seen += count
+            if seen >= target:
+                return self.buckets[index] if index < len(self.buckets) else None
+        return None
+
+    def _cost(self, model: Optional[str], input_tokens: int, output_tokens: int) -> float:
+        prices = self.pricing.get(model) if model else None
+        if not prices:
+            return 0.0
+        return (input_tokens * prices[0] + output_tokens * prices[1]) / 1_000_000
+
+
+def parse_pricing(value: str) -> Dict[str, Tuple[float, float]]:
+    """
+    解析 "model=輸入價格/輸出價格,..." 格式的價格設定（每百萬 token）
+
+    Args:
+        value: 環境變數內容
+
+    Returns:
+        模型名稱 → (輸入價格, 輸出價格)
+    """
+    pricing = {}
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        model, _, prices = item.partition("=")
+        try:
+            input_price, _, output_price = prices.partition("/")
+            pricing[model.strip()] = (float(input_price), float(output_price or input_price))
+        except ValueError:
+            logging.warning(f"忽略無效的價格設定: {item}")
+    return pricing
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+提示詞管理模組
+每種呼叫類型註冊一次系統指示與輸出長度上限，並統計各提示詞的輸入 / 輸出 token 用量
+"""
+
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+from .gateway import estimate_tokens
+
+
+class PromptSpec:
+    """一種呼叫類型的提示詞設定"""
+
+    def __init__(self, name: str, system_instruction: Optional[str] = None,
+                 max_output_tokens: Optional[int] = None):
+        """
+        初始化提示詞設定
+
+        Args:
+            name: 呼叫類型
+            system_instruction: 每次呼叫共用的系統指示（角色、語氣等）
+            max_output_tokens: 輸出 token 上限
+        """
+        self.name = name
+        self.system_instruction = system_instruction
+        self.max_output_tokens = max_output_tokens
+        self.version = hashlib.sha256((system_instruction or "").encode("utf-8")).hexdigest()[:12]
+
+
+class PromptRegistry:
+    """提示詞註冊表與 token 用量統計（執行緒安全）"""
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self._specs: Dict[str, PromptSpec] = {}
+        self._usage: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, system_instruction: Optional[str] = None,
+                 max_output_tokens: Optional[int] = None) -> PromptSpec:
+        """
+        註冊呼叫類型的提示詞設定
+
+        Args:
+            name: 呼叫類型
+            system_instruction: 共用的系統指示
+            max_output_tokens: 輸出 token 上限
+
+        Returns:
+            提示詞設定
+        """
+        spec = PromptSpec(name, system_instruction, max_output_tokens)
+        with self._lock:
+            self._specs[name] = spec
+        self.logger.info(f"註冊提示詞 {name}，輸出上限: {max_output_tokens or '不限'}")
+        return spec
+
+    def get(self, name: str) -> Optional[PromptSpec]:
+        """取得呼叫類型的提示詞設定"""
+        with self._lock:
+            return self._specs.get(name)
+
+    def generation_config(self, name: str,
+                          overrides: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """
+        合併呼叫類型的輸出上限與呼叫端指定的生成設定
+
+        Args:
+            name: 呼叫類型
+            overrides: 呼叫端指定的生成設定，優先於註冊值
+
+        Returns:
+            生成設定，沒有任何設定時返回 None
+        """
+        spec = self.get(name)
+        config = {}
+        if spec and spec.max_output_tokens:
+            config["max_output_tokens"] = spec.max_output_tokens
+        if overrides:
+            config.update(overrides)
+        return config or None
+
+    def record(self, name: str, input_tokens: int, output_tokens: int, truncated: bool = False):
+        """
+        記錄一次呼叫的 token 用量
+
+        Args:
+            name: 呼叫類型
+            input_tokens: 輸入 token 數
+            output_tokens: 輸出 token 數
+            truncated: 輸出是否因達到上限而被截斷
+        """
+        with self._lock:
+            usage = self._usage.setdefault(name, {
+                "calls": 0, "input_tokens": 0, "output_tokens": 0,
+                "max_input_tokens": 0, "max_output_tokens": 0, "truncated": 0,
+            })
+            usage["calls"] += 1
+            usage["input_tokens"] += input_tokens
+            usage["output_tokens"] += output_tokens
+            usage["max_input_tokens"] = max(usage["max_input_tokens"], input_tokens)
+            usage["max_output_tokens"] = max(usage["max_output_tokens"], output_tokens)
+            if truncated:
+                usage["truncated"] += 1
+
+    def report(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        依總 token 用量排序的提示詞報表
+
+        Args:
+            limit: 最多列出幾種呼叫類型
+
+        Returns:
+            用量最高的呼叫類型清單
+        """
+        with self._lock:
+            rows = []
+            for name, usage in self._usage.items():
+                spec = self._specs.get(name)
+                calls = usage["calls"]
+                rows.append({
+                    "name": name,
+                    **usage,
+                    "total_tokens": usage["input_tokens"] + usage["output_tokens"],
+                    "avg_input_tokens": round(usage["input_tokens"] / calls, 1),
+                    "avg_output_tokens": round(usage["output_tokens"] / calls, 1),
+                    "output_limit": spec.max_output_tokens if spec else None,
+                })
+        rows.sort(key=lambda row: row["total_tokens"], reverse=True)
+        return rows[:limit]
+
+
+def response_usage(contents: Any, response: Any) -> Dict[str, Any]:
+    """
+    取得一次呼叫的 token 用量
+
+    SDK 有回傳 usage_metadata 時使用實際數字，否則以字數估算
+
+    Args:
+        contents: 送出的內容
+        response: Gemini 回應
+
+    Returns:
+        {"input_tokens", "output_tokens", "truncated"}
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None and getattr(usage, "prompt_token_count", None):
+        input_tokens = usage.prompt_token_count
+        output_tokens = getattr(usage, "candidates_token_count", 0) or 0
+    else:
+        input_tokens = estimate_tokens(contents)
+        try:
+            output_tokens = estimate_tokens(response.text or "")
+        except Exception:
+            output_tokens = 0
+    return {"input_tokens": input_tokens, "output_tokens": output_tokens,
+            "truncated": _finished_by_max_tokens(response)}
+
+
+def _finished_by_max_tokens(response: Any) -> bool:
+    try:
+        reason = response.candidates[0].finish_reason
+    except Exception:
+        return False
+    return getattr(reason, "name", None) == "MAX_TOKENS" or reason == 2
+
+
+_system_instruction = None
+
+
+def supports_system_instruction() -> bool:
+    """目前安裝的 SDK 是否支援 GenerativeModel(system_instruction=...)"""
+    global _system_instruction
+    if _system_instruction is None:
+        try:
+            import inspect
+            import google.generativeai as genai
+            params = inspect.signature(genai.GenerativeModel.__init__).parameters
+            _system_instruction = "system_instruction" in params
+        except Exception:
+            _system_instruction = False
+    return _system_instruction
+
+
+def parse_output_limits(value: str) -> Dict[str, int]:
+    """
+    解析 "call_type=n,call_type=n" 格式的輸出上限設定
+
+    Args:
+        value: 環境變數內容
+
+    Returns:
+        呼叫類型 → 輸出 token 上限
+    """
+    limits = {}
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        name, _, limit = item.partition("=")
+        try:
+            limits[name.strip()] = int(limit)
+        except ValueError:
+            logging.warning(f"忽略無效的輸出上限設定: {item}")
+    return limits
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLM 容錯模組
+斷路器在上游持續失敗時直接拒絕請求，重試策略以隨機抖動的退避時間排程重試
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+# 斷路器狀態
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """斷路器開啟中，請求未送出"""
+
+
+class CircuitBreaker:
+    """連續失敗達門檻即開啟，冷卻後放行少量試探請求（執行緒安全）"""
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30,
+                 half_open_max: int = 1, probe_timeout: float = 90):
+        """
+        初始化斷路器
+
+        Args:
+            failure_threshold: 連續失敗幾次後開啟
+            recovery_timeout: 開啟後多久放行試探請求（秒）
+            half_open_max: 半開狀態同時放行的試探請求數
+            probe_timeout: 試探請求多久沒有回報結果即視為遺失，重新放行試探請求（秒）
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max = half_open_max
+        self.probe_timeout = probe_timeout
+        self.logger = logging.getLogger(__name__)
+
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+        self._stats = {"opened": 0, "rejected": 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now: float) -> str:
+        if self._state == OPEN and now - self._opened_at >= self.recovery_timeout:
+            self._state = HALF_OPEN
+            self._probes = 0
+        elif (self._state == HALF_OPEN and self._probes
+                and now - self._probe_started >= self.probe_timeout):
+            # 試探請求的結果沒有回報（例如呼叫端中途放棄），不能讓斷路器永遠停在半開
+            self.logger.warning(f"LLM 斷路器試探請求 {self.probe_timeout} 秒未回報結果，重新放行試探請求")
+            self._probes = 0
+        return self._state
+
+    def allow(self) -> bool:
+        """是否可以送出請求；半開狀態下會佔用一個試探名額"""
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and self._probes < self.half_open_max:
+                self._probes += 1
+                self._probe_started = time.monotonic()
+                return True
+            self._stats["rejected"] += 1
+            return False
+
+    def record_success(self):
+        """記錄成功，半開狀態下恢復正常"""
+        with self._lock:
+            if self._state != CLOSED:
+                self.logger.info("LLM 斷路器恢復")
+            self._state = CLOSED
+            self._failures = 0
+
+    def release(self):
+        """歸還未回報結果的試探名額（請求被取消或中途放棄）；已回報結果時不做任何事"""
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes:
+                self._probes -= 1
+
+    def record_failure(self):
+        """記錄上游失敗，達門檻或試探失敗時開啟"""
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or (
+                    self._state == CLOSED and self._failures >= self.failure_threshold):
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._stats["opened"] += 1
+                self.logger.warning(
+                    f"LLM 斷路器開啟，連續失敗 {self._failures} 次，{self.recovery_timeout} 秒內直接拒絕請求"
+                )
+
+    def stats(self) -> Dict[str, object]:
+        """取得斷路器狀態與統計"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["state"] = self._current_state(time.monotonic())
+            stats["failures"] = self._failures
+        return stats
+
+
+class RetryPolicy:
+    """指數退避 + full jitter 的重試策略，並受每個請求的時間預算限制"""
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 1,
+                 max_delay: float = 8, budget: float = 60):
+        """
+        初始化重試策略
+
+        Args:
+            max_attempts: 最多嘗試次數（含第一次）
+            base_delay: 第一次重試的退避上限（秒）
+            max_delay: 退避時間上限（秒）
+            budget: 每個請求從送出到放棄的總秒數
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+
+    def next_delay(self, attempt: int, error: BaseException, remaining: float) -> Optional[float]:
+        """
+        計算下一次重試前的等待秒數
+
+        Args:
+            attempt: 已嘗試次數
+            error: 這次失敗的例外
+            remaining: 剩餘的時間預算（秒）
+
+        Returns:
+            等待秒數；不應重試時返回 None
+        """
+        if attempt >= self.max_attempts or not is_retryable(error):
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        # 至少要留一秒給下一次嘗試，否則重試沒有意義
+        if delay + 1 > remaining:
+            return None
+        return delay
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    """判斷例外是否為上游的配額 / 速率限制錯誤（HTTP 429）"""
+    try:
+        from google.api_core import exceptions as google_exceptions
+        if isinstance(error, google_exceptions.ResourceExhausted):
+            return True
+    except ImportError:
+        pass
+    code = getattr(error, "code", None)
+    if callable(code):
+        try:
+            code = code()
+        except Exception:
+            code = None
+    return code == 429 or getattr(code, "value", None) == 429
+
+
+def is_transient(error: BaseException) -> bool:
+    """判斷是否為上游暫時性故障（逾時、連線失敗、5xx），此類錯誤計入斷路器"""
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    try:
+        from google.api_core import exceptions as google_exceptions
+        if isinstance(error, (google_exceptions.ServerError, google_exceptions.DeadlineExceeded)):
+            return True
+    except ImportError:
+        pass
+    return False
+
+
+def is_retryable(error: BaseException) -> bool:
+    """判斷失敗的請求是否值得重試"""
+    if isinstance(error, CircuitOpenError):
+        return False
+    return is_transient(error) or is_rate_limited(error)
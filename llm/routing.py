@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+模型路由模組
+依呼叫類型選擇模型層級（例如簡短任務使用快速模型、詳細食譜使用完整模型），
+偏好的層級過慢或被限流時改用下一個層級，並記錄路由決策與各層級延遲
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional
+
+from .backends import LLMBackend
+
+DEFAULT_TIER = "default"
+
+
+class ModelTier:
+    """一個模型層級：後端與該層級的生成設定"""
+
+    def __init__(self, name: str, backend: LLMBackend,
+                 generation_config: Optional[Dict[str, Any]] = None):
+        """
+        初始化模型層級
+
+        Args:
+            name: 層級名稱（例如 default、fast）
+            backend: LLM 後端
+            generation_config: 此層級的生成設定（例如 temperature），會被呼叫類型的設定覆寫
+        """
+        self.name = name
+        self.backend = backend
+        self.generation_config = generation_config or {}
+        self.limited_until = 0.0
+        self.slow_until = 0.0
+        self.latencies = deque(maxlen=200)
+        self.calls = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    @property
+    def model_name(self) -> str:
+        """此層級使用的模型名稱"""
+        return getattr(self.backend, "model_name", self.backend.name)
+
+
+class ModelRouter:
+    """呼叫類型 → 模型層級的路由器（執行緒安全）"""
+
+    def __init__(self, tiers: Iterable[ModelTier], routes: Optional[Dict[str, List[str]]] = None,
+                 slow_after: float = 15, cooldown: float = 30):
+        """
+        初始化模型路由器
+
+        Args:
+            tiers: 模型層級，第一個為預設層級
+            routes: 呼叫類型 → 依偏好排序的層級名稱；未列出的呼叫類型使用預設層級
+            slow_after: 單次呼叫超過此秒數即視為該層級過慢
+            cooldown: 層級過慢或被限流後暫停使用的秒數
+        """
+        self.tiers: Dict[str, ModelTier] = {}
+        for tier in tiers:
+            self.tiers[tier.name] = tier
+        if not self.tiers:
+            raise ValueError("至少需要一個模型層級")
+        self.default = next(iter(self.tiers))
+        self.slow_after = slow_after
+        self.cooldown = cooldown
+        self.logger = logging.getLogger(__name__)
+
+        self.routes: Dict[str, List[str]] = {}
+        for call_type, names in (routes or {}).items():
+            valid = [name for name in names if name in self.tiers]
+            if len(valid) != len(names):
+                self.logger.warning(f"路由 {call_type} 含未設定的模型層級，已略過: {names}")
+            if valid:
+                self.routes[call_type] = valid
+
+        self._lock = threading.Lock()
+        self._decisions: Dict[str, Dict[str, int]] = {}
+        self._fallbacks = 0
+
+    @classmethod
+    def single(cls, backend: LLMBackend) -> "ModelRouter":
+        """只有一個層級的路由器（所有呼叫類型使用同一個後端）"""
+        return cls([ModelTier(DEFAULT_TIER, backend)])
+
+    def route(self, call_type: str) -> List[str]:
+        """呼叫類型依偏好排序的層級名稱"""
+        return self.routes.get(call_type, [self.default])
+
+    def choose(self, call_type: str, exclude: Iterable[str] = ()) -> Optional[ModelTier]:
+        """
+        選擇此次呼叫使用的層級
+
+        Args:
+            call_type: 呼叫類型
+            exclude: 這次請求已失敗的層級
+
+        Returns:
+            第一個可用的層級；都在暫停中時返回偏好層級，全部排除時返回 None
+        """
+        candidates = [name for name in self.route(call_type) if name not in exclude]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            chosen = next(
+                (name for name in candidates
+                 if self.tiers[name].limited_until <= now and self.tiers[name].slow_until <= now),
+                candidates[0]
+            )
+            decisions = self._decisions.setdefault(call_type, {})
+            decisions[chosen] = decisions.get(chosen, 0) + 1
+            if chosen != self.route(call_type)[0]:
+                self._fallbacks += 1
+        return self.tiers[chosen]
+
+    def record_success(self, tier: ModelTier, latency: float):
+        """記錄成功呼叫的延遲，超過門檻時暫停使用該層級"""
+        with self._lock:
+            tier.calls += 1
+            tier.latencies.append(latency)
+            if latency > self.slow_after:
+                tier.slow_until = time.monotonic() + self.cooldown
+                self.logger.warning(f"模型層級 {tier.name} 回應過慢（{latency:.1f} 秒），暫時改用其他層級")
+
+    def record_failure(self, tier: ModelTier, latency: float, rate_limited: bool = False):
+        """記錄失敗；被限流或逾時時暫停使用該層級"""
+        with self._lock:
+            tier.calls += 1
+            tier.errors += 1
+            if rate_limited:
+                tier.rate_limited += 1
+                tier.limited_until = time.monotonic() + self.cooldown
+            elif latency > self.slow_after:
+                tier.slow_until = time.monotonic() + self.cooldown
+
+    def record_cancelled(self, tier: ModelTier, latency: float):
+        """記錄被取消的呼叫（超過時間預算或對沖請求已先完成），超過門檻時暫停使用該層級"""
+        if latency > self.slow_after:
+            with self._lock:
+                tier.slow_until = time.monotonic() + self.cooldown
+
+    def stats(self) -> Dict[str, Any]:
+        """取得路由決策與各層級延遲統計"""
+        now = time.monotonic()
+        with self._lock:
+            tiers = {}
+            for name, tier in self.tiers.items():
+                latencies = sorted(tier.latencies)
+                if tier.limited_until > now:
+                    state = "rate_limited"
+                elif tier.slow_until > now:
+                    state = "slow"
+                else:
+                    state = "ok"
+                tiers[name] = {
+                    "model": tier.model_name,
+                    "state": state,
+                    "calls": tier.calls,
+                    "errors": tier.errors,
+                    "rate_limited": tier.rate_limited,
+                    "p50": round(_percentile(latencies, 0.5), 3),
+                    "p95": round(_percentile(latencies, 0.95), 3),
+                }
+            return {
+                "tiers": tiers,
+                "decisions": {call_type: dict(counts) for call_type, counts in self._decisions.items()},
+                "fallbacks": self._fallbacks,
+            }
+
+
+def _percentile(ordered: List[float], ratio: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
+
+
+def parse_routes(value: str) -> Dict[str, List[str]]:
+    """
+    解析 "call_type=tier>tier,call_type=tier" 格式的路由設定
+
+    Args:
+        value: 環境變數內容
+
+    Returns:
+        呼叫類型 → 依偏好排序的層級名稱
+    """
+    routes = {}
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        call_type, _, tiers = item.partition("=")
+        names = [name.strip() for name in tiers.split(">") if name.strip()]
+        if names:
+            routes[call_type.strip()] = names
+    return routes
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Single-flight 模組
+相同鍵值的並行請求只呼叫一次上游，所有呼叫端共用同一個結果
+"""
+
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, CancelledError, Future, TimeoutError, wait
+from typing import Any, Callable, Dict, Optional
+
+from .cancel import CancelToken
+from .forksafe import reinit_in_child
+
+
+class SingleFlight:
+    """合併相同鍵值的進行中請求"""
+
+    def __init__(self):
+        """初始化 single-flight"""
+        self.logger = logging.getLogger(__name__)
+        self._in_flight: Dict[str, Future] = {}
+        self._waiters: Dict[str, int] = {}  # 仍在等待各請求結果的呼叫端數
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "shared": 0}
+        reinit_in_child(self, "_after_fork")
+
+    def _after_fork(self):
+        """fork 出的子進程不會收到父進程進行中請求的結果，不能合併到這些請求"""
+        self._in_flight = {}
+        self._waiters = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, start: Callable[[], Future], timeout: float = None,
+           on_join: Optional[Callable[[Future], None]] = None,
+           cancel: Optional[CancelToken] = None,
+           on_abandon: Optional[Callable[[Future], None]] = None) -> Any:
+        """
+        執行請求；相同 key 已有請求進行中時直接等待它的結果
+
+        Args:
+            key: 請求鍵值（例如提示詞雜湊）
+            start: 送出上游請求並返回 Future 的函數
+            timeout: 此呼叫端最多等待秒數，逾時拋出 concurrent.futures.TimeoutError
+            on_join: 合併到進行中請求時呼叫（例如提高該請求的優先順序）
+            cancel: 取消權杖，取消時此呼叫端不再等待並拋出 concurrent.futures.CancelledError
+            on_abandon: 被取消的呼叫端是最後一個等待者時呼叫（例如中止上游請求）
+
+        Returns:
+            上游回應；上游失敗時所有等待者都會收到同一個例外
+        """
+        if cancel is not None and cancel.cancelled:
+            raise CancelledError("LLM 呼叫已取消")
+
+        leader = False
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is None:
+                future = start()
+                self._in_flight[key] = future
+                self._waiters[key] = 0
+                self._stats["calls"] += 1
+                leader = True
+            else:
+                self._stats["shared"] += 1
+                self.logger.info(f"合併進行中的 LLM 請求: {key[:12]}")
+            self._waiters[key] += 1
+
+        # 在鎖外註冊：若請求已完成，callback 會立即在此執行緒執行
+        if leader:
+            future.add_done_callback(lambda done: self._forget(key, done))
+        elif on_join:
+            on_join(future)
+
+        if cancel is None:
+            try:
+                # 每個呼叫端各自逾時，不會因為上游卡住而永久等待
+                return future.result(timeout=timeout)
+            finally:
+                self._leave(key, future)
+
+        stopped = Future()
+        remove = cancel.on_cancel(lambda: stopped.done() or stopped.set_result(None))
+        try:
+            done, _ = wait([future, stopped], timeout=timeout, return_when=FIRST_COMPLETED)
+            if future in done:
+                return future.result()
+            if not done:
+                raise TimeoutError()
+        finally:
+            remove()
+            last = self._leave(key, future)
+        if last and not future.done() and on_abandon is not None:
+            # 沒有其他呼叫端需要這個結果，不必再等上游完成
+            on_abandon(future)
+        raise CancelledError("LLM 呼叫已取消")
+
+    def _leave(self, key: str, future: Future) -> bool:
+        """呼叫端不再等待，返回是否為最後一個等待者"""
+        with self._lock:
+            if self._in_flight.get(key) is not future:
+                return True
+            self._waiters[key] -= 1
+            return self._waiters[key] <= 0
+
+    def _forget(self, key: str, future: Future):
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+                del self._waiters[key]
+
+    def stats(self) -> Dict[str, int]:
+        """取得合併統計"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._in_flight)
+        return stats
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+串流 JSON 解析模組
+逐段讀入 LLM 串流回應，指定陣列中的物件一完整就立即輸出，不必等整個回應結束
+"""
+
+import json
+import logging
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+
+class IncrementalArrayParser:
+    """從串流文字中逐一取出指定陣列的完整 JSON 物件"""
+
+    def __init__(self, array_key: Optional[str] = "recommendations"):
+        """
+        初始化解析器
+
+        Args:
+            array_key: 要讀取的陣列欄位名稱；None 時使用第一個出現的陣列
+        """
+        self.array_key = array_key
+        self.logger = logging.getLogger(__name__)
+
+        self._buffer = ""
+        self._pos = 0             # 下一個要掃描的位置
+        self._in_array = False    # 是否已進入目標陣列
+        self._done = False        # 目標陣列已結束
+        self._depth = 0           # 目標陣列內的物件巢狀層數
+        self._object_start = -1
+        self._in_string = False
+        self._escape = False
+        self.errors = 0
+
+    @property
+    def done(self) -> bool:
+        """目標陣列是否已讀取完畢"""
+        return self._done
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        """
+        讀入一段文字
+
+        Args:
+            text: 串流回應的新片段
+
+        Returns:
+            這段文字讀入後新完成的物件清單
+        """
+        if self._done or not text:
+            return []
+        self._buffer += text
+        if not self._in_array and not self._find_array():
+            return []
+        return self._scan()
+
+    def _find_array(self) -> bool:
+        """尋找目標陣列的開頭（略過 ```json 等前綴）"""
+        if self.array_key is None:
+            start = self._buffer.find("[")
+        else:
+            key_pos = self._buffer.find(f'"{self.array_key}"')
+            if key_pos < 0:
+                return False
+            start = self._buffer.find("[", key_pos)
+        if start < 0:
+            return False
+        self._in_array = True
+        self._pos = start + 1
+        return True
+
+    def _scan(self) -> List[Dict[str, Any]]:
+        objects = []
+        buffer = self._buffer
+        i = self._pos
+        while i < len(buffer):
+            char = buffer[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                if self._depth == 0:
+                    self._object_start = i
+                self._depth += 1
+            elif char == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    obj = self._decode(buffer[self._object_start:i + 1])
+                    if obj is not None:
+                        objects.append(obj)
+                    self._object_start = -1
+            elif char == "]" and self._depth == 0:
+                self._done = True
+                i += 1
+                break
+            i += 1
+
+        # 已輸出的內容不再需要，只保留未完成的物件
+        keep_from = self._object_start if self._object_start >= 0 else i
+        self._buffer = buffer[keep_from:]
+        if self._object_start >= 0:
+            self._object_start = 0
+        self._pos = i - keep_from
+        return objects
+
+    def _decode(self, text: str) -> Optional[Dict[str, Any]]:
+        try:
+            obj = json.loads(text)
+        except json.JSONDecodeError as e:
+            self.errors += 1
+            self.logger.warning(f"串流物件解析失敗: {e}")
+            return None
+        return obj if isinstance(obj, dict) else None
+
+
+def iter_array_objects(chunks: Iterable[str], array_key: Optional[str] = "recommendations") -> Iterator[Dict[str, Any]]:
+    """
+    從文字片段序列中逐一產生陣列物件
+
+    Args:
+        chunks: 串流回應的文字片段
+        array_key: 要讀取的陣列欄位名稱
+
+    Yields:
+        每個完整的 JSON 物件
+    """
+    parser = IncrementalArrayParser(array_key)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+        if parser.done:
+            return
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+結構化輸出模組
+以宣告的 schema 解析、驗證並在本地修復 LLM 的 JSON 回應，避免因格式小錯誤而重新呼叫 LLM
+"""
+
+import json
+import logging
+import re
+import threading
+from typing import Any, Dict, List, Optional
+
+
+class StructuredOutputError(ValueError):
+    """回應無法解析或不符合 schema"""
+
+
+# --- Schema 定義（JSON Schema 的子集：type、properties、required、items、minItems、additionalProperties） ---
+
+STRING = {"type": "string"}
+STRING_LIST = {"type": "array", "items": STRING}
+
+RECIPE_DETAILS_SCHEMA = {
+    "type": "object",
+    "required": ["steps"],
+    "properties": {
+        "name": STRING,
+        "ingredients": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "required": ["name"],
+                "properties": {"name": STRING, "amount": STRING, "note": STRING},
+            },
+        },
+        "time": STRING,
+        "difficulty": STRING,
+        "steps": {"type": "array", "items": STRING, "minItems": 1},
+        "tips": STRING,
+        "nutrition": STRING,
+    },
+}
+
+RECIPE_CARD_SCHEMA = {
+    "type": "object",
+    "required": ["name"],
+    "properties": {
+        "name": STRING,
+        "ingredients": STRING_LIST,
+        "time": STRING,
+        "difficulty": STRING,
+        "description": STRING,
+        # combined 模式才會有，格式不符時直接捨棄
+        "details": {
+            "type": "object",
+            "required": ["steps"],
+            "properties": {
+                "ingredients": RECIPE_DETAILS_SCHEMA["properties"]["ingredients"],
+                "steps": {"type": "array", "items": STRING, "minItems": 1},
+                "tips": STRING,
+                "nutrition": STRING,
+            },
+        },
+    },
+}
+
+RECOMMENDATIONS_SCHEMA = {
+    "type": "object",
+    "required": ["recommendations"],
+    "properties": {
+        "recommendations": {"type": "array", "items": RECIPE_CARD_SCHEMA, "minItems": 1},
+    },
+}
+
+SUBSTITUTIONS_SCHEMA = {
+    "type": "object",
+    "required": ["substitutions"],
+    "properties": {
+        "substitutions": {"type": "object", "additionalProperties": STRING_LIST},
+        "notes": STRING,
+    },
+}
+
+
+class OutputSchema:
+    """具名的輸出 schema，負責解析、修復、驗證並記錄解析失敗率"""
+
+    def __init__(self, name: str, schema: Dict[str, Any]):
+        """
+        初始化輸出 schema
+
+        Args:
+            name: schema 名稱（統計用）
+            schema: JSON Schema 子集
+        """
+        self.name = name
+        self.schema = schema
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._stats = {"parsed": 0, "clean": 0, "repaired": 0, "failed": 0}
+
+    def generation_config(self) -> Optional[Dict[str, Any]]:
+        """支援 JSON 模式的 SDK 版本返回對應的生成設定，否則返回 None（改由提示詞說明格式）"""
+        return {"response_mime_type": "application/json"} if supports_json_mode() else None
+
+    def parse(self, text: Optional[str]) -> Any:
+        """
+        解析並驗證 LLM 回應
+
+        Args:
+            text: LLM 回應文字
+
+        Returns:
+            符合 schema 的資料
+
+        Raises:
+            StructuredOutputError: 修復後仍無法解析或缺少必要欄位
+        """
+        repairs = []
+        try:
+            data = loads_lenient(text or "", repairs)
+            data = coerce(data, self.schema, "$", repairs)
+        except StructuredOutputError as e:
+            self._count("failed")
+            self.logger.warning(f"結構化輸出解析失敗 ({self.name}): {e}")
+            raise
+
+        self._count("repaired" if repairs else "clean")
+        if repairs:
+            self.logger.info(f"結構化輸出已在本地修復 ({self.name}): {'; '.join(repairs[:5])}")
+        return data
+
+    def stats(self) -> Dict[str, Any]:
+        """取得解析統計"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["failure_rate"] = round(stats["failed"] / stats["parsed"], 4) if stats["parsed"] else 0.0
+        return stats
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats["parsed"] += 1
+            self._stats[name] += 1
+
+
+RECOMMENDATIONS = OutputSchema("recommendations", RECOMMENDATIONS_SCHEMA)
+RECIPE_DETAILS = OutputSchema("recipe_details", RECIPE_DETAILS_SCHEMA)
+SUBSTITUTIONS = OutputSchema("substitutions", SUBSTITUTIONS_SCHEMA)
+
+
+def structured_stats() -> Dict[str, Dict[str, Any]]:
+    """取得所有輸出 schema 的解析統計"""
+    return {schema.name: schema.stats() for schema in (RECOMMENDATIONS, RECIPE_DETAILS, SUBSTITUTIONS)}
+
+
+def generate_structured(llm_client, prompt: str, output_schema: OutputSchema,
+                        call_type: str, **kwargs) -> Any:
+    """
+    呼叫 LLM 並依 schema 解析回應
+
+    Args:
+        llm_client: LLMClient 實例
+        prompt: 提示詞（需說明 JSON 格式）
+        output_schema: 輸出 schema
+        call_type: 呼叫類型
+        **kwargs: 傳給 llm_client.generate_content 的其他參數
+
+    Returns:
+        符合 schema 的資料
+
+    Raises:
+        StructuredOutputError: 回應無法解析
+    """
+    response = llm_client.generate_content(
+        prompt, call_type=call_type, generation_config=output_schema.generation_config(), **kwargs
+    )
+    try:
+        text = response.text if response else None
+    except ValueError:
+        text = None  # 回應被安全性過濾，沒有文字內容
+    if not text:
+        output_schema._count("failed")
+        raise StructuredOutputError("LLM 沒有返回有效回應")
+    return output_schema.parse(text)
+
+
+_json_mode = None
+
+
+def supports_json_mode() -> bool:
+    """目前安裝的 SDK 是否支援 response_mime_type（JSON 模式）"""
+    global _json_mode
+    if _json_mode is None:
+        try:
+            import google.ai.generativelanguage as glm
+            fields = glm.GenerationConfig.pb().DESCRIPTOR.fields_by_name
+            _json_mode = "response_mime_type" in fields
+        except Exception:
+            _json_mode = False
+    return _json_mode
+
+
+# --- 解析與修復 ---
+
+_FENCE = re.compile(r"^```[a-zA-Z]*\s*|\s*```$")
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+
+
+def loads_lenient(text: str, repairs: List[str]) -> Any:
+    """
+    解析 JSON，失敗時依序嘗試本地修復
+
+    修復項目：移除 ``` 標記與前後說明文字、移除多餘逗號、補上被截斷的括號與引號
+
+    Args:
+        text: LLM 回應文字
+        repairs: 記錄套用過的修復
+
+    Returns:
+        解析結果
+    """
+    stripped = _FENCE.sub("", text.strip()).strip()
+    try:
+        return json.loads(stripped)
+    except json.JSONDecodeError:
+        pass
+
+    candidate = _extract_json(stripped)
+    if candidate is None:
+        raise StructuredOutputError("回應中沒有 JSON 內容")
+    if candidate != stripped:
+        repairs.append("移除 JSON 前的文字")
+
+    attempts = [
+        ("", candidate),
+        ("移除多餘逗號", _TRAILING_COMMA.sub(r"\1", candidate)),
+    ]
+    closed = _close_truncated(attempts[-1][1])
+    if closed != attempts[-1][1]:
+        attempts.append(("補上截斷的結尾", closed))
+
+    decoder = json.JSONDecoder()
+    error = None
+    for repair, attempt in attempts:
+        try:
+            # raw_decode 只讀取第一個 JSON 值，忽略後面的說明文字
+            data, end = decoder.raw_decode(attempt)
+        except json.JSONDecodeError as e:
+            error = e
+            continue
+        if repair:
+            repairs.append(repair)
+        if attempt[end:].strip():
+            repairs.append("移除 JSON 後的文字")
+        return data
+    raise StructuredOutputError(f"JSON 解析失敗: {error}")
+
+
+def _extract_json(text: str) -> Optional[str]:
+    """取出第一個 { 或 [ 開始的內容"""
+    starts = [pos for pos in (text.find("{"), text.find("[")) if pos >= 0]
+    if not starts:
+        return None
+    return text[min(starts):]
+
+
+def _close_truncated(text: str) -> str:
+    """回應被截斷時（例如超過輸出上限）補上未關閉的字串與括號"""
+    stack = []
+    in_string = False
+    escape = False
+    last_complete = 0  # 最後一個完整值結束的位置
+    value_string = False  # 目前的字串是值（而非物件的鍵）
+    expect_value = False
+    for i, char in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+                if value_string:
+                    last_complete = i + 1
+            continue
+        if char == '"':
+            in_string = True
+            value_string = expect_value or (stack and stack[-1] == "]")
+            expect_value = False
+        elif char == ":":
+            expect_value = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]":
+            if stack:
+                stack.pop()
+            last_complete = i + 1
+        elif char == ",":
+            last_complete = i
+
+    if not stack and not in_string:
+        return text
+    # 捨棄最後一個不完整的項目，再補上結尾
+    body = text[:last_complete].rstrip().rstrip(",")
+    closers = []
+    in_string = False
+    escape = False
+    for char in body:
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+        elif char in "}]" and closers:
+            closers.pop()
+    return body + "".join(reversed(closers))
+
+
+# --- 驗證與型別修正 ---
+
+_BULLET = re.compile(r"^\s*(?:[-•*]|\d+[.、)）])\s*")
+
+
+def coerce(value: Any, schema: Dict[str, Any], path: str = "$",
+           repairs: Optional[List[str]] = None) -> Any:
+    """
+    依 schema 驗證資料，並修正常見的型別偏差
+
+    Args:
+        value: 解析後的資料
+        schema: JSON Schema 子集
+        path: 目前位置（錯誤訊息用）
+        repairs: 記錄套用過的修正
+
+    Returns:
+        符合 schema 的資料
+
+    Raises:
+        StructuredOutputError: 無法修正
+    """
+    if repairs is None:
+        repairs = []
+    expected = schema.get("type")
+
+    if expected == "string":
+        if isinstance(value, str):
+            return value
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            repairs.append(f"{path} 轉為字串")
+            return str(value)
+        if isinstance(value, list) and all(isinstance(item, str) for item in value):
+            repairs.append(f"{path} 清單合併為字串")
+            return "\n".join(value)
+        raise StructuredOutputError(f"{path} 應為字串")
+
+    if expected == "array":
+        if isinstance(value, str) and schema.get("items", {}).get("type") == "string":
+            repairs.append(f"{path} 字串拆成清單")
+            value = [_BULLET.sub("", line).strip() for line in value.splitlines() if line.strip()]
+        elif isinstance(value, dict):
+            repairs.append(f"{path} 物件包成清單")
+            value = [value]
+        if not isinstance(value, list):
+            raise StructuredOutputError(f"{path} 應為清單")
+
+        items = []
+        item_schema = schema.get("items", {})
+        for index, item in enumerate(value):
+            try:
+                items.append(coerce(item, item_schema, f"{path}[{index}]", repairs))
+            except StructuredOutputError as e:
+                repairs.append(f"捨棄無效項目 {path}[{index}]（{e}）")
+        if len(items) < schema.get("minItems", 0):
+            raise StructuredOutputError(f"{path} 至少需要 {schema['minItems']} 個有效項目")
+        return items
+
+    if expected == "object":
+        properties = schema.get("properties", {})
+        required = schema.get("required", [])
+        if isinstance(value, str) and required and properties.get(required[0]) == STRING:
+            # 例如食材只寫成 "雞蛋 2顆"，當作第一個必要欄位
+            repairs.append(f"{path} 字串轉為物件")
+            value = {required[0]: value}
+        if not isinstance(value, dict):
+            raise StructuredOutputError(f"{path} 應為物件")
+
+        result = {}
+        extra_schema = schema.get("additionalProperties")
+        for key, item in value.items():
+            if key in properties:
+                try:
+                    result[key] = coerce(item, properties[key], f"{path}.{key}", repairs)
+                except StructuredOutputError as e:
+                    if key in required:
+                        raise
+                    repairs.append(f"捨棄欄位 {path}.{key}（{e}）")
+            elif extra_schema is not None:
+                try:
+                    result[key] = coerce(item, extra_schema, f"{path}.{key}", repairs)
+                except StructuredOutputError as e:
+                    repairs.append(f"捨棄欄位 {path}.{key}（{e}）")
+            else:
+                result[key] = item
+
+        for key in required:
+            if key not in result or result[key] in ("", None):
+                raise StructuredOutputError(f"{path} 缺少必要欄位 {key}")
+        return result
+
+    return value
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+非同步日誌模組
+請求執行緒只把紀錄放進佇列，由背景執行緒寫入 JSON 格式、依大小輪替的日誌檔；
+多進程工作池的子進程透過跨進程佇列把紀錄交給主進程寫入
+"""
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+import sys
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Optional
+
+# 目前處理中的事件（由背景工作執行緒設定）
+_event_id = contextvars.ContextVar("log_event_id", default=None)
+_user_id = contextvars.ContextVar("log_user_id", default=None)
+_debug_sampled = contextvars.ContextVar("log_debug_sampled", default=False)
+
+# 第三方套件的 DEBUG 日誌量太大，不參與抽樣
+NOISY_LOGGERS = ["urllib3", "PIL", "grpc", "google", "werkzeug", "asyncio"]
+
+_listener = None
+_queue_handler = None
+_handlers = []
+_level = logging.INFO
+_queue_size = 10000
+_process_queue = None
+_process_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """將日誌紀錄轉成單行 JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        event_id = getattr(record, "event_id", None)
+        if event_id:
+            entry["event_id"] = event_id
+        user_id = getattr(record, "user_id", None)
+        if user_id:
+            entry["user_id"] = user_id
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class EventContextFilter(logging.Filter):
+    """附加事件資訊，並依抽樣結果決定是否保留 DEBUG 紀錄"""
+
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # 必須在呼叫端執行緒讀取 contextvars，進入佇列後就拿不到了
+        record.event_id = _event_id.get()
+        record.user_id = _user_id.get()
+
+        if record.levelno > logging.DEBUG or self.sample_rate >= 1:
+            return True
+        return _debug_sampled.get()
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """佇列滿時直接丟棄紀錄，不讓請求執行緒等待"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(log_file: str = "momshero_llm_ui.log", level: int = logging.INFO,
+                  max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5,
+                  json_format: bool = True, echo_stdout: bool = False,
+                  debug_sample_rate: float = 0.0, queue_size: int = 10000):
+    """
+    設定全域非同步日誌
+
+    Args:
+        log_file: 日誌檔路徑
+        level: 一般日誌等級
+        max_bytes: 單一日誌檔大小上限，超過即輪替
+        backup_count: 保留的舊日誌檔數量
+        json_format: 是否輸出 JSON 格式
+        echo_stdout: 是否同時輸出到 stdout
+        debug_sample_rate: 事件的 DEBUG 詳細日誌抽樣比例（0 ~ 1）
+        queue_size: 日誌佇列大小
+    """
+    global _listener, _queue_handler, _handlers, _level, _queue_size
+
+    if json_format:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+    )
+    file_handler.setFormatter(formatter)
+    handlers = [file_handler]
+
+    if echo_stdout:
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        handlers.append(stream_handler)
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    _queue_handler = NonBlockingQueueHandler(log_queue)
+    _queue_handler.addFilter(EventContextFilter(debug_sample_rate))
+
+    _install(_queue_handler, level, debug_sample_rate)
+    _handlers, _level, _queue_size = handlers, level, queue_size
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def _install(queue_handler: logging.Handler, level: int, debug_sample_rate: float):
+    """以佇列處理器取代根 logger 原有的處理器"""
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(logging.DEBUG if debug_sample_rate > 0 else level)
+    for name in NOISY_LOGGERS:
+        logging.getLogger(name).setLevel(max(level, logging.INFO))
+
+
+def worker_logging_args() -> tuple:
+    """
+    取得多進程工作池 initializer（init_worker_logging）的參數
+
+    第一次呼叫時建立跨進程佇列，並在主進程啟動寫入執行緒，寫到與 setup_logging 相同的目的地
+
+    Returns:
+        (跨進程佇列, 日誌等級, DEBUG 抽樣比例)
+    """
+    global _process_queue, _process_listener
+    if _process_queue is None:
+        _process_queue = multiprocessing.Queue(maxsize=_queue_size)
+        _process_listener = logging.handlers.QueueListener(
+            _process_queue, *_handlers, respect_handler_level=True
+        )
+        _process_listener.start()
+    return _process_queue, _level, _configured_sample_rate()
+
+
+def init_worker_logging(log_queue, level: int = logging.INFO, debug_sample_rate: float = 0.0):
+    """
+    在工作池子進程中設定日誌，紀錄送回主進程寫入
+
+    子進程繼承（fork）或重新建立的佇列沒有對應的寫入執行緒，必須改用主進程的跨進程佇列
+
+    Args:
+        log_queue: worker_logging_args() 返回的跨進程佇列
+        level: 一般日誌等級
+        debug_sample_rate: 事件的 DEBUG 詳細日誌抽樣比例
+    """
+    global _listener, _queue_handler
+    _listener = None  # fork 時複製的寫入執行緒物件在子進程中沒有作用
+    _queue_handler = NonBlockingQueueHandler(log_queue)
+    _queue_handler.addFilter(EventContextFilter(debug_sample_rate))
+    _install(_queue_handler, level, debug_sample_rate)
+
+
+def shutdown_logging():
+    """停止背景寫入執行緒並寫完佇列中的紀錄"""
+    global _listener, _process_listener
+    if _process_listener is not None:
+        _process_listener.stop()
+        _process_listener = None
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def dropped_records() -> int:
+    """因佇列已滿而丟棄的紀錄數"""
+    return _queue_handler.dropped if _queue_handler else 0
+
+
+@contextmanager
+def event_log_context(event_id: Optional[str], user_id: Optional[str] = None,
+                      sample_rate: Optional[float] = None):
+    """
+    在事件處理期間附加事件資訊到日誌，並決定此事件是否輸出 DEBUG 詳細日誌
+
+    Args:
+        event_id: webhookEventId
+        user_id: 用戶 ID
+        sample_rate: 抽樣比例，None 時使用 setup_logging 的設定
+    """
+    if sample_rate is None:
+        sample_rate = _configured_sample_rate()
+    # 以事件 ID 決定抽樣，同一事件（含重送）的結果一致
+    sampled = bool(event_id) and zlib.crc32(event_id.encode("utf-8")) % 10000 < sample_rate * 10000
+
+    tokens = (_event_id.set(event_id), _user_id.set(user_id), _debug_sampled.set(sampled))
+    try:
+        yield
+    finally:
+        _debug_sampled.reset(tokens[2])
+        _user_id.reset(tokens[1])
+        _event_id.reset(tokens[0])
+
+
+def _configured_sample_rate() -> float:
+    if _queue_handler is None:
+        return 0.0
+    for log_filter in _queue_handler.filters:
+        if isinstance(log_filter, EventContextFilter):
+            return log_filter.sample_rate
+    return 0.0
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+連續訊息合併模組
+用戶連續送出的短訊息（例如「雞蛋」「蔥」「白飯」）在短暫的等待時間內合併成一次處理，只呼叫一次 LLM 推薦；
+合併處理中又收到新訊息時取消目前的處理，把訊息放回佇列與新訊息一起重新處理。
+「重新開始」「我要做…」等指令不合併，並作為前後訊息的分界
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional
+
+from llm import CancelToken
+
+
+class _Entry:
+    """一則已到達、尚未處理的訊息"""
+
+    __slots__ = ("message_id", "text", "mergeable", "arrived_at")
+
+    def __init__(self, message_id: str, text: str, mergeable: bool):
+        self.message_id = message_id
+        self.text = text
+        self.mergeable = mergeable
+        self.arrived_at = time.monotonic()
+
+
+class Batch:
+    """一次合併處理的訊息"""
+
+    def __init__(self, user_id: str, entries: List[_Entry], joiner: str):
+        self.user_id = user_id
+        self.entries = entries
+        self.text = joiner.join(entry.text for entry in entries)
+        self.mergeable = entries[0].mergeable
+        # 處理中收到新訊息時取消，結果不再回覆，進行中的 LLM 呼叫也一併取消
+        self.cancel_token = CancelToken()
+        self.started_at = time.monotonic()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_token.cancelled
+
+
+class _UserSlot:
+    __slots__ = ("pending", "running")
+
+    def __init__(self):
+        self.pending = deque()  # 依到達順序排列的 _Entry
+        self.running: Optional[Batch] = None
+
+
+class MessageCoalescer:
+    """依用戶合併連續訊息（執行緒安全）"""
+
+    def __init__(self, window: float = 1.0, max_wait: float = 4.0, joiner: str = "\n",
+                 max_running: float = 120.0):
+        """
+        初始化訊息合併器
+
+        Args:
+            window: 最後一則訊息到達後再等待多少秒，期間收到的訊息一起處理
+            max_wait: 第一則訊息最多等待的秒數
+            joiner: 合併訊息時使用的分隔字串
+            max_running: 批次處理超過此秒數仍未呼叫 finish() 時視為已中斷，不再阻擋同一用戶的後續訊息
+        """
+        self.window = window
+        self.max_wait = max_wait
+        self.joiner = joiner
+        self.max_running = max_running
+        self.logger = logging.getLogger(__name__)
+
+        self._cond = threading.Condition()
+        self._slots: Dict[str, _UserSlot] = {}
+        self._consumed = OrderedDict()  # 最近已開始處理的訊息 ID
+        self._stats = {"messages": 0, "batches": 0, "merged": 0, "cancelled": 0, "max_batch": 0,
+                       "abandoned": 0}
+
+    def arrive(self, user_id: str, message_id: str, text: str, mergeable: bool = True):
+        """
+        記錄訊息到達（在 webhook 收到事件時依順序呼叫，早於事件處理）
+
+        Args:
+            user_id: LINE 用戶 ID
+            message_id: 訊息 ID
+            text: 訊息內容
+            mergeable: 是否可與前後訊息合併（指令類訊息為 False）
+        """
+        with self._cond:
+            slot = self._slots.setdefault(user_id, _UserSlot())
+            slot.pending.append(_Entry(message_id, text, mergeable))
+            self._stats["messages"] += 1
+
+            running = slot.running
+            if (mergeable and running is not None and running.mergeable and not running.cancelled
+                    and all(entry.mergeable for entry in slot.pending)):
+                # 處理中的訊息與新訊息之間沒有指令：取消目前的處理，稍後一起重新處理
+                running.cancel_token.cancel()  # 同時中止進行中的 LLM 呼叫
+                self._stats["cancelled"] += 1
+                self.logger.info(f"用戶 {user_id} 在處理中送出新訊息，取消目前的處理並與新訊息合併")
+            self._cond.notify_all()
+
+    def take(self, user_id: str, message_id: str, text: str, mergeable: bool = True) -> Optional[Batch]:
+        """
+        取得這則訊息所屬的批次，等待時間內收到的後續訊息一起併入
+
+        Args:
+            user_id: LINE 用戶 ID
+            message_id: 訊息 ID
+            text: 訊息內容（沒有經過 arrive() 記錄時使用）
+            mergeable: 是否可與前後訊息合併
+
+        Returns:
+            要處理的批次；訊息已被前面的批次合併處理時返回 None
+        """
+        with self._cond:
+            while True:
+                slot = self._slots.get(user_id)
+                if slot is None or not any(entry.message_id == message_id for entry in slot.pending):
+                    if message_id in self._consumed:
+                        return None
+                    # 沒有記錄到達時間的訊息，從現在開始計算等待時間
+                    slot = self._slots.setdefault(user_id, _UserSlot())
+                    slot.pending.append(_Entry(message_id, text, mergeable))
+                    self._stats["messages"] += 1
+
+                run = self._leading_run(slot.pending)
+                if not any(entry.message_id == message_id for entry in run):
+                    run = [entry for entry in slot.pending if entry.message_id == message_id]
+                now = time.monotonic()
+                if slot.running is not None and now - slot.running.started_at >= self.max_running:
+                    self._abandon(slot)
+                if run[0].mergeable and len(run) == len(slot.pending):
+                    deadline = min(run[-1].arrived_at + self.window, run[0].arrived_at + self.max_wait)
+                else:
+                    deadline = now  # 後面已有指令，不必再等待
+
+                if slot.running is None and now >= deadline:
+                    for entry in run:
+                        slot.pending.remove(entry)
+                        self._consumed[entry.message_id] = True
+                    while len(self._consumed) > 10000:
+                        self._consumed.popitem(last=False)
+                    batch = Batch(user_id, run, self.joiner)
+                    slot.running = batch
+                    self._stats["batches"] += 1
+                    self._stats["merged"] += len(run) - 1
+                    self._stats["max_batch"] = max(self._stats["max_batch"], len(run))
+                    if len(run) > 1:
+                        self.logger.info(f"合併用戶 {user_id} 的 {len(run)} 則訊息: {batch.text!r}")
+                    return batch
+                if slot.running is not None:
+                    deadline = max(deadline, slot.running.started_at + self.max_running)
+                self._cond.wait(max(deadline - now, 0.001))
+
+    def finish(self, batch: Batch) -> bool:
+        """
+        結束批次處理
+
+        Args:
+            batch: take() 返回的批次
+
+        Returns:
+            是否應回覆結果；被新訊息取消時返回 False，訊息放回佇列由新訊息的處理一起完成
+        """
+        with self._cond:
+            slot = self._slots.get(batch.user_id)
+            if slot is None or slot.running is not batch:
+                return not batch.cancelled  # 已被視為中斷，後續訊息已繼續處理
+            slot.running = None
+            if batch.cancelled:
+                slot.pending.extendleft(reversed(batch.entries))
+            elif not slot.pending:
+                del self._slots[batch.user_id]
+            self._cond.notify_all()
+            return not batch.cancelled
+
+    def is_cancelled(self, user_id: str) -> bool:
+        """用戶目前處理中的批次是否已被新訊息取消"""
+        with self._cond:
+            slot = self._slots.get(user_id)
+            return bool(slot and slot.running and slot.running.cancelled)
+
+    def stats(self) -> Dict[str, Any]:
+        """取得合併與取消統計"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats["pending_users"] = len(self._slots)
+        return stats
+
+    def _abandon(self, slot: _UserSlot):
+        """處理太久沒有結束的批次（例如處理函數在 finish() 前中斷）：釋放用戶，被取消的訊息放回佇列"""
+        batch = slot.running
+        slot.running = None
+        if batch.cancelled:
+            slot.pending.extendleft(reversed(batch.entries))
+        self._stats["abandoned"] += 1
+        self.logger.warning(f"用戶 {batch.user_id} 的訊息處理超過 {self.max_running:g} 秒未結束，繼續處理後續訊息")
+
+    def _leading_run(self, pending: deque) -> List[_Entry]:
+        """佇列開頭可以合併處理的訊息：連續的可合併訊息，或單獨一則指令"""
+        if not pending[0].mergeable:
+            return [pending[0]]
+        run = []
+        for entry in pending:
+            if not entry.mergeable:
+                break
+            run.append(entry)
+        return run
+
+
+# 全域訊息合併器實例
+message_coalescer = None
+
+def init_message_coalescer(window: float = 1.0, max_wait: float = 4.0,
+                           max_running: float = 120.0) -> MessageCoalescer:
+    """初始化全域訊息合併器"""
+    global message_coalescer
+    message_coalescer = MessageCoalescer(window, max_wait, max_running=max_running)
+    logging.info(f"訊息合併器初始化成功：等待 {window:g} 秒，最多 {max_wait:g} 秒")
+    return message_coalescer
+
+def get_message_coalescer() -> Optional[MessageCoalescer]:
+    """獲取全域訊息合併器實例"""
+    return message_coalescer
@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+食譜快取模組
+依正規化的食材組合快取 LLM 推薦結果，並以料理名稱快取詳細食譜，命中時不必再呼叫 LLM
+"""
+
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from database.models import get_db_connection
+
+
+class LRUTTLCache:
+    """執行緒安全的 LRU + TTL 記憶體快取，以 JSON 大小估算記憶體用量"""
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 5 * 1024 * 1024,
+                 ttl: float = 86400):
+        """
+        初始化快取
+
+        Args:
+            max_entries: 最多保留的項目數
+            max_bytes: 快取內容大小上限（位元組）
+            ttl: 項目存活秒數
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._entries = OrderedDict()  # key -> (value, size, stored_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+        self.revision = 0  # 內容每次變動加一，快照依此判斷是否需要重新寫入
+
+    def get(self, key: str) -> Optional[Any]:
+        """取得項目，過期或不存在則返回 None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            value, size, stored_at = entry
+            if now - stored_at > self.ttl:
+                self._remove(key)
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return value
+
+    def set(self, key: str, value: Any, stored_at: Optional[float] = None):
+        """存入項目，超過數量或大小上限時淘汰最久未使用的項目"""
+        size = len(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, stored_at or time.time())
+            self._bytes += size
+            self.revision += 1
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._stats["evictions"] += 1
+
+    def peek(self, key: str) -> Optional[Any]:
+        """取得未過期的項目，不更新使用順序與統計"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[2] > self.ttl:
+                return None
+            return entry[0]
+
+    def delete(self, key: str):
+        """移除項目"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+                self.revision += 1
+
+    def clear(self):
+        """清空快取"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.revision += 1
+
+    def export(self) -> List[Tuple[str, Any, float]]:
+        """未過期的項目 (key, value, stored_at)，依使用順序由舊到新排列"""
+        now = time.time()
+        with self._lock:
+            return [(key, value, stored_at) for key, (value, _, stored_at) in self._entries.items()
+                    if now - stored_at <= self.ttl]
+
+    def stats(self) -> Dict[str, int]:
+        """取得快取統計"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        return stats
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+
+def normalize_ingredients(ingredients: Iterable[str]) -> str:
+    """將食材清單轉成與順序、重複、空白無關的快取鍵"""
+    names = {str(name).strip().lower() for name in ingredients if str(name).strip()}
+    return "、".join(sorted(names))
+
+
+class RecommendationCache:
+    """食材組合 → 推薦清單的快取，每個組合保留多個版本以維持變化"""
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 5 * 1024 * 1024,
+                 ttl: float = 86400, max_variants: int = 3,
+                 refresh_probability: float = 0.3, persist: bool = True):
+        """
+        初始化推薦快取
+
+        Args:
+            max_entries: 記憶體中最多保留的食材組合數
+            max_bytes: 記憶體快取大小上限（位元組）
+            ttl: 快取存活秒數
+            max_variants: 每個食材組合最多保留幾組不同推薦
+            refresh_probability: 版本未滿時，命中仍改呼叫 LLM 產生新版本的機率
+            persist: 是否同時存到 SQLite 資料庫
+        """
+        self.memory = LRUTTLCache(max_entries, max_bytes, ttl)
+        self.ttl = ttl
+        self.max_variants = max_variants
+        self.refresh_probability = refresh_probability
+        self.persist = persist
+        self.logger = logging.getLogger(__name__)
+
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "variety_refreshes": 0, "persistent_hits": 0}
+
+        if persist:
+            self._init_table()
+
+    def _init_table(self):
+        conn = get_db_connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS recommendation_cache (
+                cache_key TEXT PRIMARY KEY,
+                variants TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def get(self, ingredients: Iterable[str], namespace: str = "") -> Optional[List[Dict[str, Any]]]:
+        """
+        取得快取的推薦清單
+
+        Args:
+            ingredients: 食材清單
+            namespace: 區分不同推薦格式的前綴（例如含詳細食譜的推薦）
+
+        Returns:
+            推薦清單；未命中或需要產生新版本時返回 None
+        """
+        key = self._key(ingredients, namespace)
+        if not key:
+            return None
+
+        variants = self._get_variants(key)
+        if not variants:
+            self._count("misses")
+            return None
+
+        if len(variants) < self.max_variants and random.random() < self.refresh_probability:
+            self._count("variety_refreshes")
+            self._count("misses")
+            return None
+
+        self._count("hits")
+        return random.choice(variants)
+
+    def add(self, ingredients: Iterable[str], recommendations: List[Dict[str, Any]],
+            namespace: str = ""):
+        """
+        加入一組新的推薦
+
+        Args:
+            ingredients: 食材清單
+            recommendations: LLM 產生的推薦清單
+            namespace: 區分不同推薦格式的前綴
+        """
+        key = self._key(ingredients, namespace)
+        if not key or not recommendations:
+            return
+
+        variants = list(self._get_variants(key) or [])
+        variants.append(recommendations)
+        variants = variants[-self.max_variants:]
+        now = time.time()
+        self.memory.set(key, variants, now)
+
+        if self.persist:
+            try:
+                conn = get_db_connection()
+                conn.execute(
+                    'INSERT OR REPLACE INTO recommendation_cache (cache_key, variants, updated_at) VALUES (?, ?, ?)',
+                    (key, json.dumps(variants, ensure_ascii=False), now)
+                )
+                conn.commit()
+                conn.close()
+            except Exception as e:
+                self.logger.warning(f"推薦快取寫入資料庫失敗: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """取得快取統計"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["memory"] = self.memory.stats()
+        return stats
+
+    @staticmethod
+    def _key(ingredients: Iterable[str], namespace: str) -> str:
+        key = normalize_ingredients(ingredients)
+        if key and namespace:
+            return f"{namespace}:{key}"
+        return key
+
+    def _get_variants(self, key: str) -> Optional[List[List[Dict[str, Any]]]]:
+        """先查記憶體，未命中再查資料庫"""
+        variants = self.memory.get(key)
+        if variants is not None or not self.persist:
+            return variants
+
+        try:
+            conn = get_db_connection()
+            row = conn.execute(
+                'SELECT variants, updated_at FROM recommendation_cache WHERE cache_key = ?', (key,)
+            ).fetchone()
+            conn.close()
+        except Exception as e:
+            self.logger.warning(f"推薦快取讀取資料庫失敗: {e}")
+            return None
+
+        if row is None or time.time() - row['updated_at'] > self.ttl:
+            return None
+
+        variants = json.loads(row['variants'])
+        self.memory.set(key, variants, row['updated_at'])
+        self._count("persistent_hits")
+        return variants
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+
+def normalize_recipe_name(name: str) -> str:
+    """將料理名稱轉成快取鍵（去除空白、引號與大小寫差異）"""
+    return re.sub(r"[\s「」『』\"'“”]", "", str(name)).lower()
+
+
+def prompt_version(prompt_template: str) -> str:
+    """以提示模板內容的雜湊作為詳細食譜的版本"""
+    return hashlib.sha256(prompt_template.encode("utf-8")).hexdigest()[:12]
+
+
+class RecipeDetailCache:
+    """料理名稱 → 詳細食譜的兩層快取（記憶體 LRU + SQLite）"""
+
+    def __init__(self, version: str, max_entries: int = 500,
+                 max_bytes: int = 10 * 1024 * 1024, max_age: float = 30 * 86400,
+                 persist: bool = True):
+        """
+        初始化詳細食譜快取
+
+        Args:
+            version: 提示模板版本，版本不同的項目視為失效
+            max_entries: 記憶體中最多保留的食譜數
+            max_bytes: 記憶體快取大小上限（位元組）
+            max_age: 食譜存活秒數，超過視為過期
+            persist: 是否同時存到 SQLite 資料庫
+        """
+        self.version = version
+        self.max_age = max_age
+        self.persist = persist
+        self.memory = LRUTTLCache(max_entries, max_bytes, max_age)
+        self.logger = logging.getLogger(__name__)
+
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "persistent_hits": 0, "stale": 0}
+
+        if persist:
+            self._init_table()
+
+    def _init_table(self):
+        conn = get_db_connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS recipe_details (
+                name_key TEXT PRIMARY KEY,
+                prompt_version TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def get(self, recipe_name: str) -> Optional[Dict[str, Any]]:
+        """
+        取得快取的詳細食譜
+
+        Args:
+            recipe_name: 料理名稱
+
+        Returns:
+            詳細食譜，未命中或已失效則返回 None
+        """
+        key = normalize_recipe_name(recipe_name)
+        if not key:
+            return None
+
+        details = self.memory.get(key)
+        if details is None and self.persist:
+            details = self._load(key)
+            if details is not None:
+                self._count("persistent_hits")
+
+        self._count("hits" if details is not None else "misses")
+        return details
+
+    def contains(self, recipe_name: str) -> bool:
+        """檢查是否已有有效的詳細食譜（不計入命中統計）"""
+        key = normalize_recipe_name(recipe_name)
+        if not key:
+            return False
+        if self.memory.peek(key) is not None:
+            return True
+        return self.persist and self._load(key) is not None
+
+    def put(self, recipe_name: str, details: Dict[str, Any]):
+        """
+        存入詳細食譜
+
+        Args:
+            recipe_name: 料理名稱
+            details: LLM 產生的詳細食譜
+        """
+        key = normalize_recipe_name(recipe_name)
+        if not key or not details:
+            return
+
+        now = time.time()
+        self.memory.set(key, details, now)
+        if self.persist:
+            try:
+                conn = get_db_connection()
+                conn.execute(
+                    'INSERT OR REPLACE INTO recipe_details (name_key, prompt_version, payload, created_at) VALUES (?, ?, ?, ?)',
+                    (key, self.version, json.dumps(details, ensure_ascii=False), now)
+                )
+                conn.commit()
+                conn.close()
+            except Exception as e:
+                self.logger.warning(f"詳細食譜快取寫入資料庫失敗: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """取得快取統計"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["version"] = self.version
+        stats["memory"] = self.memory.stats()
+        return stats
+
+    def _load(self, key: str) -> Optional[Dict[str, Any]]:
+        """從資料庫讀取，提示模板版本不同或過期的項目不使用"""
+        try:
+            conn = get_db_connection()
+            row = conn.execute(
+                'SELECT prompt_version, payload, created_at FROM recipe_details WHERE name_key = ?', (key,)
+            ).fetchone()
+            conn.close()
+        except Exception as e:
+            self.logger.warning(f"詳細食譜快取讀取資料庫失敗: {e}")
+            return None
+
+        if row is None:
+            return None
+        if row['prompt_version'] != self.version or time.time() - row['created_at'] > self.max_age:
+            self._count("stale")
+            return None
+
+        details = json.loads(row['payload'])
+        self.memory.set(key, details, row['created_at'])
+        return details
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+
+# 全域推薦快取實例
+recommendation_cache = None
+
+def init_recommendation_cache(**kwargs):
+    """初始化全域推薦快取"""
+    global recommendation_cache
+    try:
+        recommendation_cache = RecommendationCache(**kwargs)
+        logging.info("推薦快取初始化成功")
+    except Exception as e:
+        logging.error(f"推薦快取初始化失敗: {e}")
+        recommendation_cache = None
+
+def get_recommendation_cache() -> Optional[RecommendationCache]:
+    """獲取全域推薦快取實例"""
+    return recommendation_cache
+
+
+# 全域詳細食譜快取實例
+recipe_detail_cache = None
+
+def init_recipe_detail_cache(prompt_template: str, **kwargs):
+    """初始化全域詳細食譜快取，版本由提示模板決定"""
+    global recipe_detail_cache
+    try:
+        recipe_detail_cache = RecipeDetailCache(prompt_version(prompt_template), **kwargs)
+        logging.info(f"詳細食譜快取初始化成功，版本: {recipe_detail_cache.version}")
+    except Exception as e:
+        logging.error(f"詳細食譜快取初始化失敗: {e}")
+        recipe_detail_cache = None
+
+def get_recipe_detail_cache() -> Optional[RecipeDetailCache]:
+    """獲取全域詳細食譜快取實例"""
+    return recipe_detail_cache
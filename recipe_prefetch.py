@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+詳細食譜預先生成模組
+輪播推薦送出後，在背景為推薦的料理生成詳細食譜並存入快取
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+
+class RecipePrefetcher:
+    """有預算限制的背景預先生成器，前景忙碌時不會搶用 LLM"""
+
+    def __init__(self, fetch: Callable, max_workers: int = 2, max_pending: int = 6,
+                 max_per_minute: int = 30, is_busy: Optional[Callable[[], bool]] = None):
+        """
+        初始化預先生成器
+
+        Args:
+            fetch: 生成詳細食譜的函數，參數為 (料理名稱, 推薦資料)
+            max_workers: 背景執行緒數
+            max_pending: 最多排隊 / 執行中的預先生成數
+            max_per_minute: 每分鐘最多預先生成數
+            is_busy: 前景 LLM 忙碌時返回 True 的函數，忙碌時不預先生成
+        """
+        self.fetch = fetch
+        self.max_pending = max_pending
+        self.max_per_minute = max_per_minute
+        self.is_busy = is_busy
+        self.logger = logging.getLogger(__name__)
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="recipe-prefetch")
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._recent = deque()  # 最近一分鐘的預先生成時間
+        self._stats = {"scheduled": 0, "completed": 0, "failed": 0,
+                       "skipped_busy": 0, "skipped_budget": 0}
+
+    def schedule(self, items: Iterable[Tuple[str, Dict]]) -> int:
+        """
+        排程預先生成
+
+        Args:
+            items: (料理名稱, 推薦資料) 清單
+
+        Returns:
+            實際排程的數量
+        """
+        scheduled = 0
+        for name, recommendation in items:
+            if not name:
+                continue
+            if self.is_busy and self.is_busy():
+                self._count("skipped_busy")
+                break
+            if not self._reserve(name):
+                continue
+            self._executor.submit(self._run, name, recommendation)
+            scheduled += 1
+        if scheduled:
+            self.logger.info(f"🔮 預先生成 {scheduled} 道詳細食譜")
+        return scheduled
+
+    def _reserve(self, name: str) -> bool:
+        """檢查佇列與每分鐘預算，通過則佔用一個名額"""
+        now = time.time()
+        with self._lock:
+            if name in self._pending:
+                return False
+            while self._recent and now - self._recent[0] > 60:
+                self._recent.popleft()
+            if len(self._pending) >= self.max_pending or len(self._recent) >= self.max_per_minute:
+                self._stats["skipped_budget"] += 1
+                return False
+            self._pending.add(name)
+            self._recent.append(now)
+            self._stats["scheduled"] += 1
+            return True
+
+    def _run(self, name: str, recommendation: Dict):
+        try:
+            result = self.fetch(name, recommendation)
+            self._count("completed" if result else "failed")
+        except Exception as e:
+            self.logger.warning(f"預先生成詳細食譜失敗 {name}: {e}")
+            self._count("failed")
+        finally:
+            with self._lock:
+                self._pending.discard(name)
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self) -> Dict[str, int]:
+        """取得預先生成統計"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._pending)
+        return stats
+
+    def shutdown(self):
+        """關閉背景執行緒池"""
+        self._executor.shutdown(wait=False)
+
+
+# 全域預先生成器實例
+recipe_prefetcher = None
+
+def init_recipe_prefetcher(fetch: Callable, **kwargs):
+    """初始化全域預先生成器"""
+    global recipe_prefetcher
+    try:
+        recipe_prefetcher = RecipePrefetcher(fetch, **kwargs)
+        logging.info("詳細食譜預先生成器初始化成功")
+    except Exception as e:
+        logging.error(f"詳細食譜預先生成器初始化失敗: {e}")
+        recipe_prefetcher = None
+
+def get_recipe_prefetcher() -> Optional[RecipePrefetcher]:
+    """獲取全域預先生成器實例"""
+    return recipe_prefetcher
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+狀態快照模組
+定期把對話狀態（以及沒有存到資料庫的推薦 / 詳細食譜記憶體快取）寫入本地快照檔，重啟後在背景還原，
+進行中的對話不必從頭開始、也不必重新呼叫 LLM。
+
+快照檔格式（第 1 版）：檔頭 MAGIC + 版本號，之後是一連串的區塊，
+每個區塊為 類型（F 完整 / D 增量）+ 4 位元組長度 + zlib 壓縮的 JSON。
+平時只附加有變動的用戶與快取項目（增量區塊），累積一定數量後重寫成單一完整區塊。
+同一個快照檔只由取得檔案鎖（{path}.lock）的程序寫入，其他程序只還原不寫入
+"""
+
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows 沒有 fcntl，只能依賴單一程序部署
+    fcntl = None
+
+MAGIC = b"MHSNAP"
+FORMAT_VERSION = 1
+FRAME_FULL = b"F"
+FRAME_DELTA = b"D"
+_FRAME_HEADER = struct.Struct(">cI")
+
+
+class StateSnapshotter:
+    """對話狀態與記憶體快取的快照（背景執行緒定期寫入）"""
+
+    def __init__(self, path: str, conversation_state=None, caches: Optional[Dict[str, Tuple[Any, str]]] = None,
+                 interval: float = 60, compact_after: int = 20, restore_timeout: float = 2.0):
+        """
+        初始化快照
+
+        Args:
+            path: 快照檔路徑
+            conversation_state: 記憶體對話狀態（MemoryConversationState），None 表示不保存對話狀態
+            caches: 快取名稱 → (LRUTTLCache, 版本標記)；版本標記不同的快照內容不還原
+            interval: 寫入間隔（秒）
+            compact_after: 累積多少個增量區塊後重寫成完整快照
+            restore_timeout: 還原完成前，讀寫對話狀態最多等待的秒數
+        """
+        self.path = path
+        self.conversation_state = conversation_state
+        self.caches = caches or {}
+        self.interval = interval
+        self.compact_after = compact_after
+        self.restore_timeout = restore_timeout
+        self.logger = logging.getLogger(__name__)
+
+        self._loaded = threading.Event()
+        self._stop = threading.Event()
+        self._save_lock = threading.Lock()
+        self._thread = None
+        self._deltas = 0
+        self._cache_revisions: Dict[str, int] = {}
+        self._cache_stamps: Dict[str, Dict[str, float]] = {}  # 上次寫入的快取項目 key → stored_at
+        self._lock_file = None
+        self._writer_warned = False
+        self._stats = {"loaded": False, "restored_users": 0, "restored_cache_entries": 0, "load_seconds": 0.0,
+                       "saves": 0, "full_saves": 0, "skipped_frames": 0, "last_save_bytes": 0, "errors": 0,
+                       "writer": False}
+
+    def start(self):
+        """在背景還原快照，之後定期寫入；還原完成前，讀寫對話狀態會短暫等待"""
+        if self.conversation_state is not None:
+            self.conversation_state.restore_wait = lambda: self._loaded.wait(self.restore_timeout)
+        with self._save_lock:
+            self._acquire_writer()
+        self._thread = threading.Thread(target=self._run, name="state-snapshot", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """停止背景執行緒並寫入最後一次快照"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        if self._loaded.is_set():
+            self.save()
+        self._release_writer()
+
+    def save(self, full: bool = False) -> bool:
+        """
+        寫入快照：沒有變動時不寫入，增量區塊累積到上限時改寫完整快照
+
+        Args:
+            full: 是否強制寫入完整快照
+
+        Returns:
+            是否有寫入
+        """
+        with self._save_lock:
+            if not self._acquire_writer():
+                return False
+            try:
+                if full or self._deltas >= self.compact_after or not os.path.exists(self.path):
+                    payload, stamps = self._full_payload()
+                    self._write_full(payload)
+                    self._deltas = 0
+                    self._stats["full_saves"] += 1
+                else:
+                    payload, stamps = self._delta_payload()
+                    if payload is None:
+                        return False
+                    self._append(FRAME_DELTA, payload)
+                    self._deltas += 1
+                # 寫入成功後才更新快取的寫入紀錄
+                for name, (revision, entries) in stamps.items():
+                    self._cache_revisions[name], self._cache_stamps[name] = revision, entries
+                self._stats["saves"] += 1
+                return True
+            except Exception as e:
+                # 取出的變動已從對話狀態清除，下次改寫完整快照才不會遺失
+                self._deltas = self.compact_after
+                self._stats["errors"] += 1
+                self.logger.error(f"寫入狀態快照失敗，下次改寫完整快照: {e}")
+                return False
+
+    def load(self):
+        """讀取快照檔並還原對話狀態與快取"""
+        started = time.perf_counter()
+        try:
+            states, caches, deltas = self._read()
+            # 檔尾有不完整的區塊時，下次改寫完整快照，不在損壞的內容後面繼續附加
+            self._deltas = self.compact_after if self._stats["skipped_frames"] else deltas
+            if self.conversation_state is not None and states:
+                self._stats["restored_users"] = self.conversation_state.restore(states)
+            for name, (cache, tag) in self.caches.items():
+                section = caches.get(name)
+                if not section or section.get("tag") != tag:
+                    continue
+                for key, (value, stored_at) in section["entries"].items():
+                    cache.set(key, value, stored_at)
+                self._stats["restored_cache_entries"] += len(section["entries"])
+                self._cache_revisions[name] = cache.revision
+                self._cache_stamps[name] = {key: stored_at for key, (_, stored_at) in section["entries"].items()}
+        except Exception as e:
+            self._deltas = self.compact_after  # 無法讀取的快照檔在下次寫入時整個覆寫
+            self._stats["errors"] += 1
+            self.logger.error(f"讀取狀態快照失敗，從空白狀態開始: {e}")
+        finally:
+            self._stats["load_seconds"] = round(time.perf_counter() - started, 4)
+            self._stats["loaded"] = True
+            self._loaded.set()
+            if self.conversation_state is not None:
+                self.conversation_state.restore_wait = None
+        self.logger.info(f"狀態快照還原完成：{self._stats['restored_users']} 位用戶、"
+                         f"{self._stats['restored_cache_entries']} 筆快取，耗時 {self._stats['load_seconds']} 秒")
+
+    def stats(self) -> Dict[str, Any]:
+        """取得還原與寫入統計"""
+        stats = dict(self._stats)
+        stats["path"] = self.path
+        stats["bytes"] = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        stats["pending_deltas"] = self._deltas
+        return stats
+
+    def _run(self):
+        self.load()
+        while not self._stop.wait(self.interval):
+            self.save()
+
+    # --- 快照內容 ---
+
+    def _full_payload(self) -> Tuple[Dict[str, Any], Dict[str, Tuple[int, Dict[str, float]]]]:
+        """
+        所有對話狀態與快取內容
+
+        Returns:
+            (快照內容, 快取名稱 → (版本, 寫入的項目 key → stored_at))
+        """
+        payload = {"saved_at": time.time(), "states": {}, "caches": {}}
+        stamps = {}
+        if self.conversation_state is not None:
+            payload["states"] = self.conversation_state.export()
+        for name, (cache, tag) in self.caches.items():
+            revision = cache.revision
+            entries = cache.export()
+            payload["caches"][name] = {"tag": tag, "entries": entries}
+            stamps[name] = (revision, {key: stored_at for key, _, stored_at in entries})
+        return payload, stamps
+
+    def _delta_payload(self) -> Tuple[Optional[Dict[str, Any]], Dict[str, Tuple[int, Dict[str, float]]]]:
+        """
+        上次寫入後的變動：有變動的用戶，以及新增、更新或移除的快取項目
+
+        Returns:
+            (快照內容，沒有變動時為 None, 快取名稱 → (版本, 寫入的項目 key → stored_at))
+        """
+        payload = {"saved_at": time.time(), "states": {}, "removed": [], "caches": {}}
+        stamps = {}
+        if self.conversation_state is not None:
+            payload["states"], payload["removed"] = self.conversation_state.changes()
+        for name, (cache, tag) in self.caches.items():
+            revision = cache.revision
+            if revision == self._cache_revisions.get(name):
+                continue
+            previous = self._cache_stamps.get(name, {})
+            entries = cache.export()
+            current = {key: stored_at for key, _, stored_at in entries}
+            changed = [entry for entry in entries if previous.get(entry[0]) != entry[2]]
+            removed = [key for key in previous if key not in current]
+            stamps[name] = (revision, current)
+            if changed or removed:
+                payload["caches"][name] = {"tag": tag, "entries": changed, "removed": removed}
+        if not payload["states"] and not payload["removed"] and not payload["caches"]:
+            for name, (revision, entries) in stamps.items():
+                self._cache_revisions[name], self._cache_stamps[name] = revision, entries
+            return None, {}
+        return payload, stamps
+
+    # --- 寫入權 ---
+
+    def _acquire_writer(self) -> bool:
+        """
+        取得快照檔的寫入權（{path}.lock 的排他鎖），避免多個程序同時附加或替換同一個快照檔
+
+        Returns:
+            此程序是否可以寫入；沒有 fcntl 的平台一律可以寫入
+        """
+        if self._lock_file is not None or fcntl is None:
+            self._stats["writer"] = True
+            return True
+        lock_file = open(f"{self.path}.lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            if not self._writer_warned:
+                self._writer_warned = True
+                self.logger.warning(f"另一個程序正在寫入 {self.path}，此程序只還原不寫入快照")
+            return False
+        self._lock_file = lock_file
+        self._stats["writer"] = True
+        # 接手寫入時檔案內容可能由其他程序寫成，先改寫完整快照（在還原前取得時由 load() 重新設定）
+        self._deltas = self.compact_after
+        return True
+
+    def _release_writer(self):
+        if self._lock_file is not None:
+            self._lock_file.close()  # 關閉檔案即釋放鎖
+            self._lock_file = None
+            self._stats["writer"] = False
+
+    # --- 檔案格式 ---
+
+    @staticmethod
+    def _frame(kind: bytes, payload: Dict[str, Any]) -> bytes:
+        data = zlib.compress(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        return _FRAME_HEADER.pack(kind, len(data)) + data
+
+    def _write_full(self, payload: Dict[str, Any]):
+        """寫入暫存檔後替換，寫到一半中斷也不會損壞原本的快照"""
+        data = MAGIC + bytes([FORMAT_VERSION]) + self._frame(FRAME_FULL, payload)
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self._stats["last_save_bytes"] = len(data)
+
+    def _append(self, kind: bytes, payload: Dict[str, Any]):
+        frame = self._frame(kind, payload)
+        with open(self.path, "ab") as f:
+            f.write(frame)
+            f.flush()
+            os.fsync(f.fileno())
+        self._stats["last_save_bytes"] = len(frame)
+
+    def _read(self) -> Tuple[Dict[str, Any], Dict[str, Any], int]:
+        """
+        依序套用快照檔中的區塊
+
+        Returns:
+            (用戶 ID → (最後互動時間, 狀態欄位), 快取名稱 → 快取內容, 增量區塊數)
+        """
+        if not os.path.exists(self.path):
+            return {}, {}, 0
+        with open(self.path, "rb") as f:
+            data = f.read()
+
+        header = len(MAGIC) + 1
+        if data[:len(MAGIC)] != MAGIC or len(data) < header:
+            raise ValueError("不是狀態快照檔")
+        if data[len(MAGIC)] != FORMAT_VERSION:
+            raise ValueError(f"不支援的快照格式版本 {data[len(MAGIC)]}")
+
+        states: Dict[str, Any] = {}
+        caches: Dict[str, Any] = {}  # 快取名稱 → {"tag", "entries": key → (value, stored_at)}
+        deltas = 0
+        offset = header
+        while offset < len(data):
+            if offset + _FRAME_HEADER.size > len(data):
+                self._stats["skipped_frames"] += 1
+                break
+            kind, length = _FRAME_HEADER.unpack_from(data, offset)
+            offset += _FRAME_HEADER.size
+            try:
+                payload = json.loads(zlib.decompress(data[offset:offset + length]).decode("utf-8"))
+            except (zlib.error, ValueError):
+                # 最後一個區塊寫到一半就中斷（例如程序被強制結束），忽略之後的內容
+                self._stats["skipped_frames"] += 1
+                self.logger.warning("狀態快照最後的區塊不完整，已略過")
+                break
+            offset += length
+
+            if kind == FRAME_FULL:
+                states, caches, deltas = {}, {}, 0
+            else:
+                deltas += 1
+            for user_id, (touched_at, state) in payload.get("states", {}).items():
+                states[user_id] = (touched_at, state)
+            for user_id in payload.get("removed", []):
+                states.pop(user_id, None)
+            for name, section in payload.get("caches", {}).items():
+                current = caches.get(name)
+                if current is None or current["tag"] != section["tag"]:
+                    current = caches[name] = {"tag": section["tag"], "entries": OrderedDict()}
+                for key in section.get("removed", []):
+                    current["entries"].pop(key, None)
+                for key, value, stored_at in section["entries"]:
+                    current["entries"].pop(key, None)
+                    current["entries"][key] = (value, stored_at)
+        return states, caches, deltas
+
+
+# 全域快照實例
+state_snapshotter = None
+
+def init_state_snapshotter(path: str, conversation_state=None, caches=None, **kwargs) -> StateSnapshotter:
+    """建立全域快照並在背景開始還原"""
+    global state_snapshotter
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    state_snapshotter = StateSnapshotter(path, conversation_state, caches, **kwargs)
+    state_snapshotter.start()
+    logging.info(f"狀態快照初始化成功：{path}，每 {state_snapshotter.interval:g} 秒寫入")
+    return state_snapshotter
+
+def get_state_snapshotter() -> Optional[StateSnapshotter]:
+    """獲取全域快照實例"""
+    return state_snapshotter
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def db_connect(tmp_path):
+    """取代 database.models.get_db_connection 的連線函數，資料庫放在測試的暫存目錄"""
+    path = tmp_path / "recipes.db"
+
+    def connect():
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    return connect
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import random
+
+import pytest
+
+from llm.backends import FakeBackend, LLMBackend, create_backend, parse_latency
+from llm.resilience import is_rate_limited
+
+
+def test_parse_latency_distributions():
+    rng = random.Random(0)
+    assert parse_latency("fixed:0.25")(rng) == 0.25
+    assert parse_latency("")(rng) == 0.0
+    assert all(1 <= parse_latency("uniform:1,2")(rng) <= 2 for _ in range(50))
+    assert all(parse_latency("normal:0,5")(rng) >= 0 for _ in range(50))
+    assert parse_latency("lognormal:0.5,0.1")(rng) > 0
+    with pytest.raises(ValueError):
+        parse_latency("pareto:1")
+
+
+def test_same_seed_gives_same_answers():
+    prompt = '請推薦料理，回傳 {"recommendations": [...]}'
+    first = FakeBackend(latency="fixed:0", seed=7)
+    second = FakeBackend(latency="fixed:0", seed=7)
+    assert first.generate_content(prompt).text == second.generate_content(prompt).text
+
+
+def test_responses_follow_the_prompt_kind():
+    backend = FakeBackend(latency="fixed:0")
+
+    data = json.loads(backend.generate_content('回傳 {"recommendations": [], "details": {}}').text)
+    assert len(data["recommendations"]) == 3
+    assert all("steps" in recipe["details"] for recipe in data["recommendations"])
+
+    data = json.loads(backend.generate_content('缺少以下食材：醬油、蒜\n回傳 {"substitutions": {}}').text)
+    assert set(data["substitutions"]) == {"醬油", "蒜"}
+
+    data = json.loads(backend.generate_content('請為「番茄炒蛋」提供 {"steps": []}').text)
+    assert data["name"] == "番茄炒蛋"
+
+    assert backend.generate_content(["識別圖中食材", object()]).text == "雞蛋,番茄,青菜,豆腐"
+    assert backend.stats()["calls"] == 4
+
+
+def test_injected_errors_are_counted_and_recognised():
+    limited = FakeBackend(latency="fixed:0", rate_limit_rate=1.0)
+    with pytest.raises(Exception) as caught:
+        limited.generate_content("hi")
+    assert is_rate_limited(caught.value)
+    assert limited.stats() == {"calls": 1, "errors": 0, "rate_limited": 1}
+
+    failing = FakeBackend(latency="fixed:0", error_rate=1.0)
+    with pytest.raises(Exception) as caught:
+        asyncio.run(failing.generate_content_async("hi"))
+    assert not is_rate_limited(caught.value)
+    assert failing.stats()["errors"] == 1
+
+
+def test_stream_fails_midway_after_some_chunks():
+    backend = FakeBackend(latency="fixed:0", error_rate=1.0)
+    received = []
+    with pytest.raises(Exception):
+        for chunk in backend.generate_content('回傳 {"recommendations": []}', stream=True):
+            received.append(chunk.text)
+    assert received  # 5xx 模擬串流中途斷線，之前的片段已送達
+
+    text = "".join(chunk.text for chunk in
+                   FakeBackend(latency="fixed:0").generate_content('請為「湯」提供 {"steps": []}', stream=True))
+    assert json.loads(text)["name"] == "湯"
+
+
+def test_create_backend():
+    assert isinstance(create_backend("fake", latency="fixed:0"), FakeBackend)
+    with pytest.raises(ValueError):
+        create_backend("openai")
+
+
+def test_backend_without_generate_content_cannot_be_created():
+    class AsyncOnly(LLMBackend):
+        async def generate_content_async(self, contents, generation_config=None):
+            return None
+
+    with pytest.raises(TypeError):
+        AsyncOnly()
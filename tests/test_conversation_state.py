@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from conversation_state import (STAGE_IDLE, STAGE_WAITING_FOR_CHOICE, MemoryConversationState,
+                                SQLiteConversationState, UserState, decode_state, encode_state)
+
+
+def test_user_state_rejects_unknown_fields():
+    state = UserState()
+    state.update({"stage": STAGE_WAITING_FOR_CHOICE, "ingredients": ["雞蛋"]})
+    assert state["stage"] == STAGE_WAITING_FOR_CHOICE
+    assert state.get("unknown", "x") == "x"
+    with pytest.raises(KeyError):
+        state.update({"stgae": STAGE_IDLE})
+    with pytest.raises(KeyError):
+        state["unknown"]
+
+
+def test_encode_compresses_large_states():
+    small = UserState(ingredients=["雞蛋"])
+    assert encode_state(small)[:1] == b"j"
+    large = UserState(recommendations=[{"name": "番茄炒蛋", "description": "好吃" * 200}])
+    data = encode_state(large)
+    assert data[:1] == b"z"
+    assert decode_state(data).to_dict() == large.to_dict()
+
+
+def test_memory_backend_updates_and_resets():
+    states = MemoryConversationState()
+    assert states.get_user_state("u1").stage == STAGE_IDLE
+    states.update_user_state("u1", {"stage": STAGE_WAITING_FOR_CHOICE, "ingredients": ["番茄"]})
+    assert states.get_user_state("u1").ingredients == ["番茄"]
+    states.reset_user_state("u1")
+    assert states.get_user_state("u1").stage == STAGE_IDLE
+
+    stats = states.stats()
+    assert stats["users"] == 0 and stats["bytes"] == 0
+    assert (stats["updates"], stats["resets"], stats["hits"], stats["misses"]) == (1, 1, 1, 2)
+
+
+def test_memory_backend_evicts_least_recently_used():
+    states = MemoryConversationState(max_users=2)
+    for user_id in ("u1", "u2"):
+        states.update_user_state(user_id, {"ingredients": [user_id]})
+    states.get_user_state("u1")  # u1 成為最近互動的用戶
+    states.update_user_state("u3", {"ingredients": ["u3"]})
+    assert states.get_user_state("u2").ingredients == []
+    assert states.get_user_state("u1").ingredients == ["u1"]
+    assert states.stats()["evictions"] == 1
+
+
+def test_memory_backend_enforces_byte_budget():
+    states = MemoryConversationState(max_bytes=200)
+    states.update_user_state("u1", {"ingredients": ["雞蛋"] * 10})
+    states.update_user_state("u2", {"ingredients": ["番茄"] * 10})
+    stats = states.stats()
+    assert stats["users"] == 1 and stats["bytes"] <= 200
+    # 單一用戶超過上限時仍保留剛更新的用戶
+    states.update_user_state("u3", {"ingredients": ["豆腐"] * 100})
+    assert states.get_user_state("u3").ingredients
+
+
+def test_memory_backend_expires_idle_users(monkeypatch):
+    states = MemoryConversationState(idle_timeout=60)
+    states.update_user_state("u1", {"stage": STAGE_WAITING_FOR_CHOICE})
+    now = states.get_user_state("u1").touched_at
+    monkeypatch.setattr("conversation_state.time.time", lambda: now + 61)
+    assert states.get_user_state("u1").stage == STAGE_IDLE
+    assert states.stats()["expired"] == 1
+    # 逾時移除的用戶也要出現在增量快照的移除清單中
+    assert states.changes() == ({}, ["u1"])
+
+
+@pytest.fixture
+def sqlite_state(db_connect, monkeypatch):
+    monkeypatch.setattr("conversation_state.get_db_connection", db_connect)
+
+    def create(**kwargs):
+        return SQLiteConversationState(**kwargs)
+
+    return create
+
+
+def test_sqlite_backend_shares_state_between_workers(sqlite_state):
+    worker_a, worker_b = sqlite_state(), sqlite_state()
+    worker_a.update_user_state("u1", {"stage": STAGE_WAITING_FOR_CHOICE, "ingredients": ["雞蛋"]})
+    assert worker_b.get_user_state("u1").ingredients == ["雞蛋"]
+
+    # worker_b 更新後，worker_a 的快取版本已過期，必須讀到新狀態
+    worker_b.update_user_state("u1", {"ingredients": ["雞蛋", "番茄"]})
+    assert worker_a.get_user_state("u1").ingredients == ["雞蛋", "番茄"]
+    assert worker_a.get_user_state("u1").stage == STAGE_WAITING_FOR_CHOICE
+    assert worker_a.stats()["cache_hits"] == 1
+
+    worker_a.reset_user_state("u1")
+    assert worker_b.get_user_state("u1").stage == STAGE_IDLE
+    assert worker_b.stats()["users"] == 0
+
+
+def test_sqlite_backend_retries_on_version_conflict(sqlite_state):
+    worker_a, worker_b = sqlite_state(), sqlite_state()
+    worker_a.update_user_state("u1", {"ingredients": ["雞蛋"]})
+    load = worker_a._load
+
+    def load_then_race(conn, user_id):
+        # 第一次讀取後另一個 worker 搶先寫入，讓 worker_a 的版本比對失敗
+        result = load(conn, user_id)
+        if not worker_a.stats()["conflicts"] and result[0] == 1:
+            worker_b.update_user_state(user_id, {"stage": STAGE_WAITING_FOR_CHOICE})
+        return result
+
+    worker_a._load = load_then_race
+    worker_a.update_user_state("u1", {"ingredients": ["番茄"]})
+
+    state = worker_b.get_user_state("u1")
+    assert state.stage == STAGE_WAITING_FOR_CHOICE  # 另一個 worker 的更新沒有被覆寫
+    assert state.ingredients == ["番茄"]
+    assert worker_a.stats()["conflicts"] == 1
+
+
+def test_sqlite_backend_cleans_up_idle_and_excess_users(sqlite_state, monkeypatch):
+    states = sqlite_state(max_users=2, idle_timeout=60, cache_size=0)
+    monkeypatch.setattr(SQLiteConversationState, "CLEANUP_INTERVAL", 3)
+    for user_id in ("u1", "u2", "u3"):
+        states.update_user_state(user_id, {"ingredients": [user_id]})
+    assert states.stats()["users"] == 2
+    assert states.get_user_state("u1").ingredients == []
+
+    now = time.time()
+    monkeypatch.setattr("conversation_state.time.time", lambda: now + 61)
+    assert states.get_user_state("u3").stage == STAGE_IDLE
+    assert states.stats()["users"] == 0
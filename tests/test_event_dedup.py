@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import event_dedup
+from event_dedup import (
+    DONE, IN_FLIGHT, NEW, EventDeduplicator, MemoryDeduplicator, SQLiteDeduplicator, create_deduplicator
+)
+
+
+@pytest.fixture
+def sqlite_db(db_connect, monkeypatch):
+    monkeypatch.setattr(event_dedup, "get_db_connection", db_connect)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make(request, sqlite_db):
+    cls = MemoryDeduplicator if request.param == "memory" else SQLiteDeduplicator
+    return lambda **kwargs: cls(**kwargs)
+
+
+def test_base_class_is_abstract():
+    with pytest.raises(TypeError):
+        EventDeduplicator()
+
+
+def test_claim_complete_and_release(make):
+    dedup = make()
+    assert dedup.claim("e1") == NEW
+    assert dedup.claim("e1", is_redelivery=True) == IN_FLIGHT
+    dedup.complete("e1")
+    assert dedup.claim("e1", is_redelivery=True) == DONE
+
+    assert dedup.claim("e2") == NEW
+    dedup.release("e2")  # 處理失敗，重送時重新處理
+    assert dedup.claim("e2") == NEW
+
+    stats = dedup.stats()
+    assert stats["misses"] == 3 and stats["in_flight_hits"] == 1 and stats["done_hits"] == 1
+    assert stats["redeliveries"] == 2 and stats["size"] == 2
+
+
+def test_expired_entries_can_be_claimed_again(make, monkeypatch):
+    dedup = make(ttl=10, in_flight_timeout=5)
+    now = [1000.0]
+    monkeypatch.setattr(event_dedup.time, "time", lambda: now[0])
+
+    assert dedup.claim("stuck") == NEW
+    now[0] += 6  # 處理程序中斷，處理中紀錄逾時
+    assert dedup.claim("stuck") == NEW
+
+    dedup.complete("stuck")
+    now[0] += 5
+    assert dedup.claim("stuck") == DONE
+    now[0] += 6
+    assert dedup.claim("stuck") == NEW
+
+
+def test_memory_evicts_oldest_entries():
+    dedup = MemoryDeduplicator(max_entries=2)
+    for event_id in ("e1", "e2", "e3"):
+        dedup.claim(event_id)
+    assert dedup.size() == 2
+    assert dedup.claim("e1") == NEW
+
+
+def test_create_deduplicator_passes_in_flight_timeout(sqlite_db):
+    assert create_deduplicator("off") is None
+    assert create_deduplicator("memory", in_flight_timeout=30).in_flight_timeout == 30
+    assert create_deduplicator("sqlite", in_flight_timeout=45).in_flight_timeout == 45
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+
+import pytest
+
+from llm import (
+    CircuitBreaker, CircuitOpenError, LLMGateway, RetryPolicy, TokenBucket, estimate_tokens,
+    PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+)
+
+
+@pytest.fixture
+def gateway():
+    gateways = []
+
+    def make(**kwargs):
+        kwargs.setdefault("retry", RetryPolicy(max_attempts=1))
+        gateways.append(LLMGateway(**kwargs))
+        return gateways[-1]
+
+    yield make
+    for created in gateways:
+        created.shutdown()
+
+
+def job(result, delay=0.0, record=None):
+    async def call():
+        if record is not None:
+            record.append(result)
+        await asyncio.sleep(delay)
+        return result
+    return call
+
+
+def test_concurrency_limit(gateway):
+    llm_gateway = gateway(max_concurrent=2)
+    running = []
+    peak = []
+
+    async def call():
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(0.05)
+        running.pop()
+        return "ok"
+
+    futures = [llm_gateway.submit(call) for _ in range(6)]
+    assert [future.result(timeout=2) for future in futures] == ["ok"] * 6
+    assert max(peak) == 2
+    assert llm_gateway.stats()["completed"] == 6
+
+
+def test_priority_order_when_saturated(gateway):
+    llm_gateway = gateway(max_concurrent=1)
+    order = []
+    blocker = llm_gateway.submit(job("blocker", 0.1))
+    background = llm_gateway.submit(job("background", record=order), PRIORITY_BACKGROUND)
+    interactive = llm_gateway.submit(job("interactive", record=order), PRIORITY_INTERACTIVE)
+    for future in (blocker, background, interactive):
+        future.result(timeout=2)
+    assert order == ["interactive", "background"]
+
+
+def test_promote_moves_queued_request_ahead(gateway):
+    llm_gateway = gateway(max_concurrent=1)
+    order = []
+    blocker = llm_gateway.submit(job("blocker", 0.1))
+    first = llm_gateway.submit(job("normal", record=order))
+    promoted = llm_gateway.submit(job("promoted", record=order), PRIORITY_BACKGROUND)
+    llm_gateway.promote(promoted, PRIORITY_INTERACTIVE)
+    for future in (blocker, first, promoted):
+        future.result(timeout=2)
+    assert order == ["promoted", "normal"]
+    assert llm_gateway.stats()["promoted"] == 1
+
+
+def test_token_bucket_wait_and_consume():
+    bucket = TokenBucket(per_minute=60)
+    assert bucket.wait_time(60) == 0
+    bucket.consume(60)
+    assert 0.9 < bucket.wait_time(1) <= 1.01
+    assert bucket.wait_time(1000) > 0  # 超過容量的請求在額滿時放行
+
+
+def test_requests_per_minute_throttles(gateway):
+    llm_gateway = gateway(requests_per_minute=600)  # 容量 600，每 0.1 秒補一個
+    llm_gateway._request_bucket.tokens = 0
+    started = time.monotonic()
+    llm_gateway.submit(job("ok")).result(timeout=2)
+    assert time.monotonic() - started >= 0.08
+    assert llm_gateway.stats()["throttled"] >= 1
+
+
+def test_transient_failure_is_retried_without_blocking(gateway):
+    llm_gateway = gateway(retry=RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.01, budget=5))
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError("reset")
+        return "ok"
+
+    assert llm_gateway.submit(flaky).result(timeout=5) == "ok"
+    assert llm_gateway.stats()["retried"] == 2
+
+
+def test_non_retryable_error_fails_once(gateway):
+    llm_gateway = gateway(retry=RetryPolicy(max_attempts=3, base_delay=0.01))
+
+    async def broken():
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        llm_gateway.submit(broken).result(timeout=2)
+    assert llm_gateway.stats()["retried"] == 0
+    assert llm_gateway.breaker.state == "closed"
+
+
+def test_budget_timeout(gateway):
+    llm_gateway = gateway()
+    with pytest.raises((asyncio.TimeoutError, TimeoutError)):
+        llm_gateway.submit(job("slow", 1.0), budget=0.05).result(timeout=2)
+
+
+def test_open_circuit_rejects_immediately(gateway):
+    llm_gateway = gateway(breaker=CircuitBreaker(failure_threshold=1, recovery_timeout=30))
+
+    async def down():
+        raise ConnectionError("down")
+
+    with pytest.raises(ConnectionError):
+        llm_gateway.submit(down).result(timeout=2)
+    with pytest.raises(CircuitOpenError):
+        llm_gateway.submit(job("ok")).result(timeout=2)
+    assert llm_gateway.stats()["circuit_rejected"] == 1
+
+
+def test_reserve_holds_and_returns_slot(gateway):
+    llm_gateway = gateway(max_concurrent=1)
+    inside = threading.Event()
+    leave = threading.Event()
+
+    def stream():
+        with llm_gateway.reserve():
+            inside.set()
+            leave.wait(2)
+
+    thread = threading.Thread(target=stream)
+    thread.start()
+    inside.wait(2)
+    queued = llm_gateway.submit(job("after"))
+    time.sleep(0.05)
+    assert not queued.done()
+    leave.set()
+    assert queued.result(timeout=2) == "after"
+    thread.join()
+    assert llm_gateway.load() == 0
+
+
+def test_cancel_aborts_running_and_queued_requests(gateway):
+    llm_gateway = gateway(max_concurrent=1)
+    aborted = threading.Event()
+
+    async def slow():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            aborted.set()
+            raise
+
+    running = llm_gateway.submit(slow)
+    queued = llm_gateway.submit(job("never"))
+    while llm_gateway.stats()["active"] == 0:
+        time.sleep(0.01)
+
+    llm_gateway.cancel(queued)
+    llm_gateway.cancel(running)
+    with pytest.raises(CancelledError):
+        running.result(timeout=1)
+    assert queued.cancelled()
+    assert aborted.wait(1)  # 上游呼叫被中止，而不是在背景跑完
+    assert llm_gateway.submit(job("next")).result(timeout=1) == "next"
+    assert llm_gateway.stats()["cancelled"] == 1
+    assert llm_gateway.load() == 0
+
+
+def test_cancel_during_retry_backoff(gateway):
+    llm_gateway = gateway(retry=RetryPolicy(max_attempts=3, base_delay=1, max_delay=1))
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        raise ConnectionError("down")
+
+    future = llm_gateway.submit(flaky)
+    while llm_gateway.stats()["retried"] == 0:
+        time.sleep(0.01)
+    llm_gateway.cancel(future)
+    with pytest.raises(CancelledError):
+        future.result(timeout=1)
+    time.sleep(1.2)  # 退避結束後不再重試
+    assert len(calls) == 1
+
+
+_fork_gateway = None
+
+
+def _call_in_worker():
+    return _fork_gateway.submit(job("from child")).result(timeout=3)
+
+
+@pytest.mark.skipif(not hasattr(os, "register_at_fork"), reason="需要 fork")
+def test_forked_worker_rebuilds_event_loop(gateway):
+    global _fork_gateway
+    _fork_gateway = gateway()
+    # 父進程的事件迴圈已在執行時 fork，子進程需有自己的事件迴圈執行緒
+    assert _fork_gateway.submit(job("parent")).result(timeout=1) == "parent"
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("fork")) as pool:
+        assert pool.submit(_call_in_worker).result(timeout=10) == "from child"
+    assert _fork_gateway.submit(job("parent again")).result(timeout=1) == "parent again"
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("番茄炒蛋") == 4
+    assert estimate_tokens("abcdefgh") == 2
+    assert estimate_tokens(["番茄", object()]) == 2 + 258
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from types import SimpleNamespace
+
+from llm import HedgePolicy, LLMClient, LLMGateway
+from llm.backends import LLMBackend
+
+
+class SlowFirstBackend(LLMBackend):
+    """第一次呼叫很慢，之後的呼叫很快"""
+
+    def __init__(self, slow=1.0, fast=0.01):
+        self.slow, self.fast = slow, fast
+        self.calls = 0
+
+    def generate_content(self, contents, generation_config=None, stream=False):
+        return asyncio.run(self.generate_content_async(contents, generation_config))
+
+    async def generate_content_async(self, contents, generation_config=None):
+        self.calls += 1
+        await asyncio.sleep(self.slow if self.calls == 1 else self.fast)
+        return SimpleNamespace(text=f"call {self.calls}")
+
+
+def test_threshold_uses_percentile_and_floor():
+    policy = HedgePolicy(["details"], percentile=0.9, min_samples=10, min_delay=0.5)
+    assert policy.hedge_after("details") is None  # 樣本不足
+    for latency in range(1, 11):
+        policy.record("details", float(latency))
+    assert policy.hedge_after("details") == 10.0
+    assert policy.hedge_after("other") is None
+
+    policy = HedgePolicy(["details"], min_samples=1, min_delay=0.5)
+    policy.record("details", 0.1)
+    assert policy.hedge_after("details") == 0.5
+
+
+def test_budget_limits_hedge_share():
+    policy = HedgePolicy(["details"], max_share=0.1, min_samples=1)
+    policy.record("details", 1.0)
+    for _ in range(10):
+        policy.hedge_after("details")
+    assert policy.acquire()
+    assert not policy.acquire()
+    policy.refund()
+    stats = policy.stats()
+    assert stats["hedged"] == 0 and stats["over_budget"] == 1 and stats["no_capacity"] == 1
+
+
+def test_censored_samples_raise_threshold():
+    policy = HedgePolicy(["details"], min_samples=4, min_delay=0, percentile=0.5)
+    for latency in (1.0, 1.0):
+        policy.record("details", latency)
+    for latency in (5.0, 5.0):
+        policy.record("details", latency, censored=True)
+    assert policy.hedge_after("details") == 5.0
+    assert policy.stats()["censored"] == 2
+
+
+def test_hedge_win_records_cancelled_primary_latency():
+    backend = SlowFirstBackend()
+    policy = HedgePolicy(["default"], max_share=1, min_samples=3, min_delay=0.05)
+    for _ in range(3):
+        policy.record("default", 0.05)
+    client = LLMClient(backend, timeout=5, gateway=LLMGateway(), hedging=policy)
+    try:
+        response = client.generate_content("prompt")
+    finally:
+        client.shutdown()
+
+    assert response.text == "call 2"
+    stats = policy.stats()
+    assert stats["hedge_wins"] == 1 and stats["censored"] == 1
+    latencies = list(policy._latencies["default"])
+    assert len(latencies) == 5  # 三筆預設、對沖請求、被取消的原請求
+    assert max(latencies) >= 0.05
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import pytest
+
+from ingredient_matcher import (
+    IngredientLexicon, KeywordMatcher, KIND_COOKING, KIND_INGREDIENT, substring_distance
+)
+
+
+@pytest.fixture(scope="module")
+def lexicon():
+    return IngredientLexicon(reload_interval=0)
+
+
+def test_matcher_prefers_longest_leftmost_term():
+    matcher = KeywordMatcher([("蘿蔔", KIND_INGREDIENT), ("紅蘿蔔", KIND_INGREDIENT), ("炒", KIND_COOKING)])
+    assert [match.term for match in matcher.find("紅蘿蔔炒蘿蔔")] == ["紅蘿蔔", "炒", "蘿蔔"]
+    assert matcher.terms("紅蘿蔔炒蘿蔔", KIND_INGREDIENT) == ["紅蘿蔔", "蘿蔔"]
+
+
+def test_matcher_returns_canonical_name_for_alias():
+    matcher = KeywordMatcher([("蕃茄", KIND_INGREDIENT, "番茄"), ("番茄", KIND_INGREDIENT)])
+    assert matcher.terms("蕃茄和番茄") == ["番茄"]
+
+
+def test_matcher_reports_nested_terms_through_dictionary_links():
+    matcher = KeywordMatcher([("油", KIND_INGREDIENT), ("醬油", KIND_INGREDIENT), ("Tofu", KIND_INGREDIENT)])
+    assert sorted(match.term for match in matcher.find_all("醬油")) == ["油", "醬油"]
+    assert [match.term for match in matcher.find("醬油炒TOFU")] == ["醬油", "tofu"]
+
+
+def test_shared_lexicon_keeps_compound_ingredients_whole(lexicon):
+    ingredients = lexicon.matcher.terms("紅蘿蔔加醬油紅燒", KIND_INGREDIENT)
+    assert "紅蘿蔔" in ingredients and "醬油" in ingredients
+    assert "蘿蔔" not in ingredients and "油" not in ingredients
+
+
+def test_substring_distance():
+    assert substring_distance("金針菇", "冰箱有金針姑", 1) == (1, 3, 6)
+    assert substring_distance("金針菇", "冰箱有豆腐", 1) is None
+
+
+def test_exact_and_alias_matches_stay_local(lexicon):
+    extraction = lexicon.extract("我有蕃茄和洋蔥")
+    assert extraction.ingredients == ["番茄", "洋蔥"]
+    assert not extraction.needs_llm
+
+
+def test_unknown_words_go_to_llm_even_with_matches(lexicon):
+    extraction = lexicon.extract("我有鮭魚、秋葵、松露")
+    assert extraction.ingredients == ["鮭魚", "秋葵"]
+    assert extraction.unknown == ["松露"]
+    assert extraction.needs_llm
+    assert extraction.confidence < 1
+
+
+def test_bare_egg_is_an_ingredient(lexicon):
+    extraction = lexicon.extract("我有2顆蛋")
+    assert extraction.ingredients == ["雞蛋"]
+    assert not extraction.needs_llm
+    assert lexicon.extract("皮蛋豆腐").ingredients == ["皮蛋", "豆腐"]
+
+
+def test_low_confidence_fuzzy_match_goes_to_llm():
+    strict = IngredientLexicon(reload_interval=0, min_confidence=0.7)
+    loose = IngredientLexicon(reload_interval=0, min_confidence=0.6)
+    for lexicon, needs_llm in ((strict, True), (loose, False)):
+        extraction = lexicon.extract("冰箱有金針姑")
+        assert extraction.ingredients == ["金針菇"]
+        assert extraction.fuzzy == [("金針姑", "金針菇", 0.667)]
+        assert extraction.needs_llm is needs_llm
+
+
+def test_llm_avoided_counts_only_skipped_calls():
+    lexicon = IngredientLexicon(reload_interval=0)
+    lexicon.extract("我有雞蛋")  # 標準名稱：本來就不需要 LLM
+    lexicon.extract("我有鮭魚、秋葵、松露")  # 仍需要 LLM
+    lexicon.extract("我有")  # 沒有食材，也沒有省下任何呼叫
+    assert lexicon.stats()["llm_avoided"] == 0
+    lexicon.extract("我有2顆蛋")
+    stats = lexicon.stats()
+    assert stats["llm_avoided"] == 1
+    assert stats["low_confidence"] == 1
+
+
+def test_reload_picks_up_new_aliases(tmp_path):
+    path = tmp_path / "lexicon.json"
+    path.write_text(json.dumps({"version": "1", "ingredients": {"蔬菜": {"番茄": []}}}), encoding="utf-8")
+    lexicon = IngredientLexicon(str(path), reload_interval=0)
+    assert lexicon.extract("西紅柿").ingredients == []
+
+    path.write_text(json.dumps({"version": "2", "ingredients": {"蔬菜": {"番茄": ["西紅柿"]}}}), encoding="utf-8")
+    os.utime(path, (1, 1))
+    assert lexicon.reload()
+    assert lexicon.extract("西紅柿").ingredients == ["番茄"]
+    assert lexicon.category("番茄") == "蔬菜"
+
+    path.write_text("not json", encoding="utf-8")
+    assert not lexicon.reload()
+    assert lexicon.stats()["version"] == "2"
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+import pytest
+
+pytest.importorskip("linebot")
+
+from line_client import LineClient  # noqa: E402
+
+
+def test_calls_share_one_pool_and_pass_timeouts():
+    client = LineClient("token", pool_size=4, connect_timeout=1, read_timeout=5)
+    assert client.api_client.configuration.connection_pool_maxsize == 4
+    assert client.messaging_api.api_client is client.blob_api.api_client
+
+    with mock.patch.object(client.messaging_api, "reply_message_with_http_info") as reply:
+        client.reply_message("request")
+    reply.assert_called_once_with("request", _request_timeout=(1, 5))
+    client.close()
+
+
+def test_warm_up_failure_is_reported_not_raised():
+    client = LineClient("token")
+    with mock.patch.object(client.messaging_api, "get_bot_info", side_effect=OSError("offline")):
+        assert client.warm_up() is False
+    client.close()
+
+
+def test_missing_token_fails_on_use_not_on_construction():
+    client = LineClient(None)
+    client.close()  # 尚未建立連線池
+    with pytest.raises(ValueError):
+        client.reply_message("request")
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+import log_config
+from log_config import (
+    event_log_context, init_worker_logging, setup_logging, shutdown_logging, worker_logging_args
+)
+
+
+def log_from_worker(message):
+    with event_log_context("evt-worker", "U1"):
+        logging.getLogger("worker").info(message)
+
+
+@pytest.fixture
+def log_file(tmp_path):
+    root = logging.getLogger()
+    saved = (list(root.handlers), root.level)
+    path = tmp_path / "app.log"
+    yield path
+    shutdown_logging()
+    log_config._process_queue = None
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in saved[0]:
+        root.addHandler(handler)
+    root.setLevel(saved[1])
+
+
+def read_entries(path):
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+def test_records_carry_event_context(log_file):
+    setup_logging(log_file=str(log_file))
+    with event_log_context("evt-1", "U1"):
+        logging.getLogger("test").info("hello")
+    logging.getLogger("test").info("outside")
+    shutdown_logging()
+
+    first, second = read_entries(log_file)
+    assert first["message"] == "hello"
+    assert first["event_id"] == "evt-1" and first["user_id"] == "U1"
+    assert "event_id" not in second
+
+
+def test_process_pool_workers_log_through_parent(log_file):
+    setup_logging(log_file=str(log_file))
+    with ProcessPoolExecutor(max_workers=2, initializer=init_worker_logging,
+                             initargs=worker_logging_args()) as pool:
+        list(pool.map(log_from_worker, ["from child 1", "from child 2"]))
+    shutdown_logging()
+
+    entries = [entry for entry in read_entries(log_file) if entry["logger"] == "worker"]
+    assert sorted(entry["message"] for entry in entries) == ["from child 1", "from child 2"]
+    assert all(entry["event_id"] == "evt-worker" for entry in entries)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from llm import LLMClient
+from llm.backends import LLMBackend
+from message_coalescer import MessageCoalescer
+
+
+class HangingBackend(LLMBackend):
+    """回應很慢的後端，記錄呼叫是否被中止"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.aborted = threading.Event()
+
+    def generate_content(self, contents, generation_config=None, stream=False):
+        return asyncio.run(self.generate_content_async(contents, generation_config))
+
+    async def generate_content_async(self, contents, generation_config=None):
+        self.started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            self.aborted.set()
+            raise
+        return SimpleNamespace(text="too late")
+
+
+def test_messages_within_window_are_merged():
+    coalescer = MessageCoalescer(window=0.1, max_wait=1)
+    for message_id, text in (("m1", "雞蛋"), ("m2", "蔥"), ("m3", "白飯")):
+        coalescer.arrive("U1", message_id, text)
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        futures = [pool.submit(coalescer.take, "U1", message_id, text)
+                   for message_id, text in (("m1", "雞蛋"), ("m2", "蔥"), ("m3", "白飯"))]
+        batches = [future.result(timeout=2) for future in futures]
+
+    batch = next(batch for batch in batches if batch is not None)
+    assert sum(batch is not None for batch in batches) == 1
+    assert batch.text == "雞蛋\n蔥\n白飯"
+    assert coalescer.finish(batch)
+    assert coalescer.stats()["merged"] == 2
+
+
+def test_command_is_not_merged():
+    coalescer = MessageCoalescer(window=0.05, max_wait=1)
+    coalescer.arrive("U1", "m1", "雞蛋")
+    coalescer.arrive("U1", "m2", "重新開始", mergeable=False)
+    first = coalescer.take("U1", "m1", "雞蛋")
+    assert first.text == "雞蛋"
+    coalescer.finish(first)
+    second = coalescer.take("U1", "m2", "重新開始", mergeable=False)
+    assert second.text == "重新開始"
+    coalescer.finish(second)
+
+
+def test_new_message_cancels_running_batch_and_is_merged():
+    coalescer = MessageCoalescer(window=0.05, max_wait=1)
+    coalescer.arrive("U1", "m1", "雞蛋")
+    first = coalescer.take("U1", "m1", "雞蛋")
+    coalescer.arrive("U1", "m2", "蔥")
+    assert coalescer.is_cancelled("U1")
+    assert not coalescer.finish(first)
+
+    second = coalescer.take("U1", "m2", "蔥")
+    assert second.text == "雞蛋\n蔥"
+    assert coalescer.finish(second)
+
+
+def test_unfinished_batch_does_not_block_user_forever():
+    coalescer = MessageCoalescer(window=0.01, max_wait=0.1, max_running=0.2)
+    coalescer.arrive("U1", "m1", "雞蛋")
+    crashed = coalescer.take("U1", "m1", "雞蛋")  # 處理函數沒有呼叫 finish()
+
+    coalescer.arrive("U1", "m2", "重新開始", mergeable=False)
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(batch=coalescer.take(
+        "U1", "m2", "重新開始", mergeable=False)), daemon=True)
+    started = time.monotonic()
+    thread.start()
+    thread.join(2)
+    assert not thread.is_alive()
+    assert result["batch"].text == "重新開始"
+    assert time.monotonic() - started >= 0.15
+    assert coalescer.stats()["abandoned"] == 1
+
+    # 中斷的批次之後才結束時不影響目前處理中的批次
+    coalescer.finish(crashed)
+    assert coalescer.finish(result["batch"])
+
+
+def test_new_message_aborts_the_running_llm_call():
+    coalescer = MessageCoalescer(window=0.01, max_wait=1)
+    backend = HangingBackend()
+    client = LLMClient(backend, timeout=5)
+    coalescer.arrive("U1", "m1", "雞蛋")
+    batch = coalescer.take("U1", "m1", "雞蛋")
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        call = pool.submit(client.generate_content, "推薦料理：雞蛋", "recommendations", cancel=batch.cancel_token)
+        assert backend.started.wait(2)
+        started = time.monotonic()
+        coalescer.arrive("U1", "m2", "蔥")
+        with pytest.raises(CancelledError):
+            call.result(timeout=2)
+
+    assert time.monotonic() - started < 1  # 不必等上游回應或逾時
+    assert backend.aborted.wait(1)
+    assert not coalescer.finish(batch)
+    snapshot = client.metrics.snapshot()["call_types"]["recommendations"]
+    assert snapshot["outcomes"] == {"cancelled": 1}
+    client.shutdown()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import concurrent.futures
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from llm.metrics import (JsonlSink, LLMMetrics, OUTCOME_CIRCUIT_OPEN, OUTCOME_ERROR, OUTCOME_OK,
+                         OUTCOME_TIMEOUT, outcome_of, parse_pricing)
+from llm.resilience import CircuitOpenError
+
+
+def test_parse_pricing():
+    assert parse_pricing("flash=0.1/0.4, pro=1.25,bad=x/y,nothing") == {
+        "flash": (0.1, 0.4), "pro": (1.25, 1.25)}
+
+
+def test_outcome_of():
+    assert outcome_of(None) == OUTCOME_OK
+    assert outcome_of(CircuitOpenError("open")) == OUTCOME_CIRCUIT_OPEN
+    assert outcome_of(TimeoutError()) == OUTCOME_TIMEOUT
+    # single-flight 與閘道等待逾時拋出的類型（Python 3.10 時與內建 TimeoutError 不同）
+    with pytest.raises(concurrent.futures.TimeoutError) as caught:
+        concurrent.futures.Future().result(timeout=0.01)
+    assert outcome_of(caught.value) == OUTCOME_TIMEOUT
+    assert outcome_of(asyncio.TimeoutError()) == OUTCOME_TIMEOUT
+    assert outcome_of(ValueError()) == OUTCOME_ERROR
+
+
+def test_histogram_percentiles_tokens_and_cost():
+    metrics = LLMMetrics(buckets=(1, 5), pricing={"flash": (1.0, 2.0)})
+    for latency in (0.5, 0.5, 0.5, 3.0):
+        metrics.record("details", latency, model="flash", input_tokens=1000,
+                       output_tokens=500, attempts=2)
+    metrics.record("details", 9.0, model="flash", attempts=1, outcome=OUTCOME_TIMEOUT)
+    metrics.record_cache_hit("details")
+
+    snapshot = metrics.snapshot()
+    details = snapshot["call_types"]["details"]
+    assert details["calls"] == 6
+    assert details["outcomes"] == {"ok": 4, "timeout": 1, "cache_hit": 1}
+    assert details["latency"]["histogram"] == {"le_1": 4, "le_5": 1, "inf": 1}
+    assert details["latency"]["p50"] == 1
+    assert details["latency"]["p99"] is None  # 超過最後區間
+    assert details["retries"] == 4
+    assert details["cache_hits"] == 1
+    # 每次 (1000 * 1 + 500 * 2) / 1e6 = 0.002
+    assert details["cost"] == 0.008
+    assert snapshot["total_cost"] == 0.008
+    # 快取命中沒有呼叫模型，不計入模型用量
+    assert snapshot["models"]["flash"]["calls"] == 5
+
+
+def test_jsonl_sink_writes_every_record(tmp_path):
+    path = tmp_path / "calls.jsonl"
+    metrics = LLMMetrics(sink=JsonlSink(str(path)))
+    metrics.record("ingredients", 0.2, model="flash", attempts=1, hedged=True)
+    metrics.record_cache_hit("ingredients")
+    metrics.close()
+
+    records = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert [record["outcome"] for record in records] == ["ok", "cache_hit"]
+    assert records[0]["hedged"] is True
+    assert metrics.snapshot()["sink_dropped"] == 0
+
+
+_fork_metrics = None
+
+
+def _record_in_worker():
+    _fork_metrics.record("details", 0.3, model="flash", attempts=1)
+    _fork_metrics.close()
+
+
+@pytest.mark.skipif(not hasattr(os, "register_at_fork"), reason="需要 fork")
+def test_jsonl_sink_keeps_writing_in_forked_worker(tmp_path):
+    global _fork_metrics
+    path = tmp_path / "calls.jsonl"
+    _fork_metrics = LLMMetrics(sink=JsonlSink(str(path)))
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("fork")) as pool:
+        pool.submit(_record_in_worker).result(timeout=10)
+    _fork_metrics.close()
+    assert [json.loads(line)["call_type"] for line in path.read_text(encoding="utf-8").splitlines()] == ["details"]
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from types import SimpleNamespace
+
+from llm import LLMClient, LLMGateway, PromptRegistry, parse_output_limits
+from llm.backends import LLMBackend
+from llm.prompts import response_usage
+
+
+class RecordingBackend(LLMBackend):
+    """記錄收到的內容與設定，不支援系統指示"""
+
+    def __init__(self):
+        self.calls = []
+
+    def generate_content(self, contents, generation_config=None, stream=False):
+        self.calls.append((contents, generation_config))
+        return SimpleNamespace(text="回應")
+
+
+def test_generation_config_merges_limit_and_overrides():
+    registry = PromptRegistry()
+    registry.register("details", max_output_tokens=800)
+    assert registry.generation_config("details") == {"max_output_tokens": 800}
+    assert registry.generation_config("details", {"max_output_tokens": 100, "temperature": 0}) == {
+        "max_output_tokens": 100, "temperature": 0}
+    assert registry.generation_config("unknown") is None
+
+
+def test_usage_report_is_sorted_by_total_tokens():
+    registry = PromptRegistry()
+    registry.register("small", max_output_tokens=50)
+    registry.record("small", 10, 5)
+    registry.record("large", 100, 200, truncated=True)
+    registry.record("large", 300, 100)
+    report = registry.report()
+    assert [row["name"] for row in report] == ["large", "small"]
+    large = report[0]
+    assert large["calls"] == 2 and large["total_tokens"] == 700 and large["truncated"] == 1
+    assert large["max_input_tokens"] == 300 and large["avg_output_tokens"] == 150
+    assert report[1]["output_limit"] == 50
+    assert len(registry.report(limit=1)) == 1
+
+
+def test_spec_version_tracks_system_instruction():
+    registry = PromptRegistry()
+    first = registry.register("details", "你是廚師")
+    second = registry.register("details", "你是營養師")
+    assert first.version != second.version
+    assert registry.get("details") is second
+
+
+def test_response_usage_prefers_sdk_metadata():
+    metadata = SimpleNamespace(prompt_token_count=12, candidates_token_count=34)
+    truncated = SimpleNamespace(finish_reason=SimpleNamespace(name="MAX_TOKENS"))
+    response = SimpleNamespace(text="x", usage_metadata=metadata, candidates=[truncated])
+    assert response_usage("prompt", response) == {"input_tokens": 12, "output_tokens": 34, "truncated": True}
+    assert response_usage("番茄", SimpleNamespace(text="炒蛋")) == {
+        "input_tokens": 2, "output_tokens": 2, "truncated": False}
+
+
+def test_parse_output_limits():
+    assert parse_output_limits("details=800, recommendations=400,bad,x=y") == {
+        "details": 800, "recommendations": 400}
+    assert parse_output_limits("") == {}
+
+
+def test_system_instruction_is_prepended_when_backend_lacks_support():
+    backend = RecordingBackend()
+    registry = PromptRegistry()
+    registry.register("details", "你是廚師", max_output_tokens=256)
+    client = LLMClient(backend, timeout=5, gateway=LLMGateway(), prompts=registry)
+    try:
+        client.generate_content("番茄炒蛋怎麼做", call_type="details")
+    finally:
+        client.shutdown()
+    contents, config = backend.calls[0]
+    assert contents == "你是廚師\n\n番茄炒蛋怎麼做"
+    assert config == {"max_output_tokens": 256}
+    assert registry.report()[0]["calls"] == 1
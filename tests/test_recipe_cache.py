@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import recipe_cache
+from recipe_cache import (
+    LRUTTLCache, RecipeDetailCache, RecommendationCache, normalize_ingredients, normalize_recipe_name,
+    prompt_version
+)
+
+
+@pytest.fixture(autouse=True)
+def sqlite_db(db_connect, monkeypatch):
+    monkeypatch.setattr(recipe_cache, "get_db_connection", db_connect)
+
+
+def test_lru_ttl_cache_evicts_by_count_bytes_and_age(monkeypatch):
+    cache = LRUTTLCache(max_entries=2, max_bytes=1000, ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")  # a 變成最近使用
+    cache.set("c", 3)
+    assert cache.get("b") is None and cache.get("a") == 1
+
+    cache.set("big", "x" * 2000)  # 超過大小上限的項目不存
+    assert cache.get("big") is None
+
+    now = [1000.0]
+    monkeypatch.setattr(recipe_cache.time, "time", lambda: now[0])
+    cache.set("old", 1)
+    now[0] += 11
+    assert cache.get("old") is None
+    assert cache.stats()["expired"] == 1
+
+
+def test_revision_changes_only_on_writes():
+    cache = LRUTTLCache()
+    cache.set("a", 1)
+    revision = cache.revision
+    cache.get("a")
+    cache.peek("a")
+    assert cache.revision == revision
+    cache.delete("a")
+    assert cache.revision == revision + 1
+
+
+def test_normalize_keys():
+    assert normalize_ingredients([" 雞蛋", "番茄", "雞蛋", ""]) == normalize_ingredients(["番茄", "雞蛋"])
+    assert normalize_recipe_name(" 「番茄 炒蛋」") == normalize_recipe_name("番茄炒蛋")
+    assert prompt_version("a") != prompt_version("b")
+
+
+def test_recommendations_ignore_ingredient_order_and_namespace():
+    cache = RecommendationCache(refresh_probability=0)
+    dishes = [{"name": "番茄炒蛋"}]
+    cache.add(["雞蛋", "番茄"], dishes)
+    assert cache.get(["番茄", "雞蛋 "]) == dishes
+    assert cache.get(["番茄", "雞蛋"], namespace="combined") is None
+    assert cache.get([]) is None
+
+
+def test_recommendations_keep_limited_variants():
+    cache = RecommendationCache(max_variants=2, refresh_probability=0, persist=False)
+    for index in range(3):
+        cache.add(["雞蛋"], [{"name": f"dish {index}"}])
+    seen = {cache.get(["雞蛋"])[0]["name"] for _ in range(50)}
+    assert seen == {"dish 1", "dish 2"}
+
+
+def test_recommendations_variety_refresh_reports_miss(monkeypatch):
+    cache = RecommendationCache(max_variants=3, refresh_probability=1, persist=False)
+    cache.add(["雞蛋"], [{"name": "蒸蛋"}])
+    assert cache.get(["雞蛋"]) is None
+    assert cache.stats()["variety_refreshes"] == 1
+
+
+def test_recommendations_survive_restart_through_sqlite():
+    RecommendationCache(refresh_probability=0).add(["豆腐"], [{"name": "麻婆豆腐"}])
+    restarted = RecommendationCache(refresh_probability=0)
+    assert restarted.get(["豆腐"]) == [{"name": "麻婆豆腐"}]
+    assert restarted.stats()["persistent_hits"] == 1
+
+
+def test_recipe_details_two_tiers_and_versioning():
+    details = {"ingredients": ["雞蛋"], "steps": ["打蛋"]}
+    RecipeDetailCache("v1").put("番茄炒蛋", details)
+
+    restarted = RecipeDetailCache("v1")
+    assert restarted.get("「番茄炒蛋」") == details
+    assert restarted.stats()["persistent_hits"] == 1
+    assert restarted.get("番茄炒蛋") == details  # 第二次由記憶體命中
+    assert restarted.stats()["persistent_hits"] == 1
+    assert RecipeDetailCache("v1").contains("番茄 炒蛋")
+
+    changed_prompt = RecipeDetailCache("v2")
+    assert changed_prompt.get("番茄炒蛋") is None
+    assert changed_prompt.stats()["stale"] == 1
+
+
+def test_recipe_details_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(recipe_cache.time, "time", lambda: now[0])
+    RecipeDetailCache("v1", max_age=60).put("蒸蛋", {"steps": ["蒸"]})
+    now[0] += 61
+    assert RecipeDetailCache("v1", max_age=60).get("蒸蛋") is None
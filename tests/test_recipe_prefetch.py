@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from recipe_prefetch import RecipePrefetcher
+
+
+def wait_idle(prefetcher):
+    prefetcher._executor.shutdown(wait=True)
+    return prefetcher.stats()
+
+
+def test_prefetch_runs_each_dish_once_and_counts_results():
+    fetched = []
+
+    def fetch(name, recommendation):
+        fetched.append(name)
+        if name == "壞掉":
+            raise RuntimeError("upstream down")
+        return {"name": name} if name != "空的" else None
+
+    prefetcher = RecipePrefetcher(fetch, max_workers=1)
+    items = [("番茄炒蛋", {}), ("", {}), ("空的", {}), ("壞掉", {})]
+    assert prefetcher.schedule(items) == 3
+
+    stats = wait_idle(prefetcher)
+    assert sorted(fetched) == sorted(["番茄炒蛋", "空的", "壞掉"])
+    assert (stats["completed"], stats["failed"], stats["pending"]) == (1, 2, 0)
+
+
+def test_duplicate_and_over_budget_dishes_are_skipped():
+    release = threading.Event()
+    prefetcher = RecipePrefetcher(lambda name, _: release.wait(5), max_pending=2, max_per_minute=3)
+    assert prefetcher.schedule([("a", {}), ("a", {}), ("b", {}), ("c", {})]) == 2
+    assert prefetcher.stats()["skipped_budget"] == 1  # c：佇列已滿；重複的 a 不計入
+    release.set()
+    wait_idle(prefetcher)
+
+    prefetcher = RecipePrefetcher(lambda name, _: True, max_per_minute=1)
+    assert prefetcher.schedule([("a", {}), ("b", {})]) == 1
+    assert wait_idle(prefetcher)["skipped_budget"] == 1
+
+
+def test_busy_foreground_stops_prefetching():
+    prefetcher = RecipePrefetcher(lambda name, _: True, is_busy=lambda: True)
+    assert prefetcher.schedule([("a", {}), ("b", {})]) == 0
+    assert wait_idle(prefetcher)["skipped_busy"] == 1
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from llm import CircuitBreaker, CircuitOpenError, LLMClient, LLMGateway, RetryPolicy
+from llm.backends import LLMBackend
+from llm.resilience import CLOSED, HALF_OPEN, OPEN, is_retryable
+
+
+class ChunkBackend(LLMBackend):
+    """逐段返回固定片段的串流後端"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def generate_content(self, contents, generation_config=None, stream=False):
+        if stream:
+            return (SimpleNamespace(text=chunk) for chunk in self.chunks)
+        return SimpleNamespace(text="".join(self.chunks))
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    assert breaker.state == OPEN
+
+
+@pytest.fixture
+def client():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=0.05)
+    gateway = LLMGateway(max_concurrent=2, breaker=breaker, retry=RetryPolicy(max_attempts=1))
+    client = LLMClient(ChunkBackend(["a", "b", "c", "d"]), timeout=5, gateway=gateway)
+    yield client
+    client.shutdown()
+
+
+def test_breaker_opens_and_recovers_through_probe():
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=0.05)
+    open_breaker(breaker)
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()  # 只放行一個試探請求
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.stats()["rejected"] == 2
+
+
+def test_failed_probe_reopens():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=0.05)
+    open_breaker(breaker)
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+
+def test_released_probe_can_be_retried():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=0.05)
+    open_breaker(breaker)
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+
+
+def test_lost_probe_times_out():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=0.05, probe_timeout=0.05)
+    open_breaker(breaker)
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+
+
+def test_release_after_verdict_is_noop():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=0.05)
+    open_breaker(breaker)
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    breaker.release()
+    assert breaker.state == CLOSED
+
+
+def test_early_stream_close_settles_half_open_probe(client):
+    breaker = client.gateway.breaker
+    open_breaker(breaker)
+    time.sleep(0.06)
+
+    stream = client.stream_content("prompt", call_type="recommendations")
+    assert next(stream) == "a"
+    stream.close()  # 和 stream_llm_recommendations 收到足夠菜色後一樣提前停止
+
+    assert breaker.state == CLOSED
+    assert client.generate_content("prompt").text == "abcd"
+
+
+def test_stream_error_counts_as_failure():
+    class BrokenBackend(LLMBackend):
+        def generate_content(self, contents, generation_config=None, stream=False):
+            raise ConnectionError("down")
+
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=30)
+    gateway = LLMGateway(breaker=breaker, retry=RetryPolicy(max_attempts=1))
+    client = LLMClient(BrokenBackend(), timeout=5, gateway=gateway)
+    try:
+        with pytest.raises(ConnectionError):
+            list(client.stream_content("prompt"))
+        assert breaker.state == OPEN
+        with pytest.raises(CircuitOpenError):
+            client.generate_content("another prompt")
+    finally:
+        client.shutdown()
+
+
+def test_retry_policy_respects_attempts_and_budget():
+    policy = RetryPolicy(max_attempts=3, base_delay=1, max_delay=8)
+    assert policy.next_delay(1, ConnectionError(), remaining=60) <= 1
+    assert policy.next_delay(3, ConnectionError(), remaining=60) is None
+    assert policy.next_delay(1, ConnectionError(), remaining=0.5) is None
+    assert policy.next_delay(1, ValueError(), remaining=60) is None
+
+
+class QuotaError(Exception):
+    code = 429
+
+
+def test_retryable_errors():
+    assert is_retryable(asyncio.TimeoutError())
+    assert is_retryable(QuotaError())
+    assert not is_retryable(CircuitOpenError())
+    assert not is_retryable(ValueError())
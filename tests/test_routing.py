@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from llm.backends import FakeBackend
+from llm.routing import ModelRouter, ModelTier, parse_routes
+
+
+def make_router(**kwargs):
+    tiers = [ModelTier(name, FakeBackend(latency="fixed:0", model_name=f"model-{name}"))
+             for name in ("default", "fast")]
+    return ModelRouter(tiers, routes={"ingredients": ["fast", "default"], "broken": ["missing"]}, **kwargs)
+
+
+def test_parse_routes():
+    assert parse_routes("ingredients=fast>default, substitution = fast ,bad,empty=") == {
+        "ingredients": ["fast", "default"], "substitution": ["fast"]}
+    assert parse_routes("") == {}
+
+
+def test_routes_skip_unknown_tiers_and_default_to_first():
+    router = make_router()
+    assert router.route("ingredients") == ["fast", "default"]
+    assert router.route("broken") == ["default"]  # 只含未設定層級的路由被略過
+    assert router.route("details") == ["default"]
+    assert router.choose("details").model_name == "model-default"
+    assert router.choose("ingredients", exclude=["fast", "default"]) is None
+    with pytest.raises(ValueError):
+        ModelRouter([])
+
+
+def test_rate_limited_tier_falls_back_then_recovers():
+    router = make_router(cooldown=30)
+    fast = router.tiers["fast"]
+    router.record_failure(fast, 0.1, rate_limited=True)
+    assert router.choose("ingredients").name == "default"
+    assert router.stats()["tiers"]["fast"]["state"] == "rate_limited"
+    assert router.stats()["fallbacks"] == 1
+
+    fast.limited_until = 0.0  # 冷卻結束
+    assert router.choose("ingredients").name == "fast"
+
+
+def test_slow_tier_is_paused_but_still_used_when_nothing_else_is_available():
+    router = make_router(slow_after=1)
+    router.record_success(router.tiers["fast"], 5.0)
+    assert router.choose("ingredients").name == "default"
+
+    router.record_cancelled(router.tiers["default"], 5.0)
+    # 全部暫停時仍使用偏好層級，而不是拒絕呼叫
+    assert router.choose("ingredients").name == "fast"
+
+
+def test_stats_report_latency_and_decisions():
+    router = make_router()
+    tier = router.tiers["default"]
+    for latency in (0.1, 0.2, 0.3, 0.4):
+        router.record_success(tier, latency)
+    router.record_failure(tier, 0.5)
+    router.choose("details")
+
+    stats = router.stats()
+    assert stats["tiers"]["default"]["calls"] == 5
+    assert stats["tiers"]["default"]["errors"] == 1
+    assert stats["tiers"]["default"]["p50"] == 0.3
+    assert stats["tiers"]["fast"]["p95"] == 0.0
+    assert stats["decisions"] == {"details": {"default": 1}}
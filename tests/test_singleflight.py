@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import threading
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+
+import pytest
+
+from llm import CancelToken, SingleFlight
+
+
+def completed(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def run_with_timeout(fn, timeout=2):
+    """在另一個執行緒執行，死結時讓測試失敗而不是卡住"""
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault("value", fn()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "SingleFlight.do 沒有返回（死結）"
+    return result["value"]
+
+
+def test_instant_call_does_not_deadlock():
+    flight = SingleFlight()
+    assert run_with_timeout(lambda: flight.do("key", lambda: completed("done"))) == "done"
+    assert flight.stats() == {"calls": 1, "shared": 0, "in_flight": 0}
+    # 已完成的請求不再被合併
+    assert run_with_timeout(lambda: flight.do("key", lambda: completed("again"))) == "again"
+    assert flight.stats()["calls"] == 2
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight()
+    upstream = Future()
+    starts = []
+    joined = []
+
+    def start():
+        starts.append(1)
+        return upstream
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        leader = pool.submit(flight.do, "key", start, 2)
+        while flight.stats()["in_flight"] == 0:
+            pass
+        followers = [pool.submit(flight.do, "key", start, 2, joined.append) for _ in range(3)]
+        while flight.stats()["shared"] < 3:
+            pass
+        upstream.set_result("shared result")
+        results = [leader.result()] + [future.result() for future in followers]
+
+    assert results == ["shared result"] * 4
+    assert len(starts) == 1
+    assert joined == [upstream] * 3
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_failure_is_shared_and_forgotten():
+    flight = SingleFlight()
+    failed = Future()
+    failed.set_exception(ValueError("boom"))
+    with pytest.raises(ValueError):
+        flight.do("key", lambda: failed)
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_cancelled_caller_aborts_only_when_last_waiter():
+    flight = SingleFlight()
+    upstream = Future()
+    abandoned = []
+    first, second = CancelToken(), CancelToken()
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(flight.do, "key", lambda: upstream, 2, None, first, abandoned.append)
+        while flight.stats()["in_flight"] == 0:
+            pass
+        follower = pool.submit(flight.do, "key", lambda: upstream, 2, None, second, abandoned.append)
+        while flight.stats()["shared"] == 0:
+            pass
+
+        first.cancel()
+        with pytest.raises(CancelledError):
+            leader.result(timeout=1)
+        assert abandoned == []  # 仍有呼叫端在等待，不中止上游
+
+        second.cancel()
+        with pytest.raises(CancelledError):
+            follower.result(timeout=1)
+        assert abandoned == [upstream]
+
+
+def test_already_cancelled_token_never_starts_a_call():
+    flight = SingleFlight()
+    token = CancelToken()
+    token.cancel()
+    with pytest.raises(CancelledError):
+        flight.do("key", lambda: pytest.fail("不應送出請求"), cancel=token)
+    assert flight.stats()["calls"] == 0
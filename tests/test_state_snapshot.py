@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+import state_snapshot
+from conversation_state import MemoryConversationState
+from recipe_cache import LRUTTLCache
+from state_snapshot import StateSnapshotter
+
+
+def make_snapshotter(path, **kwargs):
+    state = MemoryConversationState()
+    cache = LRUTTLCache(max_entries=100, max_bytes=1024 * 1024)
+    snapshotter = StateSnapshotter(str(path), state, {"recipes": (cache, "v1")}, **kwargs)
+    return snapshotter, state, cache
+
+
+def restore(path, tag="v1"):
+    snapshotter, state, cache = make_snapshotter(path)
+    snapshotter.caches = {"recipes": (cache, tag)}
+    snapshotter.load()
+    return snapshotter, state, cache
+
+
+@pytest.fixture
+def path(tmp_path):
+    return tmp_path / "state.snapshot"
+
+
+def test_full_and_delta_frames_round_trip(path):
+    snapshotter, state, cache = make_snapshotter(path)
+    state.update_user_state("U1", {"stage": "recommend", "ingredients": ["雞蛋"]})
+    cache.set("番茄炒蛋", {"steps": ["打蛋"]})
+    assert snapshotter.save()  # 沒有快照檔時寫入完整快照
+    state.update_user_state("U2", {"ingredients": ["豆腐"]})
+    state.reset_user_state("U1")
+    assert snapshotter.save()
+    assert not snapshotter.save()  # 沒有變動
+    assert snapshotter.stats()["pending_deltas"] == 1
+
+    _, restored, restored_cache = restore(path)
+    assert restored.get_user_state("U1").get("ingredients") == []
+    assert restored.get_user_state("U2").get("ingredients") == ["豆腐"]
+    assert restored_cache.get("番茄炒蛋") == {"steps": ["打蛋"]}
+
+
+def test_cache_delta_contains_only_changed_keys(path):
+    snapshotter, _, cache = make_snapshotter(path)
+    for index in range(50):
+        cache.set(f"recipe-{index}", {"steps": [f"step {index}"] * 20})
+    snapshotter.save()
+    full_bytes = snapshotter.stats()["last_save_bytes"]
+
+    cache.set("recipe-new", {"steps": ["new"]})
+    cache.delete("recipe-0")
+    snapshotter.save()
+    assert snapshotter.stats()["last_save_bytes"] < full_bytes / 5
+
+    _, _, restored_cache = restore(path)
+    assert restored_cache.get("recipe-new") == {"steps": ["new"]}
+    assert restored_cache.get("recipe-0") is None
+    assert restored_cache.get("recipe-49") == {"steps": ["step 49"] * 20}
+
+
+def test_cache_with_other_tag_is_not_restored(path):
+    snapshotter, _, cache = make_snapshotter(path)
+    cache.set("番茄炒蛋", {"steps": []})
+    snapshotter.save()
+    _, _, restored_cache = restore(path, tag="v2")
+    assert restored_cache.get("番茄炒蛋") is None
+
+
+def test_compaction_rewrites_single_full_frame(path):
+    snapshotter, state, _ = make_snapshotter(path, compact_after=3)
+    snapshotter.save()
+    for index in range(3):
+        state.update_user_state(f"U{index}", {"ingredients": [str(index)]})
+        snapshotter.save()
+    assert snapshotter.stats()["pending_deltas"] == 3
+    size_before = os.path.getsize(path)
+
+    state.update_user_state("U9", {"ingredients": ["9"]})
+    snapshotter.save()
+    stats = snapshotter.stats()
+    assert stats["pending_deltas"] == 0 and stats["full_saves"] == 2
+    assert os.path.getsize(path) < size_before + stats["last_save_bytes"]
+
+    _, restored, _ = restore(path)
+    assert restored.stats()["users"] == 4
+
+
+def test_truncated_trailing_frame_is_skipped(path):
+    snapshotter, state, _ = make_snapshotter(path)
+    state.update_user_state("U1", {"ingredients": ["雞蛋"]})
+    snapshotter.save()
+    state.update_user_state("U2", {"ingredients": ["豆腐"]})
+    snapshotter.save()
+    snapshotter.close()
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 3)
+
+    restored_snapshotter, restored, _ = restore(path)
+    assert restored.get_user_state("U1").get("ingredients") == ["雞蛋"]
+    assert restored.stats()["users"] == 1
+    assert restored_snapshotter.stats()["skipped_frames"] == 1
+
+    # 下一次寫入改寫完整快照，不在損壞的內容後面附加
+    restored.update_user_state("U3", {"ingredients": ["白飯"]})
+    restored_snapshotter.save()
+    assert restored_snapshotter.stats()["full_saves"] == 1
+    _, again, _ = restore(path)
+    assert again.stats()["users"] == 2
+
+
+def test_unreadable_file_is_replaced(path):
+    path.write_bytes(b"garbage")
+    snapshotter, state, _ = restore(path)
+    assert snapshotter.stats()["errors"] == 1
+    state.update_user_state("U1", {"ingredients": ["雞蛋"]})
+    assert snapshotter.save()
+    _, restored, _ = restore(path)
+    assert restored.stats()["users"] == 1
+
+
+def test_failed_delta_write_forces_full_save(path, monkeypatch):
+    snapshotter, state, _ = make_snapshotter(path)
+    snapshotter.save()
+    state.update_user_state("U1", {"ingredients": ["雞蛋"]})
+
+    def broken_append(kind, payload):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(snapshotter, "_append", broken_append)
+    assert not snapshotter.save()
+    monkeypatch.undo()
+
+    assert snapshotter.save()
+    assert snapshotter.stats()["full_saves"] == 2
+    _, restored, _ = restore(path)
+    assert restored.get_user_state("U1").get("ingredients") == ["雞蛋"]
+
+
+@pytest.mark.skipif(state_snapshot.fcntl is None, reason="需要 fcntl 檔案鎖")
+def test_only_one_process_writes(path):
+    first, first_state, _ = make_snapshotter(path)
+    second, second_state, _ = make_snapshotter(path)
+    first_state.update_user_state("U1", {"ingredients": ["雞蛋"]})
+    second_state.update_user_state("U2", {"ingredients": ["豆腐"]})
+    assert first.save()
+    assert not second.save()
+    assert second.stats()["writer"] is False
+
+    first.close()
+    assert second.save()  # 寫入的程序結束後接手，並改寫完整快照
+    assert second.stats()["full_saves"] == 1
+    _, restored, _ = restore(path)
+    assert restored.stats()["users"] == 1
+    assert restored.get_user_state("U2").get("ingredients") == ["豆腐"]
+    second.close()
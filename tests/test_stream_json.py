@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import json
+
+from llm import IncrementalArrayParser, iter_array_objects
+
+DISHES = [
+    {"name": "番茄炒蛋", "description": '含有 } 與 " 的說明'},
+    {"name": "蒸蛋", "details": {"steps": ["打蛋", "蒸"]}},
+    {"name": "蛋花湯"},
+]
+RESPONSE = "```json\n" + json.dumps({"recommendations": DISHES, "note": "x"}, ensure_ascii=False) + "\n```"
+
+
+def chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_objects_are_emitted_as_soon_as_they_close():
+    parser = IncrementalArrayParser()
+    first_end = RESPONSE.index("蒸蛋") - 3
+    assert [obj["name"] for obj in parser.feed(RESPONSE[:first_end])] == ["番茄炒蛋"]
+    assert not parser.done
+    rest = parser.feed(RESPONSE[first_end:])
+    assert [obj["name"] for obj in rest] == ["蒸蛋", "蛋花湯"]
+    assert parser.done
+    assert parser.feed("{}") == []
+
+
+def test_any_chunk_size_gives_same_objects():
+    for size in (1, 2, 7, 64):
+        assert list(iter_array_objects(chunked(RESPONSE, size))) == DISHES
+
+
+def test_strings_with_brackets_and_escapes():
+    objects = list(iter_array_objects(chunked(RESPONSE, 3)))
+    assert objects[0]["description"] == '含有 } 與 " 的說明'
+
+
+def test_invalid_object_is_skipped():
+    parser = IncrementalArrayParser()
+    objects = parser.feed('{"recommendations": [{"name": "a",}, {"name": "b"}]}')
+    assert [obj["name"] for obj in objects] == ["b"]
+    assert parser.errors == 1
+
+
+def test_first_array_when_no_key():
+    assert list(iter_array_objects(['[{"a": 1}', ', {"a": 2}]'], array_key=None)) == [{"a": 1}, {"a": 2}]
+
+
+def test_iterator_stops_reading_after_array():
+    consumed = []
+
+    def chunks():
+        for chunk in ('{"recommendations": [{"n": 1}]', ', "more": "x"}', "never read"):
+            consumed.append(chunk)
+            yield chunk
+
+    assert list(iter_array_objects(chunks())) == [{"n": 1}]
+    assert len(consumed) == 1
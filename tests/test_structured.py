@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+from types import SimpleNamespace
+
+import pytest
+
+from llm import OutputSchema, StructuredOutputError, coerce, generate_structured
+from llm.structured import RECIPE_DETAILS_SCHEMA, RECOMMENDATIONS_SCHEMA, SUBSTITUTIONS_SCHEMA, loads_lenient
+
+
+def parse(schema, text):
+    return OutputSchema("test", schema).parse(text)
+
+
+def test_clean_json_needs_no_repair():
+    schema = OutputSchema("test", RECOMMENDATIONS_SCHEMA)
+    data = schema.parse('{"recommendations": [{"name": "番茄炒蛋", "ingredients": ["番茄", "雞蛋"]}]}')
+    assert data["recommendations"][0]["ingredients"] == ["番茄", "雞蛋"]
+    assert schema.stats()["clean"] == 1
+
+
+@pytest.mark.parametrize("text", [
+    '```json\n{"recommendations": [{"name": "蒸蛋"}]}\n```',
+    '好的，以下是推薦：{"recommendations": [{"name": "蒸蛋"}]} 祝您用餐愉快',
+    '{"recommendations": [{"name": "蒸蛋"},],}',
+])
+def test_wrapped_or_sloppy_json_is_repaired(text):
+    schema = OutputSchema("test", RECOMMENDATIONS_SCHEMA)
+    assert schema.parse(text) == {"recommendations": [{"name": "蒸蛋"}]}
+
+
+def test_truncated_response_keeps_complete_items():
+    repairs = []
+    data = loads_lenient('{"recommendations": [{"name": "蒸蛋"}, {"name": "番茄', repairs)
+    assert data == {"recommendations": [{"name": "蒸蛋"}]}
+    assert "補上截斷的結尾" in repairs
+
+
+def test_type_drift_is_coerced():
+    data = parse(RECIPE_DETAILS_SCHEMA, '''{
+        "ingredients": ["雞蛋 2顆", {"name": "鹽", "amount": 1}],
+        "steps": "1. 打蛋\\n2. 加鹽\\n3. 蒸十分鐘",
+        "tips": ["小火", "蓋保鮮膜"],
+        "time": 15
+    }''')
+    assert data["ingredients"] == [{"name": "雞蛋 2顆"}, {"name": "鹽", "amount": "1"}]
+    assert data["steps"] == ["打蛋", "加鹽", "蒸十分鐘"]
+    assert data["tips"] == "小火\n蓋保鮮膜"
+    assert data["time"] == "15"
+
+
+def test_invalid_items_are_dropped_but_required_fields_enforced():
+    data = parse(RECOMMENDATIONS_SCHEMA, '{"recommendations": [{"name": "蒸蛋"}, {"description": "沒有名稱"}]}')
+    assert data == {"recommendations": [{"name": "蒸蛋"}]}
+    with pytest.raises(StructuredOutputError):
+        parse(RECOMMENDATIONS_SCHEMA, '{"recommendations": [{"description": "沒有名稱"}]}')
+    with pytest.raises(StructuredOutputError):
+        parse(RECIPE_DETAILS_SCHEMA, '{"steps": []}')
+
+
+def test_additional_properties():
+    data = coerce({"雞蛋": "豆腐", "醬油": ["鹽", 1]}, SUBSTITUTIONS_SCHEMA["properties"]["substitutions"])
+    assert data == {"雞蛋": ["豆腐"], "醬油": ["鹽", "1"]}
+
+
+def test_failures_are_counted():
+    schema = OutputSchema("test", RECOMMENDATIONS_SCHEMA)
+    with pytest.raises(StructuredOutputError):
+        schema.parse("抱歉，我無法回答")
+    assert schema.stats()["failed"] == 1 and schema.stats()["failure_rate"] == 1.0
+
+
+def test_generate_structured_passes_json_mode_and_parses():
+    calls = []
+
+    class Client:
+        def generate_content(self, prompt, **kwargs):
+            calls.append(kwargs)
+            return SimpleNamespace(text='{"recommendations": [{"name": "蒸蛋"}]}')
+
+    schema = OutputSchema("test", RECOMMENDATIONS_SCHEMA)
+    assert generate_structured(Client(), "prompt", schema, "recommendations") == {"recommendations": [{"name": "蒸蛋"}]}
+    assert calls[0]["call_type"] == "recommendations"
+    assert "generation_config" in calls[0]
+
+    class Empty:
+        def generate_content(self, prompt, **kwargs):
+            return SimpleNamespace(text="")
+
+    with pytest.raises(StructuredOutputError):
+        generate_structured(Empty(), "prompt", schema, "recommendations")
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("linebot")
+
+from event_dedup import MemoryDeduplicator  # noqa: E402
+from webhook_dispatcher import EventDispatcher, _event_id, _ordering_key  # noqa: E402
+
+
+def make_event(user_id, event_id, text=""):
+    return SimpleNamespace(
+        source=SimpleNamespace(user_id=user_id),
+        webhook_event_id=event_id,
+        delivery_context=SimpleNamespace(is_redelivery=False),
+        message=SimpleNamespace(id=f"m-{event_id}", text=text),
+    )
+
+
+@pytest.fixture
+def dispatcher():
+    dispatcher = EventDispatcher("secret", async_mode=True, max_workers=4)
+    yield dispatcher
+    dispatcher.shutdown()
+
+
+def test_events_of_one_user_run_in_order(dispatcher):
+    order = []
+
+    def handle(event):
+        time.sleep(0.05 if event.webhook_event_id == "e1" else 0)
+        order.append(event.webhook_event_id)
+
+    futures = [dispatcher.submit(handle, make_event("U1", f"e{index}")) for index in range(1, 5)]
+    for future in futures:
+        future.result(timeout=2)
+    assert order == ["e1", "e2", "e3", "e4"]
+    assert dispatcher.pending_users() == 0
+
+
+def test_different_users_run_in_parallel(dispatcher):
+    barrier = threading.Barrier(2, timeout=2)
+
+    def handle(event):
+        barrier.wait()  # 兩位用戶的事件必須同時執行才能通過
+
+    futures = [dispatcher.submit(handle, make_event(user_id, user_id)) for user_id in ("U1", "U2")]
+    for future in futures:
+        future.result(timeout=2)
+
+
+def test_failure_does_not_block_the_users_next_event(dispatcher):
+    def handle(event):
+        if event.webhook_event_id == "bad":
+            raise RuntimeError("boom")
+        return event.webhook_event_id
+
+    failed = dispatcher.submit(handle, make_event("U1", "bad"))
+    succeeded = dispatcher.submit(handle, make_event("U1", "good"))
+    with pytest.raises(RuntimeError):
+        failed.result(timeout=2)
+    assert succeeded.result(timeout=2) == "good"
+
+
+def test_duplicate_events_are_processed_once():
+    dispatcher = EventDispatcher("secret", async_mode=True, deduplicator=MemoryDeduplicator())
+    calls = []
+    release = threading.Event()
+
+    def handle(event):
+        release.wait(2)
+        calls.append(event.webhook_event_id)
+
+    try:
+        first = dispatcher._dispatch_once("e1", handle, make_event("U1", "e1"), None)
+        in_flight = dispatcher._dispatch_once("e1", handle, make_event("U1", "e1"), None)
+        assert in_flight is first  # 處理中的重送事件共用同一個結果
+        release.set()
+        first.result(timeout=2)
+        deadline = time.monotonic() + 2
+        while dispatcher.deduplicator.stats()["size"] and time.monotonic() < deadline:
+            if dispatcher.deduplicator._entries["e1"][0] == "done":
+                break
+            time.sleep(0.01)
+        assert dispatcher._dispatch_once("e1", handle, make_event("U1", "e1"), None) is None
+        assert calls == ["e1"]
+    finally:
+        dispatcher.shutdown()
+
+
+def test_event_keys():
+    assert _ordering_key(make_event("U1", "e1")) == "U1"
+    assert _ordering_key(SimpleNamespace(source=SimpleNamespace(user_id=None, group_id="G1"))) == "G1"
+    assert _ordering_key(SimpleNamespace()) is None
+    legacy = SimpleNamespace(webhook_event_id=None, message=SimpleNamespace(id="123"))
+    assert _event_id(legacy) == "message:123"
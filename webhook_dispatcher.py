@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Webhook 事件分派模組
+驗證簽章後把 LINE 事件交給背景工作池處理，讓 /callback 可以立即回應 200。
+同一用戶的事件依序執行，不同用戶的事件並行處理；重送的事件會先經過去重器。
+"""
+
+import inspect
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait
+from typing import Callable, Optional
+
+from linebot.v3 import WebhookHandler
+from linebot.v3.webhooks import MessageEvent
+
+from event_dedup import EventDeduplicator, NEW, IN_FLIGHT
+from log_config import event_log_context, init_worker_logging, worker_logging_args
+
+
+class EventDispatcher(WebhookHandler):
+    """依用戶排序、跨用戶並行的 Webhook 處理器，可切換同步 / 背景處理模式"""
+
+    def __init__(self, channel_secret: str, async_mode: bool = False,
+                 max_workers: int = 8, worker_type: str = "thread",
+                 deduplicator: Optional[EventDeduplicator] = None,
+                 on_submit: Optional[Callable] = None):
+        """
+        初始化事件分派器
+
+        Args:
+            channel_secret: LINE Channel Secret
+            async_mode: 是否在背景工作池處理事件（立即回應 webhook）
+            max_workers: 背景工作池大小
+            worker_type: 工作池類型，thread 或 process
+            deduplicator: 事件去重器，None 表示不去重
+            on_submit: 事件交給工作池前呼叫的函數（在 webhook 請求中依收到順序執行，早於任何事件處理）
+        """
+        super().__init__(channel_secret)
+        self.async_mode = async_mode
+        self.max_workers = max_workers
+        self.worker_type = worker_type
+        self.deduplicator = deduplicator
+        self.on_submit = on_submit
+        self.logger = logging.getLogger(__name__)
+
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+        # 每個用戶尚未執行的事件佇列；key 存在代表該用戶有事件正在執行
+        self._user_queues = {}
+        self._queue_lock = threading.Lock()
+
+        # 處理中事件的 Future，重送事件直接附加到這裡
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+    def _get_executor(self):
+        """延遲建立背景工作池"""
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    if self.worker_type == "process":
+                        # 子進程的日誌經由跨進程佇列交給主進程寫入
+                        self._executor = ProcessPoolExecutor(
+                            max_workers=self.max_workers,
+                            initializer=init_worker_logging,
+                            initargs=worker_logging_args()
+                        )
+                    else:
+                        self._executor = ThreadPoolExecutor(
+                            max_workers=self.max_workers,
+                            thread_name_prefix="line-event"
+                        )
+                    self.logger.info(f"背景工作池啟動: {self.worker_type} x {self.max_workers}")
+        return self._executor
+
+    def resolve_handler(self, event) -> Optional[Callable]:
+        """
+        依照 WebhookHandler 的規則找出事件對應的處理函數
+
+        Args:
+            event: LINE webhook 事件
+
+        Returns:
+            處理函數，找不到則返回 None
+        """
+        func = None
+        if isinstance(event, MessageEvent):
+            key = f"{event.__class__.__name__}_{event.message.__class__.__name__}"
+            func = self._handlers.get(key)
+        if func is None:
+            func = self._handlers.get(event.__class__.__name__)
+        if func is None:
+            func = self._default
+        return func
+
+    def handle(self, body, signature):
+        """
+        處理 webhook 請求
+
+        簽章驗證失敗時會拋出 InvalidSignatureError；背景模式下事件送出後即返回。
+
+        Args:
+            body: Webhook 請求內容（文字）
+            signature: X-Line-Signature 標頭
+        """
+        payload = self.parser.parse(body, signature, as_payload=True)
+
+        futures = []
+        for event in payload.events:
+            func = self.resolve_handler(event)
+            if func is None:
+                self.logger.info(f"沒有 {event.__class__.__name__} 的處理函數")
+                continue
+
+            event_id = _event_id(event)
+            if self.deduplicator is not None and event_id:
+                future = self._dispatch_once(event_id, func, event, payload.destination)
+            else:
+                future = self.submit(func, event, payload.destination)
+            if future is not None:
+                futures.append(future)
+
+        # 同步模式等待整批事件完成，總延遲取決於最慢的單一用戶
+        if not self.async_mode and futures:
+            wait(futures)
+
+    def submit(self, func: Callable, event, destination: Optional[str] = None) -> Future:
+        """
+        將事件交給背景工作池
+
+        同一用戶的事件會排隊，等前一個事件處理完才執行，確保對話狀態依序轉換。
+
+        Args:
+            func: 事件處理函數
+            event: LINE webhook 事件
+            destination: 接收事件的 Bot user ID
+
+        Returns:
+            事件處理完成時結束的 Future
+        """
+        if self.on_submit is not None:
+            try:
+                self.on_submit(event)
+            except Exception as e:
+                self.logger.warning(f"事件送出前的處理失敗: {e}")
+
+        key = _ordering_key(event)
+        result = Future()
+        task = (func, event, destination, result)
+
+        with self._queue_lock:
+            if key is not None:
+                queue = self._user_queues.get(key)
+                if queue is not None:
+                    queue.append(task)
+                    return result
+                self._user_queues[key] = deque()
+
+        self._run_task(key, task)
+        return result
+
+    def _dispatch_once(self, event_id: str, func: Callable, event,
+                       destination: Optional[str]) -> Optional[Future]:
+        """
+        經過去重器分派事件
+
+        Returns:
+            新事件或附加到處理中事件時返回 Future；已完成的重複事件返回 None
+        """
+        delivery_context = getattr(event, "delivery_context", None)
+        is_redelivery = bool(getattr(delivery_context, "is_redelivery", False))
+
+        status = self.deduplicator.claim(event_id, is_redelivery)
+        if status == IN_FLIGHT:
+            with self._in_flight_lock:
+                return self._in_flight.get(event_id)
+        if status != NEW:
+            return None
+
+        future = self.submit(func, event, destination)
+        with self._in_flight_lock:
+            self._in_flight[event_id] = future
+        future.add_done_callback(lambda done: self._on_event_finished(event_id, done))
+        return future
+
+    def _on_event_finished(self, event_id: str, future: Future):
+        """更新去重器中的事件狀態"""
+        with self._in_flight_lock:
+            self._in_flight.pop(event_id, None)
+        try:
+            if future.exception() is None:
+                self.deduplicator.complete(event_id)
+            else:
+                self.deduplicator.release(event_id)
+        except Exception as e:
+            self.logger.warning(f"更新事件去重狀態失敗: {e}")
+
+    def _run_task(self, key, task):
+        """執行單一事件，完成後接著執行同一用戶的下一個事件"""
+        func, event, destination, result = task
+        future = self._get_executor().submit(_invoke, func, event, destination)
+        future.add_done_callback(lambda done: self._on_task_done(key, done, result))
+
+    def _on_task_done(self, key, future, result):
+        """回報事件結果並排程同一用戶的下一個事件"""
+        error = future.exception()
+        if error is not None:
+            self.logger.error(f"背景事件處理失敗: {error}")
+            result.set_exception(error)
+        else:
+            result.set_result(future.result())
+
+        if key is None:
+            return
+        with self._queue_lock:
+            queue = self._user_queues[key]
+            if not queue:
+                del self._user_queues[key]
+                return
+            next_task = queue.popleft()
+        self._run_task(key, next_task)
+
+    def pending_users(self) -> int:
+        """目前有事件在處理或排隊中的用戶數"""
+        with self._queue_lock:
+            return len(self._user_queues)
+
+    def shutdown(self, wait: bool = True):
+        """關閉背景工作池"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+def _ordering_key(event) -> Optional[str]:
+    """取得事件的排序鍵（用戶 / 群組 / 聊天室 ID），沒有來源則不排序"""
+    source = getattr(event, "source", None)
+    if source is None:
+        return None
+    for attr in ("user_id", "group_id", "room_id"):
+        value = getattr(source, attr, None)
+        if value:
+            return value
+    return None
+
+
+def _event_id(event) -> Optional[str]:
+    """取得事件的 webhookEventId，舊格式事件改用訊息 ID"""
+    event_id = getattr(event, "webhook_event_id", None)
+    if event_id:
+        return event_id
+    message = getattr(event, "message", None)
+    message_id = getattr(message, "id", None)
+    return f"message:{message_id}" if message_id else None
+
+
+def _invoke(func: Callable, event, destination: Optional[str] = None):
+    """依處理函數的參數數量呼叫（與 WebhookHandler 相同），並附加事件日誌資訊"""
+    arg_spec = inspect.getfullargspec(func)
+    with event_log_context(_event_id(event), _ordering_key(event)):
+        if arg_spec.varargs is not None or len(arg_spec.args) == 2:
+            return func(event, destination)
+        elif len(arg_spec.args) == 1:
+            return func(event)
+        else:
+            return func()